@@ -0,0 +1,148 @@
+"""
+Cache for MARC records, keyed by barcode.
+
+Parsed records are kept in an in-process LRU of **BIB_CACHE_SIZE** records
+(default 256) that is safe to share between threads. When **BIB_CACHE_DIR**
+is set the raw XML is also written to that directory and reused for
+**BIB_CACHE_TTL** seconds (default one day), so other processes and later
+runs do not have to fetch it again.
+"""
+
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+class BibCache(object):
+    """
+    :param fetch: callable that takes a barcode and returns the raw MARC XML
+    :param parse: callable that turns the raw XML into a record object
+    """
+
+    def __init__(self, fetch, parse, size=None, cache_dir=None, ttl=None):
+        self.fetch = fetch
+        self.parse = parse
+        self.size = size or getattr(settings, 'BIB_CACHE_SIZE', 256)
+        self.cache_dir = cache_dir or getattr(settings, 'BIB_CACHE_DIR', None)
+        self.ttl = ttl or getattr(settings, 'BIB_CACHE_TTL', 24 * 60 * 60)
+        self.records = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def get(self, barcode, **kwargs):
+        """
+        Returns the record for ``barcode``, fetching it if it is not cached.
+        The record is shared by every caller and must not be modified.
+        Keyword arguments are passed on to ``fetch``.
+        """
+        with self.lock:
+            try:
+                record = self.records.pop(barcode)
+                self.records[barcode] = record
+                self.hits += 1
+                return record
+            except KeyError:
+                pass
+
+        # Fetch without holding the lock so several threads can fetch at once.
+        text = self._read(barcode)
+        if text is not None:
+            record = self.parse(text)
+            with self.lock:
+                self.disk_hits += 1
+        else:
+            text = self.fetch(barcode, **kwargs)
+            # Parse before writing so a bad response does not get cached.
+            record = self.parse(text)
+            self._write(barcode, text)
+            with self.lock:
+                self.misses += 1
+
+        self.add(barcode, record)
+        return record
+
+    def add(self, barcode, record):
+        "Put a record in the in-process cache."
+        with self.lock:
+            self.records.pop(barcode, None)
+            self.records[barcode] = record
+            while len(self.records) > self.size:
+                self.records.popitem(last=False)
+
+    @contextmanager
+    def room_for(self, count):
+        """
+        Keeps at least ``count`` records until the block ends, then goes back
+        to ``size``, dropping the least recently used records.
+        """
+        with self.lock:
+            size = self.size
+            self.size = max(size, count)
+        try:
+            yield self
+        finally:
+            with self.lock:
+                self.size = size
+                while len(self.records) > self.size:
+                    self.records.popitem(last=False)
+
+    def invalidate(self, barcode):
+        "Forget ``barcode`` so the next :meth:`get` fetches it again."
+        with self.lock:
+            self.records.pop(barcode, None)
+        if self.cache_dir:
+            try:
+                os.remove(self._path(barcode))
+            except OSError:
+                pass
+
+    def clear(self):
+        with self.lock:
+            self.records.clear()
+
+    def stats(self):
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'size': len(self.records)
+            }
+
+    def _path(self, barcode):
+        return os.path.join(self.cache_dir, '%s.xml' % barcode)
+
+    def _read(self, barcode):
+        if not self.cache_dir:
+            return None
+        cache_file = self._path(barcode)
+        try:
+            if time.time() - os.path.getmtime(cache_file) > self.ttl:
+                return None
+            with open(cache_file, 'rb') as cached:
+                return cached.read()
+        except (IOError, OSError):
+            return None
+
+    def _write(self, barcode, text):
+        if not self.cache_dir:
+            return
+        cache_file = self._path(barcode)
+        tmp_file = '%s.%s.tmp' % (cache_file, os.getpid())
+        try:
+            if not os.path.exists(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            with open(tmp_file, 'wb') as cached:
+                cached.write(text)
+            os.rename(tmp_file, cache_file)
+        except (IOError, OSError) as error:
+            logger.warning('Could not cache the bib record for %s: %s' % (barcode, error))
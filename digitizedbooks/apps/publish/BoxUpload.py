@@ -0,0 +1,277 @@
+"""
+Chunked uploads to Box.
+
+A package is sent to Box in parts through an upload session: the session is
+opened with the size of the file, the parts are sent by a pool of
+**BOX_UPLOAD_WORKERS** (default 4) threads and the session is committed with
+the list of parts and the sha1 of the whole file, which Box checks. When an
+upload is interrupted the session can be resumed, only the parts Box does
+not have yet are sent again. Sessions expire after a few days, an upload
+with an expired session starts over with a new one.
+
+Instead of reading a file, an upload can take the file as it is written to
+the object returned by :meth:`ChunkedUpload.stream`, which sends each part
+once it is full. Only the parts being sent are kept in memory, so nothing
+has to be written to disk first.
+
+The requests go through the ``make_request`` method of a
+:class:`boxsdk.Client`, so they are authenticated and errors raise
+:class:`boxsdk.exception.BoxAPIException`, to **BOX_UPLOAD_URL** (default
+the Box upload API).
+"""
+
+import base64
+import binascii
+from collections import deque, namedtuple
+import hashlib
+import json
+import logging
+from multiprocessing.pool import ThreadPool
+import os
+import threading
+import time
+
+from django.conf import settings
+
+from boxsdk.exception import BoxAPIException
+
+import Hashing
+
+logger = logging.getLogger(__name__)
+
+UploadedFile = namedtuple('UploadedFile', 'id sha1')
+'The file made by an upload, with the sha1 Box has for it'
+
+
+def upload_url():
+    return getattr(settings, 'BOX_UPLOAD_URL', 'https://upload.box.com/api/2.0')
+
+
+def chunked_threshold():
+    "Size from which files are uploaded in parts, **BOX_CHUNKED_THRESHOLD** (default 50MB)."
+    return getattr(settings, 'BOX_CHUNKED_THRESHOLD', 50 * 1024 * 1024)
+
+
+def _digest(sha1):
+    "Value of the Digest header for a sha1, as Box wants it."
+    return 'sha=%s' % base64.b64encode(sha1)
+
+
+def _retry_after(response, default=5):
+    headers = getattr(response, 'headers', None)
+    if headers is None and hasattr(response, 'network_response'):
+        headers = response.network_response.headers
+    try:
+        return int((headers or {}).get('Retry-After', default))
+    except ValueError:
+        return default
+
+
+class ChunkedUpload(object):
+    """
+    Uploads ``path`` to the Box folder ``folder_id`` as ``name``, by default
+    the file's name. If the folder already has a file with that name a new
+    version of it is uploaded.
+
+    :param path: the file to upload, None when it is written to :meth:`stream`
+    :param size: size of the file, needed when there is no ``path``
+    :param sha1: hex sha1 of the file, computed if not given
+    :param session_id: id of an upload session to resume
+    :param on_session: called with the id of the session when one is
+        opened, so it can be kept to resume the upload
+    """
+
+    def __init__(self, client, path, folder_id, name=None, size=None, sha1=None, session_id=None,
+            on_session=None, workers=None):
+        self.client = client
+        self.path = path
+        self.folder_id = folder_id
+        self.name = name or os.path.basename(path)
+        self.size = os.path.getsize(path) if size is None else size
+        self.sha1 = sha1
+        self.session_id = session_id
+        self.on_session = on_session
+        self.workers = workers or getattr(settings, 'BOX_UPLOAD_WORKERS', 4)
+        self.part_size = None
+        self.parts_sent = 0
+        'Parts sent by this upload, parts of a resumed session are not counted'
+        self._lock = threading.Lock()
+
+    def _session_url(self, *parts):
+        return '/'.join((upload_url(), 'files/upload_sessions', self.session_id) + parts)
+
+    def _open_session(self):
+        body = {'file_size': self.size}
+        try:
+            response = self.client.make_request('POST', '%s/files/upload_sessions' % upload_url(),
+                data=json.dumps(dict(body, folder_id=self.folder_id, file_name=self.name)))
+        except BoxAPIException as e:
+            # The file is already there, upload a new version of it.
+            if e.status != 409:
+                raise
+            file_id = e.context_info['conflicts']['id']
+            response = self.client.make_request('POST', '%s/files/%s/upload_sessions' % (upload_url(), file_id),
+                data=json.dumps(body))
+        session = response.json()
+        self.session_id = session['id']
+        self.part_size = session['part_size']
+        logger.info('Opened upload session %s for %s, %s parts' % (self.session_id, self.path, session['total_parts']))
+        if self.on_session is not None:
+            self.on_session(self.session_id)
+
+    def _resume_session(self):
+        "Returns the parts Box already has, None if the session expired or is for another size."
+        try:
+            session = self.client.make_request('GET', self._session_url()).json()
+        except BoxAPIException as e:
+            if e.status != 404:
+                raise
+            logger.info('Upload session %s for %s expired' % (self.session_id, self.path))
+            return None
+        self.part_size = session['part_size']
+        if session.get('total_parts', -(-self.size // self.part_size)) != -(-self.size // self.part_size):
+            logger.info('Upload session %s is for a file of another size than %s' % (self.session_id, self.path))
+            return None
+
+        parts = []
+        while True:
+            page = self.client.make_request('GET', self._session_url('parts'),
+                params={'offset': len(parts), 'limit': 1000}).json()
+            parts.extend(page['entries'])
+            if not page['entries'] or len(parts) >= page['total_count']:
+                break
+        logger.info('Resuming upload session %s for %s, %s parts were sent' % (self.session_id, self.path, len(parts)))
+        return parts
+
+    def _read_part(self, offset):
+        with open(self.path, 'rb') as package:
+            package.seek(offset)
+            data = package.read(self.part_size)
+        return self._send_part(offset, data)
+
+    def _send_part(self, offset, data):
+        end = offset + len(data) - 1
+        response = self.client.make_request('PUT', self._session_url(), data=data, headers={
+            'Content-Type': 'application/octet-stream',
+            'Digest': _digest(hashlib.sha1(data).digest()),
+            'Content-Range': 'bytes %s-%s/%s' % (offset, end, self.size)})
+        with self._lock:
+            self.parts_sent += 1
+        return response.json()['part']
+
+    def _commit(self, parts):
+        if self.sha1 is None:
+            self.sha1 = Hashing.hash_file(self.path, ('sha1',))[0]['sha1']
+        while True:
+            response = self.client.make_request('POST', self._session_url('commit'),
+                data=json.dumps({'parts': parts}), headers={
+                    'Content-Type': 'application/json',
+                    'Digest': _digest(binascii.unhexlify(self.sha1))})
+            # Box is still putting the parts together.
+            if response.status_code == 202:
+                time.sleep(_retry_after(response))
+                continue
+            entry = response.json()['entries'][0]
+            return UploadedFile(entry['id'], entry.get('sha1'))
+
+    def _start(self):
+        "Resumes or opens the session, returns the parts Box already has."
+        parts = None
+        if self.session_id:
+            parts = self._resume_session()
+        if parts is None:
+            self._open_session()
+            parts = []
+        return parts
+
+    def run(self):
+        "Sends the parts Box does not have yet and commits them. Returns an :class:`UploadedFile`."
+        parts = self._start()
+        sent = set(part['offset'] for part in parts)
+        offsets = [offset for offset in range(0, self.size, self.part_size) if offset not in sent]
+        pool = ThreadPool(min(self.workers, len(offsets)) or 1)
+        try:
+            parts.extend(pool.map(self._read_part, offsets))
+        finally:
+            pool.close()
+            pool.join()
+
+        return self._commit(sorted(parts, key=lambda part: part['offset']))
+
+    def stream(self):
+        """
+        Resumes or opens the session and returns a :class:`PartWriter` the
+        file is written to. Closing it commits the upload.
+        """
+        return PartWriter(self, self._start())
+
+
+class PartWriter(object):
+    """
+    File-like object that sends what is written to it to an upload session
+    one part at a time, at most ``workers`` parts at once. The sha1 and size
+    of the file are worked out as it is written. Parts Box already has from
+    an earlier try are not sent again, the file has to be written exactly as
+    it was then.
+    """
+
+    def __init__(self, upload, parts):
+        self.upload = upload
+        self.parts = parts
+        self.sent = set(part['offset'] for part in parts)
+        self.position = 0
+        self.sha1 = hashlib.sha1()
+        self._buffer = bytearray()
+        self._offset = 0
+        self._pool = ThreadPool(upload.workers)
+        self._sending = deque()
+        self._aborted = False
+
+    def tell(self):
+        return self.position
+
+    def write(self, data):
+        if self._aborted:
+            return
+        self.sha1.update(data)
+        self.position += len(data)
+        self._buffer += data
+        part_size = self.upload.part_size
+        while len(self._buffer) >= part_size:
+            self._send(bytes(self._buffer[:part_size]))
+            del self._buffer[:part_size]
+
+    def flush(self):
+        pass
+
+    def _send(self, data):
+        if self._offset not in self.sent:
+            # Wait for a part to be sent before keeping another one in memory.
+            while len(self._sending) >= self.upload.workers:
+                self.parts.append(self._sending.popleft().get())
+            self._sending.append(self._pool.apply_async(self.upload._send_part, (self._offset, data)))
+        self._offset += len(data)
+
+    def abort(self):
+        "Stops sending parts, the session is left to be resumed."
+        self._aborted = True
+        self._pool.terminate()
+        self._pool.join()
+
+    def close(self):
+        "Sends the last part and commits the upload. Returns an :class:`UploadedFile`."
+        try:
+            if self._buffer:
+                self._send(bytes(self._buffer))
+                self._buffer = bytearray()
+            while self._sending:
+                self.parts.append(self._sending.popleft().get())
+        finally:
+            self._pool.close()
+            self._pool.join()
+
+        if self.position != self.upload.size:
+            raise ValueError('%s bytes were written to the upload of %s, it was opened for %s' % \
+                (self.position, self.upload.name, self.upload.size))
+        self.upload.sha1 = self.sha1.hexdigest()
+        return self.upload._commit(sorted(self.parts, key=lambda part: part['offset']))
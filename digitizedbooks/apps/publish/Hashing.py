@@ -0,0 +1,76 @@
+"""
+Computes several digests of a file in one pass.
+
+HathiTrust wants md5s in ``checksum.md5``, the METS has md5s and Box
+returns sha1s. Instead of reading a file once per digest, :func:`hash_file`
+reads it once and updates every digest with each chunk. The chunks are read
+into a buffer that is reused for every file hashed by the same thread, so
+hashing a volume does not allocate a new string for each chunk.
+
+The buffer is **CHECKSUM_BUFFER_SIZE** bytes (default 1MB).
+"""
+
+import hashlib
+import threading
+
+from django.conf import settings
+
+DEFAULT_ALGORITHMS = ('md5', 'sha1')
+
+_local = threading.local()
+
+
+def buffer_size():
+    return getattr(settings, 'CHECKSUM_BUFFER_SIZE', 1024 * 1024)
+
+
+def _buffer(size):
+    "Returns this thread's buffer of ``size`` bytes."
+    buf = getattr(_local, 'buffer', None)
+    if buf is None or len(buf) != size:
+        buf = _local.buffer = bytearray(size)
+    return buf
+
+
+def hash_file(path, algorithms=DEFAULT_ALGORITHMS, size=None, copy_to=None):
+    """
+    Reads ``path`` once and returns a dict of algorithm -> hex digest for
+    each of ``algorithms`` (any name :func:`hashlib.new` knows, like
+    'sha256') and the number of bytes read.
+
+    :param size: size of the read buffer, default **CHECKSUM_BUFFER_SIZE**
+    :param copy_to: open file, or anything with a ``write`` method, the bytes
+        are also written to, so a file can be copied and hashed in the same pass
+    """
+    buf = _buffer(size or buffer_size())
+    checksums = [(algorithm, hashlib.new(algorithm)) for algorithm in algorithms]
+    total = 0
+    with open(path, 'rb') as file_to_hash:
+        while True:
+            read = file_to_hash.readinto(buf)
+            if not read:
+                break
+            # A read-only buffer rather than a memoryview: it doesn't copy
+            # either, and zlib accepts it when the chunk is being zipped.
+            chunk = buffer(buf, 0, read)
+            for algorithm, checksum in checksums:
+                checksum.update(chunk)
+            if copy_to is not None:
+                copy_to.write(chunk)
+            total += read
+    return dict((algorithm, checksum.hexdigest()) for algorithm, checksum in checksums), total
+
+
+def hash_file_per_digest(path, algorithms=DEFAULT_ALGORITHMS):
+    """
+    The way files used to be hashed, one full read into memory per digest.
+    Only kept to compare against in the ``benchmark_digests`` command.
+    """
+    digests = {}
+    size = 0
+    for algorithm in algorithms:
+        with open(path, 'rb') as file_to_hash:
+            data = file_to_hash.read()
+        digests[algorithm] = hashlib.new(algorithm, data).hexdigest()
+        size += len(data)
+    return digests, size
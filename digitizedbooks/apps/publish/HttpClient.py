@@ -0,0 +1,82 @@
+"""
+Shared HTTP client for the calls to Alma, the catalog and HathiTrust.
+
+One pooled, keep-alive :class:`requests.Session` is kept per host so bulk runs
+reuse connections instead of paying for a new handshake on every request.
+Every request gets a timeout and failed connections are retried with backoff.
+
+Settings:
+
+* **HTTP_POOL_SIZE** connections kept open per host (default 10)
+* **HTTP_CONNECT_TIMEOUT** seconds to wait for a connection (default 10)
+* **HTTP_READ_TIMEOUT** seconds to wait for a response (default 60)
+* **HTTP_RETRIES** times a failed connection or read is retried (default 3)
+* **HTTP_BACKOFF** backoff factor between retries in seconds (default 0.5)
+"""
+
+import os
+import threading
+from urlparse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+from django.conf import settings
+
+_sessions = {}
+_sessions_pid = None
+_lock = threading.Lock()
+_calls = [0]
+
+
+def _new_session():
+    retry = Retry(
+        total=getattr(settings, 'HTTP_RETRIES', 3),
+        backoff_factor=getattr(settings, 'HTTP_BACKOFF', 0.5))
+    adapter = HTTPAdapter(
+        pool_connections=1,
+        pool_maxsize=getattr(settings, 'HTTP_POOL_SIZE', 10),
+        max_retries=retry)
+
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def session_for(url):
+    "Returns the session for the host of ``url``."
+    global _sessions_pid
+    host = urlparse(url).netloc
+    with _lock:
+        # Forked workers must not share the parent's sockets.
+        if _sessions_pid != os.getpid():
+            _sessions.clear()
+            _sessions_pid = os.getpid()
+        if host not in _sessions:
+            _sessions[host] = _new_session()
+        return _sessions[host]
+
+
+def call_count():
+    "Number of requests made by this process."
+    return _calls[0]
+
+
+def request(method, url, **kwargs):
+    "Same as :func:`requests.request` but pooled and with default timeouts."
+    with _lock:
+        _calls[0] += 1
+    kwargs.setdefault('timeout', (
+        getattr(settings, 'HTTP_CONNECT_TIMEOUT', 10),
+        getattr(settings, 'HTTP_READ_TIMEOUT', 60)))
+    return session_for(url).request(method, url, **kwargs)
+
+
+def get(url, **kwargs):
+    return request('GET', url, **kwargs)
+
+
+def put(url, **kwargs):
+    return request('PUT', url, **kwargs)
@@ -0,0 +1,174 @@
+"""
+Scanner for the directory defined by **KDIP_DIR**.
+
+Volume directories are the ones whose name starts with a digit. The scanner
+keeps an index of every volume it has seen (path, inode and mtime) grouped by
+the top level entry of **KDIP_DIR** they live under. On an incremental scan
+only the top level entries whose mtime or inode changed since the last scan
+are walked, the volumes of the others are taken from the index.
+
+.. Note::
+   A directory's mtime only changes when its direct children change. A volume
+   added two levels below a top level entry will not be seen by an incremental
+   scan until that entry is touched or a full scan is run.
+"""
+
+import json
+import logging
+import os
+import re
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+VOLUME_DIR = re.compile(r"^[0-9]")
+'Pattern for the names of volume directories'
+
+
+class ScanResult(object):
+    "Volumes found by a scan and how they differ from the previous scan."
+
+    def __init__(self, volumes, new, moved, removed):
+        self.volumes = volumes
+        'Every volume found, kdip_id -> path'
+        self.new = new
+        'Volumes that were not in the index, kdip_id -> path'
+        self.moved = moved
+        'Volumes whose path changed since the last scan, kdip_id -> path'
+        self.removed = removed
+        'Volumes in the index that are no longer on disk, kdip_id -> old path'
+        self.bad_kdips = []
+        'Volumes whose KDip could not be created or is invalid, set by :meth:`KDip.load`'
+
+    def __unicode__(self):
+        return u'%s volumes: %s new, %s moved, %s removed' % (
+            len(self.volumes), len(self.new), len(self.moved), len(self.removed))
+
+
+class KDipScanner(object):
+    "Finds the volume directories in **KDIP_DIR**."
+
+    def __init__(self, kdip_dir=None, index_file=None):
+        self.kdip_dir = kdip_dir or settings.KDIP_DIR
+        self.index_file = index_file or getattr(settings, 'KDIP_SCAN_INDEX', None) \
+            or os.path.join(self.kdip_dir, '.kdip_scan_index.json')
+        self.exclude = [os.path.join(self.kdip_dir, excluded) \
+            for excluded in ('HT', 'out_of_scope', 'test')]
+        self.skip = getattr(settings, 'SKIP_DIR', None)
+
+    def is_excluded(self, full_path):
+        "True if ``full_path`` is in, or under, a directory the loader ignores."
+        if self.skip and self.skip in full_path:
+            return True
+        for excluded in self.exclude:
+            if full_path == excluded or full_path.startswith(excluded + os.sep):
+                return True
+        return False
+
+    def volume_for(self, full_path, is_dir=True):
+        """
+        Returns ``(kdip_id, path)`` of the volume ``full_path`` belongs to or
+        ``None`` if it is not part of a volume the loader would pick up.
+        """
+        relative = os.path.relpath(full_path, self.kdip_dir)
+        if relative.startswith(os.pardir) or self.is_excluded(full_path):
+            return None
+        names = relative.split(os.sep)
+        if not is_dir:
+            names = names[:-1]
+        path = self.kdip_dir
+        for name in names:
+            if VOLUME_DIR.search(name):
+                return name, path
+            path = os.path.join(path, name)
+        return None
+
+    def load_index(self):
+        try:
+            with open(self.index_file) as index:
+                return json.load(index)
+        except (IOError, ValueError):
+            return {}
+
+    def save_index(self, index):
+        tmp_file = '%s.tmp' % self.index_file
+        try:
+            with open(tmp_file, 'w') as tmp:
+                json.dump(index, tmp)
+            os.rename(tmp_file, self.index_file)
+        except (IOError, OSError) as error:
+            logger.warning('Could not save the scan index %s: %s' % (self.index_file, error))
+
+    def _entry(self, full_path, **extra):
+        stat = os.stat(full_path)
+        entry = {'inode': stat.st_ino, 'mtime': stat.st_mtime}
+        entry.update(extra)
+        return entry
+
+    def _walk(self, top):
+        "Find the volumes under ``top`` without descending into the volumes themselves."
+        volumes = {}
+        for path, subdirs, files in os.walk(top):
+            batches = []
+            for name in subdirs:
+                full_path = os.path.join(path, name)
+                if self.is_excluded(full_path):
+                    continue
+                if VOLUME_DIR.search(name):
+                    volumes[name] = self._entry(full_path, path=path)
+                else:
+                    batches.append(name)
+            subdirs[:] = batches
+        return volumes
+
+    def scan(self, incremental=True):
+        """
+        Scan **KDIP_DIR** and save the updated index.
+
+        :param incremental: only walk top level entries that changed since
+            the last scan. A full scan walks everything.
+        :rtype: :class:`ScanResult`
+        """
+        old_entries = self.load_index().get('entries', {})
+        entries = {}
+
+        for name in os.listdir(self.kdip_dir):
+            full_path = os.path.join(self.kdip_dir, name)
+            if not os.path.isdir(full_path) or self.is_excluded(full_path):
+                continue
+
+            entry = self._entry(full_path)
+            old_entry = old_entries.get(name)
+
+            if VOLUME_DIR.search(name):
+                entry['volumes'] = {name: dict(entry, path=self.kdip_dir)}
+            elif incremental and old_entry \
+                    and old_entry['inode'] == entry['inode'] \
+                    and old_entry['mtime'] == entry['mtime']:
+                entry['volumes'] = old_entry['volumes']
+            else:
+                entry['volumes'] = self._walk(full_path)
+            entries[name] = entry
+
+        old_volumes = {}
+        for entry in old_entries.values():
+            old_volumes.update(entry['volumes'])
+
+        volumes = {}
+        for entry in entries.values():
+            for kdip_id, volume in entry['volumes'].items():
+                if kdip_id in volumes:
+                    logger.warning('%s found in both %s and %s' % \
+                        (kdip_id, volumes[kdip_id], volume['path']))
+                volumes[kdip_id] = volume['path']
+
+        new = dict((kdip_id, path) for kdip_id, path in volumes.items() \
+            if kdip_id not in old_volumes)
+        moved = dict((kdip_id, path) for kdip_id, path in volumes.items() \
+            if kdip_id in old_volumes and old_volumes[kdip_id]['path'] != path)
+        removed = dict((kdip_id, volume['path']) for kdip_id, volume in old_volumes.items() \
+            if kdip_id not in volumes)
+
+        self.save_index({'entries': entries})
+        return ScanResult(volumes, new, moved, removed)
@@ -0,0 +1,114 @@
+"""
+Streaming reader for the METS files of KDips.
+
+A METS file for a volume of a thousand pages is tens of MB, most of it
+technical metadata. :func:`read_mets` goes through it with
+:func:`lxml.etree.iterparse`, keeps the few values validation needs in a
+small index and throws each element away as soon as it has been read, so
+memory stays flat however big the volume is.
+"""
+
+from collections import namedtuple, OrderedDict
+
+from lxml import etree
+
+METS_NS = 'http://www.loc.gov/METS/'
+MIX_NS = 'http://www.loc.gov/mix/v20'
+XLINK_NS = 'http://www.w3.org/1999/xlink'
+
+TECHMD_IDS = ('AMD_TECHMD_TIF', 'AMD_TECHMD_JPG', 'AMD_TECHMD_JP2')
+'Prefixes of the IDs of the techMD sections for image files'
+
+TECHMD = '{%s}techMD' % METS_NS
+FILE = '{%s}file' % METS_NS
+
+MIX_INFO = 'mets:mdWrap/mets:xmlData/mix:mix/mix:BasicDigitalObjectInformation/'
+NAMESPACES = {'mets': METS_NS, 'mix': MIX_NS, 'xlink': XLINK_NS}
+
+MetsEntry = namedtuple('MetsEntry', 'size checksum mimetype')
+'What the METS says about one file'
+
+
+class MetsIndex(object):
+    "The files listed in a METS file."
+
+    def __init__(self):
+        self.techmd = OrderedDict()
+        'Image files from the techMD sections, href -> :class:`MetsEntry`'
+        self.files = OrderedDict()
+        'Files from the fileSec, href -> :class:`MetsEntry`'
+        self.groups = {}
+        'fileGrp ID -> list of the hrefs in that group'
+        self.valid = None
+        'True or False if the file was validated against a schema, otherwise None'
+
+
+def _int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _read(path, schema=None):
+    index = MetsIndex()
+    # Elements are cleared once read, except inside the techMD or file that
+    # is being read.
+    reading = None
+    for event, element in etree.iterparse(path, events=('start', 'end'), schema=schema):
+        if event == 'start':
+            if reading is None and element.tag in (TECHMD, FILE):
+                reading = element
+            continue
+        if reading is not None and element is not reading:
+            continue
+        reading = None
+
+        if element.tag == TECHMD:
+            if element.get('ID', '').startswith(TECHMD_IDS):
+                href = element.findtext(MIX_INFO + 'mix:ObjectIdentifier/mix:objectIdentifierValue',
+                    namespaces=NAMESPACES)
+                if href is not None:
+                    index.techmd[href] = MetsEntry(
+                        _int(element.findtext(MIX_INFO + 'mix:fileSize', namespaces=NAMESPACES)),
+                        element.findtext(MIX_INFO + 'mix:Fixity/mix:messageDigest', namespaces=NAMESPACES),
+                        element.findtext(MIX_INFO + 'mix:FormatDesignation/mix:formatName',
+                            namespaces=NAMESPACES))
+
+        elif element.tag == FILE:
+            location = element.find('mets:FLocat', namespaces=NAMESPACES)
+            if location is not None:
+                href = location.get('{%s}href' % XLINK_NS)
+                index.files[href] = MetsEntry(_int(element.get('SIZE')),
+                    element.get('CHECKSUM'), element.get('MIMETYPE'))
+                group = element.getparent().get('ID')
+                index.groups.setdefault(group, []).append(href)
+
+        element.clear()
+        # The root has no parent, but it can follow comments.
+        parent = element.getparent()
+        if parent is not None:
+            while element.getprevious() is not None:
+                del parent[0]
+
+    return index
+
+
+def read_mets(path, schema=None):
+    """
+    Reads the METS file at ``path`` into a :class:`MetsIndex`.
+
+    :param schema: :class:`lxml.etree.XMLSchema` to validate the file against
+        while it is read. If the file is not valid it is read again without
+        the schema and ``valid`` is set to False.
+    :raises lxml.etree.XMLSyntaxError: if the file is not well formed
+    """
+    if schema is None:
+        return _read(path)
+    try:
+        index = _read(path, schema)
+        index.valid = True
+    except etree.XMLSyntaxError:
+        index = _read(path)
+        index.valid = False
+    return index
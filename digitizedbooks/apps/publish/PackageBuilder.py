@@ -0,0 +1,243 @@
+"""
+Builds the zip packages sent to HathiTrust straight from a volume's files.
+
+HathiTrust wants every file of a volume at the top of the zip, with a
+``checksum.md5`` listing their md5s. Instead of copying the files to a
+staging directory, checksumming the copies and zipping the directory,
+:class:`PackageBuilder` reads each file once: the chunks read by
+:func:`Hashing.hash_file` are hashed and compressed into the zip at the same
+time, so ``checksum.md5`` is written from the digests of the bytes that are
+actually in the package.
+
+How much each file is compressed depends on its extension,
+**HT_PACKAGE_COMPRESSION** is a dict of extension -> zlib level, 0 stores the
+file as is and '*' is used for extensions that are not in the dict. The G4
+and LZW Tiffs barely get smaller, so by default they are stored and only the
+text files are deflated, see :data:`DEFAULT_COMPRESSION`.
+
+A package can also be written to something that can't seek, like an upload
+(see :meth:`BoxUpload.ChunkedUpload.stream`), then the CRC and sizes of each
+file follow its data instead of being written back in its header.
+:meth:`PackageBuilder.measure` gives the exact size of such a package
+without reading the stored files.
+"""
+
+import os
+import struct
+import time
+import zipfile
+import zlib
+
+from django.conf import settings
+
+import Hashing
+
+DEFAULT_COMPRESSION = {
+    '.tif': 0,
+    '.tiff': 0,
+    '.jp2': 0,
+    '*': 6,
+}
+'Compression levels by extension used when **HT_PACKAGE_COMPRESSION** is not set'
+
+
+def file_type(name):
+    "Lower case extension of ``name``, used to look up its compression level."
+    return os.path.splitext(name)[1].lower()
+
+
+def package_name(path):
+    "Name of ``path`` in the package, ALTO files lose the '.alto' in their name."
+    name = os.path.basename(path)
+    if name.endswith('.alto.xml'):
+        name = name[:-len('.alto.xml')] + '.xml'
+    return name
+
+
+class _EntryWriter(object):
+    "Compresses the bytes written to it into the zip, keeping their CRC and sizes."
+
+    def __init__(self, fp, level):
+        self.fp = fp
+        self.crc = 0
+        self.file_size = 0
+        self.compress_size = 0
+        self.compressor = None
+        if level:
+            self.compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+
+    def write(self, data):
+        self.file_size += len(data)
+        self.crc = zlib.crc32(data, self.crc) & 0xffffffff
+        if self.compressor is not None:
+            data = self.compressor.compress(data)
+        self.compress_size += len(data)
+        self.fp.write(data)
+
+    def close(self):
+        if self.compressor is not None:
+            data = self.compressor.flush()
+            self.compress_size += len(data)
+            self.fp.write(data)
+
+
+class _SizeCounter(object):
+    "Stands in for the file a package is written to, only counting the bytes."
+
+    def __init__(self):
+        self.position = 0
+
+    def write(self, data):
+        self.position += len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+
+class PackageBuilder(zipfile.ZipFile):
+    """
+    A zip file that files are added to with :meth:`write_file`, which keeps
+    their md5s for :meth:`write_checksums`. ::
+
+        with PackageBuilder('volume.zip') as package:
+            for path in files:
+                package.write_file(path)
+            package.write_checksums()
+
+    :param path: path of the zip file, or an object with ``write`` and
+        ``tell`` methods to stream the package to
+    :param compression: dict of extension -> zlib level like
+        :data:`DEFAULT_COMPRESSION`, default **HT_PACKAGE_COMPRESSION**
+    """
+
+    def __init__(self, path, compression=None):
+        zipfile.ZipFile.__init__(self, path, 'w', zipfile.ZIP_DEFLATED, allowZip64=True)
+        self.streaming = not hasattr(self.fp, 'seek')
+        self._measuring = isinstance(self.fp, _SizeCounter)
+        if compression is None:
+            compression = getattr(settings, 'HT_PACKAGE_COMPRESSION', DEFAULT_COMPRESSION)
+        self.levels = dict((extension.lower(), level) for extension, level in compression.items())
+        self.checksums = []
+        'List of (name in the package, md5) of the files written'
+        self.bytes_read = 0
+        self.newest = None
+        'Latest modification time of the files written'
+        self.report = {}
+        'File type -> dict of the files, bytes in, bytes out and seconds spent on them'
+
+    @classmethod
+    def measure(cls, paths, compression=None):
+        '''
+        Size of the package of ``paths`` when it is streamed. Only the files
+        that are compressed are read, stored files count for their size.
+        '''
+        counter = _SizeCounter()
+        with cls(counter, compression) as package:
+            for path in paths:
+                package.write_file(path)
+            package.write_checksums()
+        return counter.position
+
+    def level(self, arcname):
+        "The zlib level ``arcname`` is compressed with, 0 if it is stored."
+        return self.levels.get(file_type(arcname), self.levels.get('*', zlib.Z_DEFAULT_COMPRESSION))
+
+    def _count(self, arcname, bytes_in, bytes_out, seconds):
+        totals = self.report.setdefault(file_type(arcname) or arcname,
+            {'files': 0, 'bytes_in': 0, 'bytes_out': 0, 'seconds': 0.0})
+        totals['files'] += 1
+        totals['bytes_in'] += bytes_in
+        totals['bytes_out'] += bytes_out
+        totals['seconds'] += seconds
+
+    def summary(self):
+        "One line per file type with the bytes in and out and the seconds spent."
+        return ['%s: %s files, %s bytes in, %s out (%.0f%%), %.2f seconds' % (name,
+            totals['files'], totals['bytes_in'], totals['bytes_out'],
+            100.0 * totals['bytes_out'] / (totals['bytes_in'] or 1), totals['seconds']) \
+            for name, totals in sorted(self.report.items())]
+
+    def write_file(self, path, arcname=None, level=None):
+        '''
+        Adds the file at ``path`` as ``arcname``, by default
+        :func:`package_name`, compressed at ``level`` or the level for its
+        type. The file is read once, the digests of what was read are
+        returned as a dict of algorithm -> hex digest, like
+        :func:`Hashing.hash_file`.
+        '''
+        # Like ZipFile.write, except the bytes go through Hashing.hash_file.
+        start = time.time()
+        if arcname is None:
+            arcname = package_name(path)
+        if level is None:
+            level = self.level(arcname)
+        st = os.stat(path)
+        self.newest = max(self.newest, st.st_mtime)
+        zinfo = zipfile.ZipInfo(arcname, time.localtime(st.st_mtime)[0:6])
+        zinfo.external_attr = (st.st_mode & 0xFFFF) << 16L
+        zinfo.compress_type = zipfile.ZIP_DEFLATED if level else zipfile.ZIP_STORED
+        zinfo.file_size = st.st_size
+        # Without seeking, the CRC and sizes go in a data descriptor after
+        # the file's data.
+        zinfo.flag_bits = 0x08 if self.streaming else 0x00
+        zinfo.header_offset = self.fp.tell()
+        self._writecheck(zinfo)
+        self._didModify = True
+
+        # The header is written again once the CRC and sizes are known.
+        zinfo.CRC = 0
+        zinfo.compress_size = 0
+        zip64 = zinfo.file_size * 1.05 > zipfile.ZIP64_LIMIT
+        self.fp.write(zinfo.FileHeader(zip64))
+        entry = _EntryWriter(self.fp, level)
+        if self._measuring and not level:
+            self.fp.position += st.st_size
+            entry.file_size = entry.compress_size = size = st.st_size
+            digests = {'md5': '0' * 32}
+        else:
+            digests, size = Hashing.hash_file(path, copy_to=entry)
+        entry.close()
+        zinfo.CRC = entry.crc
+        zinfo.file_size = entry.file_size
+        zinfo.compress_size = entry.compress_size
+        if not zip64 and max(zinfo.file_size, zinfo.compress_size) > zipfile.ZIP64_LIMIT:
+            raise RuntimeError('%s grew while it was added to the package' % path)
+
+        if self.streaming:
+            self.fp.write(struct.pack('<4sLQQ' if zip64 else '<4sLLL', 'PK\x07\x08',
+                zinfo.CRC, zinfo.compress_size, zinfo.file_size))
+        else:
+            position = self.fp.tell()
+            self.fp.seek(zinfo.header_offset, 0)
+            self.fp.write(zinfo.FileHeader(zip64))
+            self.fp.seek(position, 0)
+        self.filelist.append(zinfo)
+        self.NameToInfo[zinfo.filename] = zinfo
+
+        self.checksums.append((arcname, digests['md5']))
+        self.bytes_read += size
+        self._count(arcname, size, zinfo.compress_size, time.time() - start)
+        return digests
+
+    def write_checksums(self, arcname='checksum.md5'):
+        '''
+        Adds the list of the md5s of the files written so far. It is stored
+        when streaming, so its size does not depend on the md5s. It is dated
+        like the newest file rather than now, so the same files always make
+        the same package and an upload of it can be resumed.
+        '''
+        start = time.time()
+        checksums = ''.join('%s %s\n' % (md5, name) for name, md5 in self.checksums)
+        # Paths read from the database are unicode, only bytes can be streamed.
+        if isinstance(checksums, unicode):
+            checksums = checksums.encode('utf-8')
+        zinfo = zipfile.ZipInfo(arcname,
+            time.localtime(self.newest)[0:6] if self.newest is not None else (1980, 1, 1, 0, 0, 0))
+        zinfo.external_attr = 0600 << 16
+        zinfo.compress_type = zipfile.ZIP_DEFLATED if self.level(arcname) and not self.streaming \
+            else zipfile.ZIP_STORED
+        self.writestr(zinfo, checksums)
+        self._count(arcname, len(checksums), self.getinfo(arcname).compress_size, time.time() - start)
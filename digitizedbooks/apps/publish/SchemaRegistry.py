@@ -0,0 +1,123 @@
+"""
+Local copies of the XSD schemas used to validate METS and ALTO files.
+
+Schemas are kept in **SCHEMA_DIR** (default the ``schemas`` directory next
+to this module), mirroring their URLs: the schema at
+``http://www.loc.gov/standards/mets/version191/mets.xsd`` is stored as
+``www.loc.gov/standards/mets/version191/mets.xsd``. When a schema is
+compiled, it and every schema it imports or includes are read from the local
+copies, so validating does not need the network. Each schema is only
+compiled once per process.
+
+The schema files are not in the repository. Run ``manage.py refresh_schemas``
+to download them, and again to pick up new versions. A schema that has not
+been downloaded is loaded from the network, with a warning, every time it is
+compiled.
+"""
+
+import logging
+import os
+import threading
+from urlparse import urljoin, urlparse
+
+from lxml import etree
+
+from django.conf import settings
+
+import HttpClient
+
+logger = logging.getLogger(__name__)
+
+XSD_NAMESPACE = 'http://www.w3.org/2001/XMLSchema'
+
+_schemas = {}
+_lock = threading.Lock()
+
+
+def schema_dir():
+    return getattr(settings, 'SCHEMA_DIR', None) \
+        or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'schemas')
+
+
+def local_path(url, directory=None):
+    "Path of the vendored copy of the schema at ``url``."
+    parsed = urlparse(url)
+    return os.path.join(directory or schema_dir(), parsed.netloc, *parsed.path.strip('/').split('/'))
+
+
+class LocalResolver(etree.Resolver):
+    "Resolves schema URLs to their vendored copies."
+
+    def resolve(self, url, pubid, context):
+        path = local_path(url)
+        if os.path.exists(path):
+            return self.resolve_filename(path, context)
+        if urlparse(url).scheme in ('http', 'https'):
+            logger.warning('No local copy of %s, loading it from the network' % url)
+        return None
+
+
+def get_schema(url):
+    """
+    Returns the compiled :class:`lxml.etree.XMLSchema` for ``url``. It is
+    compiled the first time it is asked for and reused after that.
+    """
+    with _lock:
+        if url not in _schemas:
+            parser = etree.XMLParser()
+            parser.resolvers.add(LocalResolver())
+            path = local_path(url)
+            if not os.path.exists(path):
+                logger.warning('No local copy of %s, loading it from the network' % url)
+                path = url
+            logger.info('Compiling schema %s' % url)
+            _schemas[url] = etree.XMLSchema(etree.parse(path, parser))
+        return _schemas[url]
+
+
+def clear():
+    "Forget the compiled schemas."
+    with _lock:
+        _schemas.clear()
+
+
+def refresh(urls, directory=None):
+    """
+    Downloads the schemas at ``urls`` and every schema they import, include or
+    redefine into ``directory`` (default **SCHEMA_DIR**).
+    Returns the URLs that were downloaded.
+    """
+    pending = list(urls)
+    seen = set(pending)
+    downloaded = []
+
+    while pending:
+        url = pending.pop(0)
+        response = HttpClient.get(url)
+        response.raise_for_status()
+
+        # Make sure it is a schema before writing over the old copy.
+        schema = etree.fromstring(response.content)
+
+        path = local_path(url, directory)
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        tmp_file = '%s.tmp' % path
+        with open(tmp_file, 'wb') as local:
+            local.write(response.content)
+        os.rename(tmp_file, path)
+        downloaded.append(url)
+        logger.info('Saved %s to %s' % (url, path))
+
+        for tag in ('import', 'include', 'redefine'):
+            for ref in schema.iter('{%s}%s' % (XSD_NAMESPACE, tag)):
+                location = ref.get('schemaLocation')
+                if location:
+                    location = urljoin(url, location)
+                    if location not in seen:
+                        seen.add(location)
+                        pending.append(location)
+
+    with _lock:
+        _schemas.clear()
+    return downloaded
@@ -0,0 +1,106 @@
+"""
+Reads the tags of a TIFF's first image file directory (IFD) straight from
+the file, without PIL. Only the header, the IFD and the values of the
+requested tags that don't fit in the IFD are read, a few small seeks per file.
+Handles little and big endian files and BigTIFF.
+"""
+
+import struct
+
+# Field type -> (struct format of one value, size in bytes)
+FIELD_TYPES = {
+    1: ('B', 1),    # BYTE
+    2: ('s', 1),    # ASCII
+    3: ('H', 2),    # SHORT
+    4: ('L', 4),    # LONG
+    5: ('LL', 8),   # RATIONAL
+    6: ('b', 1),    # SBYTE
+    7: ('B', 1),    # UNDEFINED
+    8: ('h', 2),    # SSHORT
+    9: ('l', 4),    # SLONG
+    10: ('ll', 8),  # SRATIONAL
+    11: ('f', 4),   # FLOAT
+    12: ('d', 8),   # DOUBLE
+    16: ('Q', 8),   # LONG8
+    17: ('q', 8),   # SLONG8
+    18: ('Q', 8),   # IFD8
+}
+
+
+class TiffHeaderError(Exception):
+    "Raised when a file does not have a TIFF header that can be read."
+    pass
+
+
+def read_tags(path, tags=None):
+    """
+    Returns a dict of tag number -> value for the first IFD of the TIFF at
+    ``path``. Values look like the ones from PIL's ``Image.tag``: a string
+    for ASCII, a tuple of (numerator, denominator) pairs for rationals and a
+    tuple of numbers for everything else.
+
+    :param tags: only read these tag numbers, all tags if ``None``
+    """
+    with open(path, 'rb') as tiff:
+        header = tiff.read(16)
+        if header[:2] == b'II':
+            endian = '<'
+        elif header[:2] == b'MM':
+            endian = '>'
+        else:
+            raise TiffHeaderError('%s is not a TIFF' % path)
+
+        magic = struct.unpack(endian + 'H', header[2:4])[0]
+        if magic == 42:
+            offset = struct.unpack(endian + 'L', header[4:8])[0]
+            count_format, entry_format, offset_format = 'H', 'HHL4s', 'L'
+        elif magic == 43 and len(header) == 16:
+            offset_size, reserved, offset = struct.unpack(endian + 'HHQ', header[4:16])
+            if offset_size != 8:
+                raise TiffHeaderError('%s has an unsupported BigTIFF offset size' % path)
+            count_format, entry_format, offset_format = 'Q', 'HHQ8s', 'Q'
+        else:
+            raise TiffHeaderError('%s is not a TIFF' % path)
+
+        inline_size = struct.calcsize(endian + offset_format)
+        entry_size = struct.calcsize(endian + entry_format)
+
+        tiff.seek(offset)
+        count_data = tiff.read(struct.calcsize(endian + count_format))
+        if len(count_data) != struct.calcsize(endian + count_format):
+            raise TiffHeaderError('%s is truncated' % path)
+        count = struct.unpack(endian + count_format, count_data)[0]
+        entries = tiff.read(count * entry_size)
+        if len(entries) != count * entry_size:
+            raise TiffHeaderError('%s is truncated' % path)
+
+        found = {}
+        for start in range(0, len(entries), entry_size):
+            tag, field_type, value_count, value = struct.unpack(
+                endian + entry_format, entries[start:start + entry_size])
+            if (tags is not None and tag not in tags) or field_type not in FIELD_TYPES:
+                continue
+
+            value_format, value_size = FIELD_TYPES[field_type]
+            length = value_size * value_count
+            if length <= inline_size:
+                data = value[:length]
+            else:
+                tiff.seek(struct.unpack(endian + offset_format, value)[0])
+                data = tiff.read(length)
+                if len(data) != length:
+                    raise TiffHeaderError('%s is truncated' % path)
+
+            found[tag] = _decode(endian, field_type, value_format, value_count, data)
+
+        return found
+
+
+def _decode(endian, field_type, value_format, value_count, data):
+    if field_type == 2:
+        return data.split(b'\0', 1)[0]
+    values = struct.unpack('%s%d%s' % (endian, value_count * len(value_format), value_format[0]), data)
+    if len(value_format) == 2:
+        # Rationals are pairs of numerator and denominator.
+        return tuple(zip(values[::2], values[1::2]))
+    return values
@@ -0,0 +1,52 @@
+"""
+Records how long each stage of validating or loading a volume takes, how
+many bytes it read and how many HTTP requests it made.
+"""
+
+import time
+
+import HttpClient
+
+
+class StageTimer(object):
+    """
+    Call :meth:`stage` when a stage starts, it ends the stage before it.
+    Call :meth:`finish` after the last stage.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.stages = []
+        self.current = None
+        self._start = None
+        self._calls = None
+
+    def stage(self, name):
+        self.finish()
+        self.current = {'name': name, 'seconds': 0, 'bytes': 0, 'calls': 0}
+        self._start = time.time()
+        self._calls = HttpClient.call_count()
+
+    def add_bytes(self, count):
+        "Count ``count`` bytes as read by the current stage."
+        if self.current is not None:
+            self.current['bytes'] += count
+
+    def finish(self):
+        if self.current is None:
+            return
+        self.current['seconds'] = round(time.time() - self._start, 3)
+        self.current['calls'] += HttpClient.call_count() - self._calls
+        self.stages.append(self.current)
+        self.current = None
+
+    @property
+    def seconds(self):
+        return round(time.time() - self.started, 3)
+
+    def total(self, key):
+        "Sum of ``key`` ('seconds', 'bytes' or 'calls') over the finished stages."
+        return sum(stage[key] for stage in self.stages)
+
+    def summary(self):
+        return ', '.join('%(name)s %(seconds).1fs' % stage for stage in self.stages)
@@ -0,0 +1,150 @@
+"""
+Packages the next volumes of a job while the current one uploads.
+
+Building a package keeps the CPU and the disk busy, uploading it keeps the
+network busy. :class:`PipelinedUploader` packages volumes in a background
+thread, up to **HT_UPLOAD_LOOKAHEAD** (default 2) packages ahead of the
+upload running in the calling thread. It stops getting further ahead when
+the next package would not fit in the free space of the package directory.
+Afterwards it reports how much of the packaging was hidden behind uploads.
+"""
+
+from collections import deque
+import logging
+import os
+import threading
+import time
+
+from django.conf import settings
+from django.db import connection
+
+logger = logging.getLogger(__name__)
+
+
+def free_space(path):
+    "Bytes available to a normal user on the file system of ``path``, or of its closest existing parent."
+    while not os.path.exists(path) and os.path.dirname(path) != path:
+        path = os.path.dirname(path)
+    stat = os.statvfs(path)
+    return stat.f_bavail * stat.f_frsize
+
+
+class PipelinedUploader(object):
+    """
+    Calls ``package(item)`` in a background thread and ``upload(item)`` in
+    the calling thread for every item, each item being uploaded once it has
+    been packaged. Exceptions raised by ``package`` are logged and the item is
+    still uploaded, ``upload`` is expected to handle a missing package.
+
+    :param lookahead: most packages waiting to be uploaded, default
+        **HT_UPLOAD_LOOKAHEAD**
+    :param directory: where the packages are written, when it is given the
+        next item is only packaged ahead if ``size(item)`` bytes are free there
+    :param size: function that estimates the size of an item's package
+    """
+
+    def __init__(self, package, upload, lookahead=None, directory=None, size=None):
+        self.package = package
+        self.upload = upload
+        self.lookahead = lookahead or getattr(settings, 'HT_UPLOAD_LOOKAHEAD', 2)
+        self.directory = directory
+        self.size = size
+        self.package_seconds = 0.0
+        self.upload_seconds = 0.0
+        'Time spent packaging and uploading'
+        self.wait_seconds = 0.0
+        'Time uploads spent waiting for a package'
+        self.seconds = 0.0
+        self.most_ahead = 0
+        'Most packages that were waiting to be uploaded at once'
+        self.space_waits = 0
+        'Times packaging waited for free space'
+
+    def _room_for(self, item):
+        if self.directory is None or self.size is None:
+            return True
+        return free_space(self.directory) >= self.size(item)
+
+    def _packager(self, items):
+        try:
+            for item in items:
+                with self._changed:
+                    # Never wait when nothing is waiting to be uploaded, uploads
+                    # don't free any space.
+                    waited = False
+                    while not self._stopped and self._ready and \
+                            (len(self._ready) >= self.lookahead or not self._room_for(item)):
+                        if not waited and len(self._ready) < self.lookahead:
+                            self.space_waits += 1
+                        waited = True
+                        # Timed, so the free space is checked again.
+                        self._changed.wait(1)
+                    if self._stopped:
+                        return
+
+                start = time.time()
+                try:
+                    self.package(item)
+                except Exception:
+                    logger.exception('Packaging %s failed' % (item,))
+                self.package_seconds += time.time() - start
+
+                with self._changed:
+                    self._ready.append(item)
+                    self.most_ahead = max(self.most_ahead, len(self._ready))
+                    self._changed.notify_all()
+        finally:
+            with self._changed:
+                self._packaged_all = True
+                self._changed.notify_all()
+            # Django opens a database connection for each thread.
+            connection.close()
+
+    def run(self, items):
+        "Packages and uploads ``items``, returns the number of items uploaded."
+        items = list(items)
+        self._ready = deque()
+        self._changed = threading.Condition()
+        self._stopped = False
+        self._packaged_all = False
+        start = time.time()
+
+        packager = threading.Thread(target=self._packager, args=(items,), name='packager')
+        packager.daemon = True
+        packager.start()
+        uploaded = 0
+        try:
+            while True:
+                with self._changed:
+                    wait_start = time.time()
+                    while not self._ready and not self._packaged_all:
+                        self._changed.wait()
+                    self.wait_seconds += time.time() - wait_start
+                    if not self._ready:
+                        break
+                    item = self._ready.popleft()
+                    self._changed.notify_all()
+
+                upload_start = time.time()
+                self.upload(item)
+                self.upload_seconds += time.time() - upload_start
+                uploaded += 1
+        finally:
+            with self._changed:
+                self._stopped = True
+                self._changed.notify_all()
+            packager.join()
+            self.seconds = time.time() - start
+        return uploaded
+
+    @property
+    def overlap_seconds(self):
+        "Time spent packaging and uploading at the same time."
+        return max(0.0, self.package_seconds + self.upload_seconds - self.seconds)
+
+    def summary(self):
+        return '%.1fs packaging, %.1fs uploading, %.1fs waiting for packages, %.1fs in total, ' \
+            '%.1fs (%.0f%%) of packaging overlapped uploads, up to %s packages ahead, ' \
+            '%s waits for free space' % (self.package_seconds, self.upload_seconds,
+            self.wait_seconds, self.seconds, self.overlap_seconds,
+            100 * self.overlap_seconds / (self.package_seconds or 1), self.most_ahead, self.space_waits)
@@ -4,14 +4,22 @@ A handful of utility methods for various actions.
 
 import re
 import yaml
-import requests
+import logging
+from copy import deepcopy
+import os
 from eulxml.xmlmap import load_xmlobject_from_string, load_xmlobject_from_file
 from os import listdir, remove
 from datetime import datetime
-from PIL import Image
+from multiprocessing.pool import ThreadPool
 from django.conf import settings
 
 import models
+import HttpClient
+import Hashing
+from ValidateTiff import ValidateTiff
+from BibCache import BibCache
+
+logger = logging.getLogger(__name__)
 
 def date_to_int(date):
     try:
@@ -85,6 +93,23 @@ def get_rights(date, tag_583x):
     else:
         return None
 
+def digest_file(path, algorithms=Hashing.DEFAULT_ALGORITHMS, buffer_size=None):
+    """
+    Method to get the digests of a file without reading the whole thing into
+    memory. The file is read once and every digest in `algorithms` is updated
+    with each chunk, see :func:`Hashing.hash_file`.
+    Returns a dict of algorithm -> hex digest and the number of bytes read.
+    """
+    return Hashing.hash_file(path, algorithms, buffer_size)
+
+def md5_file(path, buffer_size=None):
+    """
+    Method to get the md5 of a file without reading the whole thing into
+    memory. Returns the hex digest and the number of bytes read.
+    """
+    digests, size = digest_file(path, ('md5',), buffer_size)
+    return digests['md5'], size
+
 def update_999a(path, kdip_id, enumcron):
     """
     Method to updae the 999a MARC field if/when it is changed
@@ -138,23 +163,36 @@ alma = Utils.load_alma_bib_record(k)
 
     return oclc_tags
 
+def fetch_bib_record(barcode, **kwargs):
+    """
+    Method to fetch the MARC XML for a barcode from Alma
+    http://discovere.emory.edu:8991/cgi-bin/get_alma_record?item_id=010002483050
+    Keyword arguments, like `timeout`, are passed to the request.
+    """
+    get_bib_rec = HttpClient.get( \
+        'https://kleene.library.emory.edu/cgi-bin/get_alma_record?item_id=', \
+        params={'item_id': barcode}, **kwargs)
+
+    return get_bib_rec.text.encode('utf-8')
+
+def parse_bib_record(bib_xml):
+    return load_xmlobject_from_string(bib_xml, models.Marc)
+
+bib_cache = BibCache(fetch_bib_record, parse_bib_record)
+
 def load_bib_record(kdip):
     """
     Method to load MARC XML from Am
-    http://discovere.emory.edu:8991/cgi-bin/get_alma_record?item_id=010002483050
     Method accepts a KDip object of a barcode as a string.
+    Records come from `bib_cache` so the same record is not fetched over and
+    over. The returned record is shared, copy it before changing it.
     """
     if isinstance(kdip, basestring):
-        barcode = kdip
+        barcode = kdip[:12]
     else:
-        barcode = kdip.kdip_id
+        barcode = kdip.barcode
 
-    get_bib_rec = requests.get( \
-        'https://kleene.library.emory.edu/cgi-bin/get_alma_record?item_id=', \
-        params={'item_id': barcode})
-
-    return load_xmlobject_from_string( \
-        get_bib_rec.text.encode('utf-8'), models.Marc)
+    return bib_cache.get(barcode)
 
 def load_alma_bib_record(kdip):
     """
@@ -163,7 +201,7 @@ def load_alma_bib_record(kdip):
     if isinstance(kdip, basestring):
         kdip = models.KDip.objects.get(kdip_id=kdip)
 
-    item = requests.get('%sitems' % settings.ALMA_API_ROOT,
+    item = HttpClient.get('%sitems' % settings.ALMA_API_ROOT,
         params={
             'item_barcode': kdip.kdip_id,
             'apikey': settings.ALMA_APIKEY
@@ -176,7 +214,7 @@ def load_alma_bib_record(kdip):
     kdip.mms_id = item_obj.mms_id
     kdip.save()
 
-    bib = requests.get('%sbibs/%s' % (settings.ALMA_API_ROOT, kdip.mms_id),
+    bib = HttpClient.get('%sbibs/%s' % (settings.ALMA_API_ROOT, kdip.mms_id),
         params={'apikey': settings.ALMA_APIKEY}
     )
 
@@ -184,6 +222,39 @@ def load_alma_bib_record(kdip):
 
     return load_xmlobject_from_string(bib_xml, models.AlmaBibRecord)
 
+def fetch_bib_records(barcodes, concurrency=None, timeout=None):
+    """
+    Method to fetch and parse the bib records for many barcodes at once.
+    At most `concurrency` (**BIB_FETCH_CONCURRENCY**, default 8) requests
+    run at the same time and each one gives up after `timeout` seconds.
+    The records end up in `bib_cache`, hold `bib_cache.room_for` the batch
+    to keep them all until they are used.
+
+    Returns a dict of barcode -> Marc. Barcodes that could not be fetched are
+    left out and will be fetched again when they are needed.
+    """
+    barcodes = list(set(barcode[:12] for barcode in barcodes))
+    if not barcodes:
+        return {}
+    concurrency = concurrency or getattr(settings, 'BIB_FETCH_CONCURRENCY', 8)
+    fetch_kwargs = {'timeout': timeout} if timeout else {}
+
+    def fetch(barcode):
+        try:
+            return barcode, bib_cache.get(barcode, **fetch_kwargs)
+        except Exception as e:
+            logger.error('Could not fetch bib record for %s: %s' % (barcode, e))
+            return barcode, None
+
+    pool = ThreadPool(min(concurrency, len(barcodes)))
+    try:
+        results = pool.map(fetch, barcodes)
+    finally:
+        pool.close()
+        pool.join()
+
+    return dict((barcode, record) for barcode, record in results if record is not None)
+
 def transform_035(record):
     '''
     Remove this tag:
@@ -254,7 +325,8 @@ def create_ht_marc(kdip):
     else:
         barcode = kdip.kdip_id
 
-    record = load_bib_record(barcode)
+    # Work on a copy, the cached record is shared.
+    record = models.Marc(deepcopy(load_bib_record(barcode).node))
     cleanup_035s(record)
     remove_most_999_fields(record, barcode)
     transform_035(record)
@@ -287,11 +359,9 @@ def create_yaml(kdip):
     # First we need to figure out the 'capture date'
     tif_dir = '%s/%s/TIFF' % (kdip.path, kdip.kdip_id)
     tif = '%s/%s' % (tif_dir, listdir(tif_dir)[-1])
-    image = Image.open(tif)
-    # In Pillow 3.0 the DateTime/306 tag is returned as a tuple, not a string.
-    # So if/when we move to 3.x we will need this conversion.
-    if image.tag.has_key(306):
-        dt = datetime.strptime(image.tag[306], '%Y:%m:%d %H:%M:%S')
+    tags = ValidateTiff(tif).read_tags()
+    if 306 in tags:
+        dt = datetime.strptime(tags[306], '%Y:%m:%d %H:%M:%S')
     else:
         dt = ''
 
@@ -1,174 +1,233 @@
 from PIL import Image
-import sys, re
-
-import models
+import sys
+from multiprocessing import Pool, current_process
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+import TiffHeader
+from TiffHeader import TiffHeaderError
+
+
+TIF_TAGS = {
+    'ImageWidth': 256,
+    'ImageLength': 257,
+    'BitsPerSample': 258,
+    'Compression': 259,
+    'PhotometricInterpretation': 262,
+    'DocumentName': 269,
+    'Make': 271,
+    'Model': 272,
+    'Orientation': 274,
+    'XResolution': 282,
+    'YResolution': 283,
+    'ResolutionUnit': 296,
+    'DateTime': 306,
+    'ImageProducer': 315,
+    #'BitsPerPixel': 37122,
+    'ColorSpace': 40961,
+    'SamplesPerPixel': 277
+}
+'Tiff tags that get validated, by name'
+
+DEFAULT_RULES = {
+    # Checked on every page. A rule with no conditions only requires the tag.
+    'tags': [
+        ('ImageWidth', {'min': 1}),
+        ('ImageLength', {'min': 1}),
+        ('Make', {}),
+        ('Model', {}),
+        ('Orientation', {'values': [1]}),
+        ('ResolutionUnit', {'values': [2]}),
+        ('DateTime', {}),
+    ],
+    # The image type is picked by BitsPerSample, then that type's rules are checked.
+    'image_types': [
+        ('Bitonal', {
+            'BitsPerSample': [1],
+            'tags': [
+                ('Compression', {'values': [1, 4]}),
+                ('SamplesPerPixel', {'values': [1]}),
+                ('XResolution', {'min': 600}),
+                ('YResolution', {'min': 600}),
+            ]
+        }),
+        ('Grayscale', {
+            'BitsPerSample': [8],
+            'tags': [
+                ('Compression', {'values': [1, 4]}),
+                ('SamplesPerPixel', {'values': [1]}),
+                ('XResolution', {'min': 600}),
+                ('YResolution', {'min': 600}),
+            ]
+        }),
+        ('Color', {
+            'BitsPerSample': [3, (8, 8, 8)],
+            'tags': [
+                ('Compression', {'values': [1, 5]}),
+                ('PhotometricInterpretation', {'values': [2]}),
+                ('SamplesPerPixel', {'values': [3]}),
+                ('XResolution', {'min': 300}),
+                ('YResolution', {'min': 300}),
+            ]
+        }),
+    ]
+}
+'''
+Rules the Tiffs are validated against, **TIFF_VALIDATION_RULES** replaces them.
+Each rule is a tag name from :data:`TIF_TAGS` and its conditions: ``values``,
+the allowed values, and ``min``, the lowest allowed value. Values are compared
+after :func:`normalize_tag`, so a resolution of ((600, 1),) is 600.0.
+'''
+
+def normalize_tag(value):
+    '''
+    Turns a tag value as read by :meth:`ValidateTiff.read_tags` into something
+    that can be compared: single values are unwrapped, rationals become floats
+    and strings are stripped.
+    '''
+    if isinstance(value, basestring):
+        return value.strip()
+    value = tuple((float(part[0]) / part[1] if part[1] else 0.0) if isinstance(part, tuple) else part \
+        for part in value)
+    if len(value) == 1:
+        return value[0]
+    return value
+
+def _compile_rule(name, conditions):
+    try:
+        tag = TIF_TAGS[name]
+    except KeyError:
+        raise ImproperlyConfigured('Unknown Tiff tag %s in TIFF_VALIDATION_RULES' % name)
+    values = conditions.get('values')
+    if values is not None:
+        values = frozenset(tuple(value) if isinstance(value, list) else value for value in values)
+    return (tag, 'Invalid value for %s in ' % name, values, conditions.get('min'))
+
+def compile_rules(rules):
+    '''
+    Compiles a rule table like :data:`DEFAULT_RULES` into a list of the checks
+    done on every page and a dict of BitsPerSample value -> checks for that
+    image type.
+    '''
+    common = [_compile_rule(name, conditions) for name, conditions in rules['tags']]
+    image_types = {}
+    for image_type, type_rules in rules['image_types']:
+        checks = [_compile_rule(name, conditions) for name, conditions in type_rules['tags']]
+        for bits in type_rules['BitsPerSample']:
+            image_types[tuple(bits) if isinstance(bits, (list, tuple)) else bits] = checks
+    return common, image_types
+
+RULES = compile_rules(getattr(settings, 'TIFF_VALIDATION_RULES', DEFAULT_RULES))
+'The compiled :data:`DEFAULT_RULES` or **TIFF_VALIDATION_RULES**'
+
+def _read_tags(tiff_file):
+    try:
+        return ValidateTiff(tiff_file).read_tags()
+    except:
+        return None
+
+def _map(function, items, workers=None):
+    workers = workers or getattr(settings, 'TIFF_VALIDATION_WORKERS', 1)
+
+    # Pool workers are daemonic and can't have a pool of their own, which is
+    # the case when `KDip.load` is run with several workers.
+    if workers > 1 and len(items) > 1 and not current_process().daemon:
+        pool = Pool(workers)
+        try:
+            return pool.map(function, items)
+        finally:
+            pool.close()
+            pool.join()
+    return map(function, items)
+
+def read_tiff_tags(tiffs, workers=None):
+    '''
+    Reads the tags of a list of Tiff files, spread over a pool of `workers`
+    processes (**TIFF_VALIDATION_WORKERS**, default 1 which reads them in this
+    process). Returns a dict of file -> tags, the tags are `None` for files
+    that could not be read.
+    '''
+    return dict(zip(tiffs, _map(_read_tags, tiffs, workers)))
+
+def validate_tiff_files(tiffs, workers=None, tags=None):
+    '''
+    Validates a list of Tiff files. The tags of the files that are not in
+    `tags` (file -> tags) are read with :func:`read_tiff_tags`.
+    Returns the errors for all the files, in the same order as `tiffs`.
+    '''
+    tags = dict(tags or {})
+    tags.update(read_tiff_tags([tiff for tiff in tiffs if tiff not in tags], workers))
+
+    errors = []
+    for tiff in tiffs:
+        errors.extend(ValidateTiff(tiff, tags=tags[tiff]).validate_tiffs())
+    return errors
 
 
 class ValidateTiff:
-    def __init__(self, tiff_file, kdip):
+    def __init__(self, tiff_file, kdip=None, tags=None):
         self.tiff_file = tiff_file
         self.kdip = kdip
+        self.tags = tags
+        self.errors = []
 
-    def validate_tiffs(self):
+    def read_tags(self):
         '''
-        Method to validate the Tiff files.
-        Site for looking up Tiff tags: http://www.awaresystems.be/imaging/tiff/tifftags/search.html
+        Returns the Tiff's tags as a dict of tag number -> value. The tags are
+        read straight from the file header unless **TIFF_TAG_READER** is set to
+        'pil' or the header can't be parsed, then PIL is used.
         '''
-
-        def log_error():
-            tiff_error = models.ValidationError(
-                kdip=self.kdip,
-                error="%s %s" % (self.error, self.tiff_file),
-                error_type="Invalid Tiff")
-            tiff_error.save()
-
-        tif_tags = {
-            'ImageWidth': 256,
-            'ImageLength': 257,
-            'BitsPerSample': 258,
-            'Compression': 259,
-            'PhotometricInterpretation': 262,
-            'DocumentName': 269,
-            'Make': 271,
-            'Model': 272,
-            'Orientation': 274,
-            'XResolution': 282,
-            'YResolution': 283,
-            'ResolutionUnit': 296,
-            'DateTime': 306,
-            'ImageProducer': 315,
-            #'BitsPerPixel': 37122,
-            'ColorSpace': 40961,
-            'SamplesPerPixel': 277
-        }
-
-        bittsPerSample = {
-            '1': 'Bitonal',
-            '3': 'Color-3',
-            '8': 'Grayscale',
-            '888': 'Color-888',
-            '88': 'Two channel grayscale'
-        }
-
-        compressions = {
-            'Uncompressed': (1,),
-            'T6/Group 4 Fax': (4,),
-            'LZW': (5,)
-        }
-
-        photometricInterpretation = {
-            'WhiteIsZero': (0,),
-            'BlackIsZero': (1,),
-            'RGB': (2,)
-        }
-
-        samplesPerPixel = {
-            'Grayscale': '(1,)',
-            'RGB': '(3,)'
-        }
-
-        missing = []
-        found = {}
-        skipalbe = ['ImageProducer', 'DocumentName', 'Make', 'Model', 'ColorSpace']
-        yaml_data = {}
-
-        image = ''
+        tag_numbers = TIF_TAGS.values()
+        if getattr(settings, 'TIFF_TAG_READER', 'header') != 'pil':
+            try:
+                return TiffHeader.read_tags(self.tiff_file, tag_numbers)
+            except TiffHeaderError:
+                pass
+
+        image = Image.open(self.tiff_file)
         try:
-            image = Image.open(self.tiff_file)
-
-            tags = image.tag
-            for tif_tag in tif_tags:
-                valid = tags.has_key(tif_tags[tif_tag])
-                if valid is False:
-                    found[tif_tag] = False
-
-                if valid is True:
-                    found[tif_tag] = tags.get(tif_tags[tif_tag])
-
-            ## START REAL VALIDATION
-            if found['ImageWidth'] <= 0:
-                self.error = 'Invalid value for ImageWidth in '
-                log_error()
-
-            if found['ImageLength']  <= 0:
-                self.error = 'Invalid value for ImageLength in '
-                log_error()
-
-            if not found['Make']:
-                self.error = 'Invalid value for Make in '
-                log_error()
-
-            if not found['Model']:
-                self.error = 'Invalid value for Make in '
-                log_error()
-
-            if found['Orientation'] != (1,):
-                self.error = 'Invalid value for Orientation in '
-                log_error(self.kdip)
-
-            if found['ResolutionUnit'] != (2,):
-                self.error = 'Invalid value for ResolutionUnit in '
-                log_error()
-
-            if not found['DateTime']:
-                self.error = 'Invalid value for DateTime in '
-                log_error()
-
-            image_code = re.sub("[^0-9]", "", str(found['BitsPerSample']))
-            image_type = bittsPerSample[image_code]
-
-            if image_type is 'Bitonal' or image_type is 'Grayscale':
-
-                if found['Compression'] == compressions['Uncompressed'] or found['Compression'] == compressions['T6/Group 4 Fax']:
-                    pass
-                else :
-                    self.error = 'Invalid value for PhotometricInterpretation in '
-                    log_error()
-
-                if str(found['SamplesPerPixel']) != samplesPerPixel['Grayscale']:
-                    self.error = 'Invalid value for SamplesPerPixel in '
-                    log_error()
-
-                if found['XResolution'] < 600:
-                    self.error = 'Invalid value for XResolution in '
-                    log_error()
-
-                if found['YResolution'] < 600:
-                    self.error = 'Invalid value for YResolution in '
-                    log_error()
-
-            # COLOR
-            elif image_type is 'Color-3' or image_type is 'Color-888':
-
-                if found['Compression'] == compressions['Uncompressed'] or found['Compression'] == compressions['LZW']:
-                    pass
-                else:
-                    self.error = 'Invalid value for Compression in %s' % (self.tiff_file)
-                    log_error()
+            return dict((tag, image.tag[tag]) for tag in tag_numbers if tag in image.tag)
+        finally:
+            image.close()
 
-                if found['PhotometricInterpretation'] != photometricInterpretation['RGB']:
-                    self.error = 'Invalid value for PhotometricInterpretation in %s' % (self.tiff_file)
-                    log_error()
+    def validate_tiffs(self, rules=None):
+        '''
+        Method to validate the Tiff files against :data:`RULES`, or ``rules``
+        compiled with :func:`compile_rules`. Uses the tags passed to the
+        constructor if there are any, otherwise they are read from the file.
+        Site for looking up Tiff tags: http://www.awaresystems.be/imaging/tiff/tifftags/search.html
+        Returns a list of error messages, which is empty if the file is valid.
+        '''
 
-                if str(found['SamplesPerPixel']) != samplesPerPixel['RGB']:
-                    self.error = 'Invalid value for SamplesPerPixel in '
-                    log_error()
+        def log_error():
+            self.errors.append("%s %s" % (self.error, self.tiff_file))
 
-                if found['XResolution'] < 300:
-                    self.error = 'Invalid value for XResolution in '
-                    log_error()
+        common, image_types = rules or RULES
 
-                if found['YResolution'] < 300:
-                    self.error = 'Invalid value for YResolution in '
+        try:
+            tags = self.tags if self.tags is not None else self.read_tags()
+            found = dict((tag, normalize_tag(value)) for tag, value in tags.items())
+
+            checks = list(common)
+            type_checks = image_types.get(found.get(TIF_TAGS['BitsPerSample']))
+            if type_checks is not None:
+                checks.extend(type_checks)
+
+            for tag, error, values, minimum in checks:
+                value = found.get(tag)
+                if value is None or value == '' \
+                        or values is not None and value not in values \
+                        or minimum is not None and value < minimum:
+                    self.error = error
                     log_error()
 
-            else:
+            if type_checks is None:
                 self.error = 'Cannot determine type for '
                 log_error()
 
-            image.close()
-
         except:
             self.error = 'Error \'%s\' while validating ' % sys.exc_info()[1]
             log_error()
-            image.close()
+
+        return self.errors
@@ -15,7 +15,7 @@
 #   limitations under the License.
 
 from django.contrib import admin
-from digitizedbooks.apps.publish.models import  Job, KDip, ValidationError
+from digitizedbooks.apps.publish.models import  Job, KDip, ValidationError, ValidationRun
 from django.contrib.sites.models import Site
 from django import forms
 
@@ -33,6 +33,27 @@ class ValidationErrorInline(admin.TabularInline):
     def has_delete_permission(self, request, obj=None):
         return False
 
+class ValidationRunInline(admin.TabularInline):
+    model = ValidationRun
+    fields = ['kind', 'started', 'seconds', 'bytes_read', 'external_calls', 'stage_summary']
+    readonly_fields = fields
+    extra = 0
+
+    def has_add_permission(self, request):
+        return False
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+class ValidationRunAdmin(admin.ModelAdmin):
+    list_display = ['kdip', 'kind', 'started', 'seconds', 'bytes_read', 'external_calls', 'stage_summary']
+    list_filter = ['kind']
+    search_fields = ['kdip__kdip_id']
+    readonly_fields = ['kdip', 'kind', 'started', 'seconds', 'bytes_read', 'external_calls', 'stage_summary']
+    exclude = ['stages']
+
+    def has_add_permission(self, request):
+        return False
+
 class JobAdminForm(forms.ModelForm):
     def clean(self):
         if self.cleaned_data['status'] == 'ready for zephir':
@@ -43,11 +64,11 @@ class JobAdminForm(forms.ModelForm):
 class KDipAdmin(admin.ModelAdmin):
     list_display = ['kdip_id', 'status', 'note', 'oclc', 'errors', 'accepted_by_ia', 'accepted_by_ht', 'al_ht', 'job',]
     list_link = ['kdip_id']
-    list_filter = ['status', 'job', 'accepted_by_ht', 'accepted_by_ia']
+    list_filter = ['status', 'job', 'accepted_by_ht', 'accepted_by_ia', 'validation_mode']
     list_editable = ['job', 'note', 'status', 'accepted_by_ia']
-    readonly_fields = ['kdip_id', 'reason', 'path', 'oclc', 'mms_id', 'pid', 'create_date', 'errors', 'accepted_by_ht', 'ht_url', 'al_ht']
+    readonly_fields = ['kdip_id', 'reason', 'path', 'oclc', 'mms_id', 'pid', 'create_date', 'errors', 'accepted_by_ht', 'ht_url', 'al_ht', 'validation_mode', 'upload_session']
     search_fields = ['path', 'kdip_id', 'note', 'pid']
-    inlines = [ValidationErrorInline]
+    inlines = [ValidationErrorInline, ValidationRunInline]
 #    actions = [remove_from_job]
 
     def has_add_permission(self, request):
@@ -74,5 +95,6 @@ class JobAdmin(admin.ModelAdmin):
 
 admin.site.register(KDip, KDipAdmin)
 admin.site.register(Job, JobAdmin)
+admin.site.register(ValidationRun, ValidationRunAdmin)
 
 admin.site.unregister(Site)
@@ -0,0 +1,55 @@
+import os
+import tempfile
+import time
+
+from django.core.management.base import BaseCommand
+from digitizedbooks.apps.publish import Hashing
+
+class Command(BaseCommand):
+    help = 'Compare hashing files once per digest with hashing them in a single pass.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('file', nargs='*',
+            help='Files to hash. A temporary file of --size MB is used if none are given.')
+        parser.add_argument('--size', type=int, default=64,
+            help='Size in MB of the temporary file.')
+        parser.add_argument('--repeat', type=int, default=3,
+            help='Number of times each file is hashed by each method.')
+        parser.add_argument('--algorithms', default='md5,sha1',
+            help='Comma separated digests to compute.')
+        parser.add_argument('--buffer-size', type=int, default=None,
+            help='Read buffer size in bytes for the single pass.')
+
+    def handle(self, *args, **options):
+        algorithms = options['algorithms'].split(',')
+        files = options['file']
+        tmp_file = None
+        if not files:
+            fd, tmp_file = tempfile.mkstemp(suffix='.bin')
+            with os.fdopen(fd, 'wb') as tmp:
+                for mb in range(options['size']):
+                    tmp.write(os.urandom(1024 * 1024))
+            files = [tmp_file]
+
+        try:
+            size = sum(os.path.getsize(path) for path in files)
+            # Read everything once so both methods start with the same page cache.
+            for path in files:
+                Hashing.hash_file(path, ())
+
+            methods = (
+                ('per digest', lambda path: Hashing.hash_file_per_digest(path, algorithms)),
+                ('single pass', lambda path: Hashing.hash_file(path, algorithms, options['buffer_size'])))
+            for label, method in methods:
+                best = None
+                for attempt in range(options['repeat']):
+                    start = time.time()
+                    for path in files:
+                        method(path)
+                    elapsed = time.time() - start
+                    best = elapsed if best is None else min(best, elapsed)
+                self.stdout.write('%-12s %s: %.3f seconds, %.1f MB/s' % (label,
+                    '+'.join(algorithms), best, size / (best or 1e-9) / 1024 / 1024))
+        finally:
+            if tmp_file:
+                os.remove(tmp_file)
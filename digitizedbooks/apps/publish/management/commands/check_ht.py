@@ -8,7 +8,7 @@ from digitizedbooks.apps.publish.models import KDip, Job, AlmaBibData856Field, A
 from digitizedbooks.apps.publish.Utils import remove_all_999_fields, load_alma_bib_record, update_583
 from django.conf import settings
 from pidservices.djangowrapper.shortcuts import DjangoPidmanRestClient
-import requests
+from digitizedbooks.apps.publish import HttpClient
 from os import remove
 
 def update_pid(kdip_pid, ht_url):
@@ -61,7 +61,7 @@ class Command(BaseCommand):
 
         for kdip in kdips:
             ht_url = '%s%s' % (ht_stub, kdip.kdip_id)
-            req = requests.get(ht_url)
+            req = HttpClient.get(ht_url)
             # If we get 200, we call it good and updte the KDip.
             if req.status_code == 200:
                 kdip.accepted_by_ht = True
@@ -107,7 +107,7 @@ class Command(BaseCommand):
                 with open(new_marc, 'w') as marcxml:
                     marcxml.write(bib_rec.serialize(pretty=True))
 
-                put = requests.put('%sbibs/%s' % (settings.ALMA_API_ROOT, kdip.mms_id),
+                put = HttpClient.put('%sbibs/%s' % (settings.ALMA_API_ROOT, kdip.mms_id),
                         data = bib_rec.serialize(),
                         params={'apikey': settings.ALMA_APIKEY},
                         headers={'Content-Type': 'application/xml'}
@@ -1,7 +1,20 @@
-from django.core.management.base import NoArgsCommand
+from django.core.management.base import BaseCommand
 from digitizedbooks.apps.publish.models import KDip
 
-class Command(NoArgsCommand):
+class Command(BaseCommand):
+    help = 'Scan KDIP_DIR and create and validate any new KDips.'
 
-    def handle_noargs(self, **options):
-        KDip.load()
+    def add_arguments(self, parser):
+        parser.add_argument('--incremental', action='store_true', default=False,
+            help='Only walk the top level directories that changed since the last scan.')
+        parser.add_argument('--workers', type=int, default=1,
+            help='Number of processes used to create and validate new KDips.')
+
+    def handle(self, *args, **options):
+        scan = KDip.load(incremental=options['incremental'], workers=options['workers'])
+
+        self.stdout.write(unicode(scan))
+        if int(options['verbosity']) > 1:
+            for label, volumes in (('new', scan.new), ('moved', scan.moved), ('removed', scan.removed)):
+                for kdip_id in sorted(volumes):
+                    self.stdout.write('%s %s %s' % (label, kdip_id, volumes[kdip_id]))
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+from digitizedbooks.apps.publish.models import Mets, Alto
+from digitizedbooks.apps.publish import SchemaRegistry
+
+class Command(BaseCommand):
+    help = 'Download the METS and ALTO schemas, and the schemas they import, into SCHEMA_DIR.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('url', nargs='*',
+            help='Schemas to download instead of the METS and ALTO ones.')
+
+    def handle(self, *args, **options):
+        urls = options['url'] or [Mets.XSD_SCHEMA, Alto.XSD_SCHEMA]
+        for url in SchemaRegistry.refresh(urls):
+            self.stdout.write('%s -> %s' % (url, SchemaRegistry.local_path(url)))
@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand, CommandError
+from digitizedbooks.apps.publish.models import KDip
+
+class Command(BaseCommand):
+    help = 'Validate KDips again. Validates the invalid KDips if no kdip ids are given.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('kdip_id', nargs='*',
+            help='KDips to validate.')
+        parser.add_argument('--force', action='store_true', default=False,
+            help='Read and checksum every file again instead of using the file cache.')
+        parser.add_argument('--mode', default='full',
+            choices=[mode for mode, label in KDip.VALIDATION_MODES],
+            help='full checks everything, fail-fast stops at the first kind of error found '
+                'and sample only checks the first, last and a fraction (VALIDATION_SAMPLE_RATE) of the pages.')
+
+    def handle(self, *args, **options):
+        if options['kdip_id']:
+            kdips = KDip.objects.filter(kdip_id__in=options['kdip_id'])
+            missing = set(options['kdip_id']) - set(kdip.kdip_id for kdip in kdips)
+            if missing:
+                raise CommandError('Unknown KDip(s): %s' % ', '.join(sorted(missing)))
+        else:
+            kdips = KDip.objects.filter(status='invalid')
+
+        for kdip in kdips:
+            kdip.validate(force=options['force'], mode=options['mode'])
+            self.stdout.write('%s %s (%s)' % (kdip.kdip_id, kdip.status, kdip.validation_mode))
@@ -0,0 +1,121 @@
+"""
+Long running command that watches **KDIP_DIR** with inotify and queues new
+volumes for creation and validation as soon as the scanner is done with them.
+
+A volume is queued once nothing in its directory has changed for
+**KDIP_WATCH_QUIET** seconds (default 60) so partial copies are not picked up.
+Writes to a file count as changes, so a long copy of a big Tiff keeps its
+volume waiting. A volume that was found invalid is queued again, to be
+validated again, when files in it change after it was validated.
+The HT, out_of_scope and test directories and anything matching **SKIP_DIR**
+are ignored, just like `loadKDips`. Volumes go to the rq queue named by
+**KDIP_WATCH_QUEUE** (default `default`).
+
+Every directory under **KDIP_DIR** needs an inotify watch, so
+`fs.inotify.max_user_watches` may need to be raised on large shares.
+"""
+import logging
+import os
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+import django_rq
+
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
+from digitizedbooks.apps.publish.KDipScanner import KDipScanner
+from digitizedbooks.apps.publish.models import KDip
+from digitizedbooks.apps.publish.tasks import load_kdip
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Watch KDIP_DIR and queue new volumes for loading once they stop changing.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--quiet', type=int,
+            default=getattr(settings, 'KDIP_WATCH_QUIET', 60),
+            help='Seconds a volume directory must be unchanged before it is queued.')
+        parser.add_argument('--scan', action='store_true', default=False,
+            help='Run an incremental load first to pick up volumes added while not watching.')
+
+    def handle(self, *args, **options):
+        if pyinotify is None:
+            raise CommandError('watch_kdips needs the pyinotify package.')
+
+        self.scanner = KDipScanner()
+        self.pending = {}
+        quiet = options['quiet']
+        queue = django_rq.get_queue(getattr(settings, 'KDIP_WATCH_QUEUE', 'default'))
+
+        mask = pyinotify.IN_CREATE | pyinotify.IN_MODIFY | pyinotify.IN_CLOSE_WRITE | \
+            pyinotify.IN_MOVED_TO | pyinotify.IN_DELETE
+        watch_manager = pyinotify.WatchManager(exclude_filter=self.scanner.is_excluded)
+        watch_manager.add_watch(self.scanner.kdip_dir, mask, rec=True, auto_add=True,
+            exclude_filter=self.scanner.is_excluded)
+        notifier = pyinotify.Notifier(watch_manager, default_proc_fun=self.event, timeout=1000)
+
+        if options['scan']:
+            KDip.load(incremental=True)
+
+        self.stdout.write('Watching %s' % self.scanner.kdip_dir)
+        try:
+            while True:
+                if notifier.check_events():
+                    notifier.read_events()
+                    notifier.process_events()
+                self.flush(queue, quiet)
+        finally:
+            notifier.stop()
+
+    def event(self, event):
+        "Note the time of the latest change to a volume."
+        volume = self.scanner.volume_for(event.pathname, is_dir=event.dir)
+        if volume is not None:
+            kdip_id, path = volume
+            self.pending[kdip_id] = (path, time.time())
+
+    def flush(self, queue, quiet):
+        "Queue the volumes that have not changed for `quiet` seconds."
+        now = time.time()
+        ready = dict((kdip_id, path) for kdip_id, (path, changed) in self.pending.items() \
+            if now - changed >= quiet)
+        if not ready:
+            return
+
+        for kdip_id in ready:
+            del self.pending[kdip_id]
+
+        known = dict((kdip.kdip_id, kdip) for kdip in KDip.objects.filter(kdip_id__in=ready.keys()))
+
+        for kdip_id, path in ready.items():
+            kdip = known.get(kdip_id)
+            # Validating a KDip writes to its directory, those changes are not new volumes.
+            if kdip is not None and kdip.path == path and not self.changed_since_validated(kdip):
+                continue
+            queue.enqueue(load_kdip, kdip_id, path)
+            logger.info('Queued %s from %s' % (kdip_id, path))
+            self.stdout.write('Queued %s from %s' % (kdip_id, path))
+
+    def changed_since_validated(self, kdip):
+        """
+        True if ``kdip`` is invalid and a file of its volume changed after it
+        was last validated, like the end of a copy that was taken for done.
+        The ctime is used because copies can keep the mtime of the original.
+        """
+        if kdip.status != 'invalid':
+            return False
+        run = kdip.validationrun_set.first()
+        if run is None:
+            return False
+        validated = time.mktime(run.started.timetuple()) + run.started.microsecond / 1e6 + run.seconds
+        for directory, dirs, files in os.walk(os.path.join(kdip.path, kdip.kdip_id)):
+            for name in files:
+                if os.lstat(os.path.join(directory, name)).st_ctime > validated:
+                    return True
+        return False
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('publish', '0009_auto_20160120_1735'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FileCache',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('path', models.CharField(unique=True, max_length=255)),
+                ('size', models.BigIntegerField()),
+                ('mtime', models.FloatField()),
+                ('inode', models.BigIntegerField()),
+                ('md5', models.CharField(max_length=32, blank=True)),
+                ('tags', models.TextField(blank=True)),
+            ],
+        ),
+    ]
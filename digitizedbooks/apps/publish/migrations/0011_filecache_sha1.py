@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('publish', '0010_filecache'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='filecache',
+            name='sha1',
+            field=models.CharField(max_length=40, blank=True),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('publish', '0011_filecache_sha1'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ValidationRun',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('kind', models.CharField(default=b'validate', max_length=20, choices=[(b'load', b'Load'), (b'validate', b'Validate')])),
+                ('started', models.DateTimeField()),
+                ('seconds', models.FloatField()),
+                ('bytes_read', models.BigIntegerField(default=0)),
+                ('external_calls', models.IntegerField(default=0)),
+                ('stages', models.TextField(blank=True)),
+                ('kdip', models.ForeignKey(to='publish.KDip')),
+            ],
+            options={
+                'ordering': ['-started'],
+            },
+        ),
+    ]
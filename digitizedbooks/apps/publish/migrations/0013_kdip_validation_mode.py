@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('publish', '0012_validationrun'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='kdip',
+            name='validation_mode',
+            field=models.CharField(default=b'full', max_length=20, choices=[(b'full', b'Full'), (b'sample', b'Sampled'), (b'fail-fast', b'Fail fast')]),
+        ),
+    ]
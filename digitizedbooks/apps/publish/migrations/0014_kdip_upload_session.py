@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('publish', '0013_kdip_validation_mode'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='kdip',
+            name='upload_session',
+            field=models.CharField(default=b'', max_length=100, blank=True),
+        ),
+    ]
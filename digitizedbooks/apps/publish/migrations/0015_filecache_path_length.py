@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('publish', '0014_kdip_upload_session'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='filecache',
+            name='path',
+            field=models.CharField(unique=True, max_length=700),
+        ),
+    ]
@@ -16,17 +16,21 @@
 
 from datetime import datetime
 import requests
-import os, re, shutil, sys
-from hashlib import md5
+import json, math, os, random, re, shutil, sys, time
 
 from django.conf import settings
-from django.db import models
+from django.db import connections, models
+from django.db.models import Case, Value, When
 from django.core.mail import send_mail
 from django.shortcuts import redirect
 from django.http import HttpResponseRedirect
 
-from ValidateTiff import ValidateTiff
+from ValidateTiff import read_tiff_tags, validate_tiff_files
+from KDipScanner import KDipScanner
+from MetsReader import read_mets
+from Timing import StageTimer
 import Utils
+import SchemaRegistry
 from SendToZephir import send_to_zephir
 
 from eulxml.xmlmap import XmlObject
@@ -42,6 +46,7 @@ from ftplib import FTP_TLS
 #import celery
 import django_rq
 import subprocess
+from multiprocessing import Pool
 
 logger = logging.getLogger(__name__)
 
@@ -73,7 +78,17 @@ class METSFile(XmlObject):
     loctype = StringField('mets:FLocat/@LOCTYPE')
     href = StringField('mets:FLocat/@xlink:href')
 
-#TODO make schemas and namespaces local
+class LocalSchemaXmlObject(XmlObject):
+    '''
+    XmlObject that validates against the vendored copy of its **XSD_SCHEMA**,
+    see :mod:`~digitizedbooks.apps.publish.SchemaRegistry`.
+    '''
+
+    @property
+    def xmlschema(self):
+        if self.XSD_SCHEMA:
+            return SchemaRegistry.get_schema(self.XSD_SCHEMA)
+
 class METStechMD(XmlObject):
     ROOT_NAME = 'techMD'
     ROOT_NAMESPACES = {
@@ -87,7 +102,7 @@ class METStechMD(XmlObject):
     mimetype = StringField('mets:mdWrap/mets:xmlData/mix:mix/mix:BasicDigitalObjectInformation/mix:FormatDesignation/mix:formatName')
     checksum = StringField('mets:mdWrap/mets:xmlData/mix:mix/mix:BasicDigitalObjectInformation/mix:Fixity/mix:messageDigest')
 
-class Mets(XmlObject):
+class Mets(LocalSchemaXmlObject):
     XSD_SCHEMA = 'http://www.loc.gov/standards/mets/version191/mets.xsd'
     ROOT_NAME = 'mets'
     ROOT_NAMESPACES = {'mets': 'http://www.loc.gov/METS/'}
@@ -241,13 +256,34 @@ class AlmaBibRecord(XmlObject):
     field_035 = NodeListField('record/datafield[@tag="035"]', AlmaField)
     alma_number = StringField('record/controlfield[@tag="001"]/text()')
 
-class Alto(XmlObject):
+class Alto(LocalSchemaXmlObject):
     '''
     Instance of ALTO xml object. Currently this is only used for schema validation
     '''
     XSD_SCHEMA = 'http://www.loc.gov/standards/alto/alto-v2.0.xsd'
     ROOT_NAME = 'alto'
 
+def _load_volume(volume):
+    """
+    Loads one volume for :meth:`KDip.load`, possibly in a worker process.
+    ``volume`` is a tuple of kdip_id, path and the keyword arguments for
+    :meth:`KDip.load_volume`. Returns the kdip_id if the KDip could not be
+    created or is invalid, otherwise ``None``.
+    """
+    k, path, kwargs = volume
+    try:
+        kdip, created = KDip.load_volume(k, path, **kwargs)
+
+        # If the KDip had errors, add it to the list so an email alert can be sent.
+        if created and kdip.status == 'invalid':
+            return kdip.kdip_id
+
+    except:
+        logger.error("Error creating KDip %s : %s" % (k, sys.exc_info()[0]))
+        return k
+
+    return None
+
 # DB Models
 class KDip(models.Model):
     "Class to describe Kirtas output directories"
@@ -265,6 +301,12 @@ class KDip(models.Model):
         ('uploaded', 'Uploaded')
     )
 
+    VALIDATION_MODES = (
+        ('full', 'Full'),
+        ('sample', 'Sampled'),
+        ('fail-fast', 'Fail fast')
+    )
+
     kdip_id = models.CharField(max_length=100, unique=True)
     'This is the same as the directory name'
     create_date = models.DateTimeField()
@@ -293,6 +335,10 @@ class KDip(models.Model):
     'Boolean set by user if volume is live in IA'
     al_ht = models.BooleanField(default=False, verbose_name="AL-HT")
     'Boolean that is set to true by the `check_al` command when the HT link appears in the MARCXML'
+    validation_mode = models.CharField(max_length=20, choices=VALIDATION_MODES, default='full')
+    'How the KDip was last validated, see :meth:`validate`'
+    upload_session = models.CharField(max_length=100, blank=True, default='')
+    'Id of the Box upload session of an unfinished chunked upload'
 
     @property
     def barcode(self):
@@ -339,21 +385,22 @@ class KDip(models.Model):
     def tif_dir(self):
         return "%s/%s/TIFF/" % (self.path, self.kdip_id)
 
-    #@classmethod
-    def validate(self):
+    def sample_pages(self, tiffs, rate=None):
         '''
-        Validates mets files, rights, tiff files and marcxml.
+        Picks the pages checked by a sampled validation: the first and last
+        page and a fraction ``rate`` (**VALIDATION_SAMPLE_RATE**, default 0.1)
+        of the others. The same volume always gets the same sample.
         '''
-
-        logger.info('Starting validation of %s' % (self.kdip_id))
-
-        # Create the YAML file for HT. We do it here, instead of on load
-        # because we want it to recreate on reporcessing.
-        # bib_rec = Utils.load_bib_record(self.kdip_id)
-        # capture_agent = bib_rec.tag_583_5
-        Utils.create_yaml(self)
-
-        # Check the dates to see if the volume is in copyright.
+        if rate is None:
+            rate = getattr(settings, 'VALIDATION_SAMPLE_RATE', 0.1)
+        if len(tiffs) <= 2:
+            return list(tiffs)
+        middle = tiffs[1:-1]
+        count = min(len(middle), int(math.ceil(len(middle) * rate)))
+        sample = set(random.Random(self.kdip_id).sample(middle, count))
+        return [tiffs[0]] + [tiff for tiff in middle if tiff in sample] + [tiffs[-1]]
+
+    def _check_rights(self, errors):
         try:
             # Load the MARC XML
             bib_rec = Utils.load_bib_record(self)
@@ -361,9 +408,8 @@ class KDip(models.Model):
             # Check if there is a subfied 5 in the 583 tag
             if not bib_rec.tag_583_5:
                 reason = 'No 583 tag in marc record.'
-                error = ValidationError( \
-                    kdip=self, error=reason, error_type="Inadequate Rights")
-                error.save()
+                errors.append(ValidationError( \
+                    kdip=self, error=reason, error_type="Inadequate Rights"))
 
             # Get the published date
             date = Utils.get_date(bib_rec.tag_008, self.note)
@@ -378,89 +424,212 @@ class KDip(models.Model):
                 rights = Utils.get_rights(date, bib_rec.tag_583x)
                 if rights is not None:
                     logger.error(rights)
-                    error = ValidationError( \
-                        kdip=self, error=rights, error_type="Inadequate Rights")
-                    error.save()
+                    errors.append(ValidationError( \
+                        kdip=self, error=rights, error_type="Inadequate Rights"))
 
         except Exception as rights_error:
             reason = 'Could not determine rights'
-            error = ValidationError(kdip=self, error=reason, error_type="Inadequate Rights")
-            error.save()
+            errors.append(ValidationError(kdip=self, error=reason, error_type="Inadequate Rights"))
 
-        # Mets file exists
+    def _check_mets(self, errors, timer):
         logger.info('Checking for Mets File.')
         if not os.path.exists(self.mets_xml):
             reason = "Error: %s does not exist" % self.mets_xml
             logger.error(reason)
-            error = ValidationError(kdip=self, error=reason, error_type="Missing Mets")
-            error.save()
+            errors.append(ValidationError(kdip=self, error=reason, error_type="Missing Mets"))
 
         try:
-            logger.info('Loading Mets file into eulxml.')
-            mets = load_xmlobject_from_file(self.mets_xml, Mets)
-
+            schema = SchemaRegistry.get_schema(Mets.XSD_SCHEMA)
         except:
-            reason = 'Error \'%s\' while loading Mets' % (sys.exc_info()[0])
-            error = ValidationError(kdip=self, error=reason, error_type="Loading Mets")
-            error.save()
+            logger.error('Error \'%s\' while loading the Mets schema' % (sys.exc_info()[1]))
+            schema = None
 
+        mets = None
         try:
-            #mets file validates against schema
-            if mets.is_valid() is not True:
-                reason = "Error: %s is not valid" % self.mets_xml
-                logger.error(reason)
-                error = ValidationError(kdip=self, error=reason, error_type="Invalid Mets")
-                error.save()
-        except:
-            error = ValidationError(kdip=self, error='Unable to validate Mets.', error_type="Invalid Mets")
-            error.save()
-
-        logger.info('Gathering tiffs.')
+            # The Mets is streamed into an index of its files instead of
+            # being loaded whole, and validated against the schema as it is read.
+            logger.info('Reading Mets file.')
+            mets = read_mets(self.mets_xml, schema)
+            timer.add_bytes(os.path.getsize(self.mets_xml))
 
-        tiffs = glob.glob('%s/*.tif' % self.tif_dir)
-
-        logger.info('Checking tiffs.')
-        for tiff in tiffs:
-            logger.info('Sending %s for validation' % tiff)
-            validate_tif = ValidateTiff(tiff, self)
-            validate_tif.validate_tiffs()
+        except:
+            reason = 'Error \'%s\' while loading Mets' % (sys.exc_info()[0])
+            errors.append(ValidationError(kdip=self, error=reason, error_type="Loading Mets"))
 
-        # validate each file of type ALTO and OCR
-        for file_ref in mets.techmd:
+        #mets file validates against schema
+        if mets is None or schema is None:
+            errors.append(ValidationError(kdip=self, error='Unable to validate Mets.', error_type="Invalid Mets"))
+        elif mets.valid is not True:
+            reason = "Error: %s is not valid" % self.mets_xml
+            logger.error(reason)
+            errors.append(ValidationError(kdip=self, error=reason, error_type="Invalid Mets"))
+
+        return mets
+
+    def _check_tiffs(self, errors, cache, tiffs, fail_fast=False):
+        # Tags of the pages that did not change since the last validation are
+        # taken from the file cache.
+        tags = cache.cached_tags(tiffs)
+        cached = len(tags)
+        if fail_fast:
+            # Read as many pages at a time as there are workers, so the rest
+            # are not read once one of them is invalid.
+            size = getattr(settings, 'TIFF_VALIDATION_WORKERS', 1)
+            batches = [tiffs[start:start + size] for start in range(0, len(tiffs), size)]
+        else:
+            batches = [tiffs]
+
+        for batch in batches:
+            read_tags = read_tiff_tags([tiff for tiff in batch if tiff not in tags])
+            for tiff in read_tags:
+                if read_tags[tiff] is not None:
+                    cache.set_tags(tiff, read_tags[tiff])
+            tags.update(read_tags)
+
+            tiff_errors = validate_tiff_files(batch, tags=tags)
+            for tiff_error in tiff_errors:
+                errors.append(ValidationError(kdip=self, error=tiff_error, error_type="Invalid Tiff"))
+            if fail_fast and tiff_errors:
+                break
+        logger.info('Checked %s tiffs, %s from the cache.' % (len(tags), cached))
+
+    def _check_checksums(self, errors, cache, mets, pages=None, fail_fast=False):
+        # Without a Mets there is nothing to checksum, but the errors found so
+        # far still need to be saved.
+        techmd = mets.techmd if mets is not None else {}
+        for href, file_ref in techmd.items():
 
             # Olny get the Tiffs.
-            if '.tif' in file_ref.href.lower():
-                file_path = "%s%s" % (self.mets_dir, file_ref.href)
+            if '.tif' in href.lower():
+                file_path = "%s%s" % (self.mets_dir, href)
 
                 if not os.path.exists(file_path):
                     reason = "Error: %s does not exist" % file_path
                     logger.error(reason)
-                    error = ValidationError(kdip=self, error=reason, error_type="Missing Tiff")
-                    error.save()
+                    errors.append(ValidationError(kdip=self, error=reason, error_type="Missing Tiff"))
+                    if fail_fast:
+                        return
+                    continue
+
+                # Only the sampled pages are checksummed.
+                if pages is not None and os.path.basename(file_path) not in pages:
+                    continue
+
+                # checksum good, the file is read in chunks so big tiffs
+                # don't have to fit in memory.
+                checksum = cache.digests(file_path).md5
+                if not file_ref.checksum == checksum:
+
+                    reason = "Error: checksum does not match for %s" % file_path
+
+                    logger.error(reason)
+
+                    errors.append(ValidationError(kdip=self, error=reason, error_type="Checksum"))
+                    if fail_fast:
+                        return
+
+    #@classmethod
+    def validate(self, force=False, timer=None, kind='validate', mode='full'):
+        '''
+        Validates mets files, rights, tiff files and marcxml.
+        Any previous validation errors are replaced by the ones found now.
+        Tiffs that did not change since they were last validated are not read
+        again unless ``force`` is set, see :class:`FileCache`.
+        The time spent in each stage is saved as a :class:`ValidationRun`,
+        pass a ``timer`` to add the stages to ones that were already timed.
+
+        ``mode`` is one of :attr:`VALIDATION_MODES`. 'fail-fast' stops after
+        the first stage that finds errors and 'sample' only checks the pages
+        picked by :meth:`sample_pages`. The mode is saved as
+        ``validation_mode``; a volume that was not fully validated is
+        validated again in full when it is added to a :class:`Job`, and left
+        out of the job if that finds errors.
+        '''
+
+        if mode != 'full' and self.job_id is not None:
+            logger.info('%s is part of a job, validating it in full.' % self.kdip_id)
+            mode = 'full'
+        logger.info('Starting %s validation of %s' % (mode, self.kdip_id))
+        timer = timer or StageTimer()
+        fail_fast = mode == 'fail-fast'
+
+        # Errors are collected here and saved in one go at the end.
+        errors = []
 
-                # checksum good
-                with open(file_path, 'rb') as file_to_check:
-                    if not file_ref.checksum == \
-                        md5(file_to_check.read()).hexdigest():
+        # Create the YAML file for HT. We do it here, instead of on load
+        # because we want it to recreate on reporcessing.
+        # bib_rec = Utils.load_bib_record(self.kdip_id)
+        # capture_agent = bib_rec.tag_583_5
+        timer.stage('create_yaml')
+        Utils.create_yaml(self)
+
+        # Check the dates to see if the volume is in copyright.
+        timer.stage('rights')
+        self._check_rights(errors)
+
+        tiffs = sorted(glob.glob('%s/*.tif' % self.tif_dir))
+        pages = self.sample_pages(tiffs) if mode == 'sample' else tiffs
+        # Checksums of the pages that did not change since the last validation
+        # are taken from the file cache too.
+        cache = FileCacheSet('%s/%s' % (self.path, self.kdip_id), force=force)
 
-                        reason = "Error: checksum does not match for %s" % file_path
+        # Mets file exists
+        mets = None
+        if not (fail_fast and errors):
+            timer.stage('mets')
+            mets = self._check_mets(errors, timer)
+
+        if not (fail_fast and errors):
+            timer.stage('tiffs')
+            logger.info('Gathering tiffs.')
+            self._check_tiffs(errors, cache, pages, fail_fast)
+
+        # validate each file of type ALTO and OCR
+        if not (fail_fast and errors):
+            timer.stage('checksums')
+            hash_start = time.time()
+            self._check_checksums(errors, cache, mets,
+                set(os.path.basename(tiff) for tiff in pages) if mode == 'sample' else None, fail_fast)
 
-                        logger.error(reason)
+            timer.add_bytes(cache.hashed_bytes)
+            hash_time = time.time() - hash_start
+            logger.info('Checksummed %s bytes for %s in %.1f seconds (%.1f MB/s)' % \
+                (cache.hashed_bytes, self.kdip_id, hash_time, cache.hashed_bytes / (hash_time or 1) / 1024 / 1024))
 
-                        error = ValidationError(kdip=self, error=reason, error_type="Checksum")
-                        error.save()
+        timer.stage('save')
+        cache.save()
+        logger.info('File cache for %s: %s hits, %s misses%s' % \
+            (self.kdip_id, cache.hits, cache.misses, ' (forced)' if force else ''))
+
+        self.validationerror_set.all().delete()
+        ValidationError.objects.bulk_create(errors)
 
         # if it gets here were are good
-        if self.validationerror_set.all():
+        if errors:
             self.status = 'invalid'
         else:
             self.status = 'new'
+        # A fail-fast validation that found nothing checked everything, and
+        # so did a sample that took every page.
+        if mode == 'full' or (fail_fast and not errors) or (mode == 'sample' and len(pages) == len(tiffs)):
+            self.validation_mode = 'full'
+        else:
+            self.validation_mode = mode
         self.save()
+
+        timer.finish()
+        ValidationRun.record(self, timer, kind)
+        logger.info('Validated %s in %.1f seconds: %s' % (self.kdip_id, timer.seconds, timer.summary()))
         return True
 
     @classmethod
     def load(self, *args, **kwargs):
-        "Class method to scan data directory specified in the ``localsettings`` **KDIP_DIR** and create new KDIP objects in the database."
+        """
+        Class method to scan data directory specified in the ``localsettings`` **KDIP_DIR** and create new KDIP objects in the database.
+        Pass ``incremental=True`` to only look at the parts of **KDIP_DIR** that changed since the last scan
+        and ``workers=N`` to create and validate new KDips in a pool of N processes.
+        Returns the :class:`~digitizedbooks.apps.publish.KDipScanner.ScanResult` of the scan.
+        """
 
         # The only thing that should be sending any args is when the kdip is
         # set to reporcess and the kdip object will be the first (and only) arg.
@@ -470,96 +639,157 @@ class KDip(models.Model):
             # type of object. Just sending `args[0]` had issues.
             # Most noteably with the Mets validation.
             kdip = KDip.objects.get(pk=reproc_kdip.id)
-            # Clear out previous validation errors.
-            errors = kdip.validationerror_set.all()
-            errors.delete()
+            # The bib record might have been fixed, don't use the cached one.
+            Utils.bib_cache.invalidate(kdip.barcode)
+            # Validating replaces the previous validation errors.
             kdip.validate()
             Utils.create_ht_marc(kdip)
 
         else:
-            kdip_list = {}
-            exclude = ['%s/HT' % kdip_dir, '%s/out_of_scope' % kdip_dir, '%s/test' % kdip_dir]
+            # An incremental scan only walks the top level directories that
+            # changed since the last scan.
+            incremental = kwargs.get('incremental', False)
+            timer = StageTimer()
+            timer.stage('scan')
+            scan = KDipScanner(kdip_dir).scan(incremental=incremental)
+            logger.info('Scanned %s: %s' % (kdip_dir, unicode(scan)))
+            for removed in scan.removed:
+                logger.info('%s is no longer in %s' % (removed, scan.removed[removed]))
+
+            # Only process new KDips, the ones that moved just get their path updated.
+            # Every volume found is checked, not only the ones the scan had not
+            # seen: a volume whose KDip could not be created is in the index
+            # all the same and is retried here.
+            timer.stage('reconcile')
+            kdip_list, moved = KDip.reconcile(scan.volumes)
+            for moved_kdip in moved:
+                logger.info('%s moved to %s' % (moved_kdip, moved[moved_kdip]))
+
+            # Fetch the bib records of all the new volumes up front rather
+            # than one at a time as each KDip is created. The cache keeps them
+            # all until the volumes are loaded.
+            with Utils.bib_cache.room_for(len(kdip_list)):
+                timer.stage('fetch_bib_records')
+                Utils.fetch_bib_records(kdip_list.keys())
+
+                # create the KDIP is it does not exits
+                volumes = [(k, kdip_list[k], kwargs) for k in kdip_list]
+                workers = kwargs.get('workers') or 1
+                # Each volume's own stages are saved as a ValidationRun.
+                timer.stage('load_volumes')
+
+                if workers > 1 and len(volumes) > 1:
+                    # The workers are forked and must not share our database
+                    # connections, each one opens its own.
+                    for connection in connections.all():
+                        connection.close()
+                    pool = Pool(workers)
+                    try:
+                        results = list(pool.imap_unordered(_load_volume, volumes))
+                    finally:
+                        pool.close()
+                        pool.join()
+                else:
+                    results = map(_load_volume, volumes)
 
-            for path, subdirs, files in os.walk(kdip_dir):
-                for dir in subdirs:
-                    kdip = re.search(r"^[0-9]", dir)
-                    full_path = os.path.join(path, dir)
+            timer.finish()
+            logger.info('Loaded %s new volumes in %.1f seconds, %s HTTP requests: %s' % \
+                (len(volumes), timer.seconds, timer.total('calls'), timer.summary()))
 
-                    # Only process new KDips or ones.
-                    try:
-                        skip = getattr(settings, 'SKIP_DIR', None)
-                        if skip not in path:
-                            processed_KDip = KDip.objects.get(kdip_id = dir)
-                            # Check to see if the a KDip has moved and update the path.
-                            if processed_KDip != path:
-                                processed_KDip.path = path
-                                processed_KDip.save()
-                    except KDip.DoesNotExist:
-                        if kdip and full_path not in exclude:
-                            kdip_list[dir] = path
-
-            # Empty list to gather errant KDips
-            bad_kdips = []
-
-            # create the KDIP is it does not exits
-            for k in kdip_list:
-                try:
-                    # lookkup bib record for note field
-                    bib_rec = Utils.create_ht_marc(k[:12])
-                    # Find the OCLC in the MARCXML
-                    # First an empty list to put all the 035 tags in
-                    oclc_tags = []
-                    for oclc_tag in bib_rec.tag_035a:
-                        oclc_search = re.search('<.*>(.*?)</.*>', oclc_tag.serialize())
-                        # Make a readable list of 035$a tags
-                        oclc_tags.append(oclc_search.group(1))
-                    # The oclc filed can have a few patterns. We want the first match
-                    oclc = next(oclc_val for oclc_val in oclc_tags \
-                        if "(OCoLC)" in oclc_val \
-                        or "ocm" in oclc_val \
-                        or "ocn" in oclc_val \
-                        and bib_rec.alma_number not in oclc_val)
-                    # Remove all non-numeric characters
-                    oclc = re.sub("[^0-9]", "", oclc)
-
-                    # Set the note field to 'EnumCron not found' if the 999a filed
-                    # is empty or missing.
-                    note = bib_rec.note(k[:12]) or 'EnumCron not found'
-
-                    defaults={
-                       'create_date': datetime.fromtimestamp(os.path.getctime('%s/%s' % (kdip_list[k], k))),
-                        'note': note,
-                        'path': kdip_list[k],
-                        'oclc': oclc
-                    }
-
-                    kdip, created = self.objects.get_or_create(kdip_id=k, defaults = defaults)
-                    if created:
-                        logger.info("Created KDip %s" % kdip.kdip_id)
-
-                        if kwargs.get('kdip_enumcron'):
-                            kdip.note = kwargs.get('kdip_enumcron')
-                            Utils.update_999a(kdip.path, kdip.kdip_id, kwargs.get('kdip_enumcron'))
-
-                        if kwargs.get('kdip_pid'):
-                            kdip.pid = kwargs.get('kdip_pid')
-
-                        kdip.validate()
-
-                        # If the KDip had errors, add it to the list so an email alert can be sent.
-                        if kdip.status == 'invalid':
-                            bad_kdips.append(kdip.kdip_id)
-
-                    # else:
-                    #     kdip.validate()
-
-
-                except:
-                    bad_kdips.append(k)
-                    logger.error("Error creating KDip %s : %s" % (k, sys.exc_info()[0]))
+            # List of errant KDips
+            bad_kdips = [k for k in results if k is not None]
+            scan.bad_kdips = bad_kdips
+
+            logger.info('Bib record cache: %(hits)s hits, %(disk_hits)s disk hits, %(misses)s misses' % \
+                Utils.bib_cache.stats())
 
             bad_kdip_list = '\n'.join(map(str, bad_kdips))
 
+            return scan
+
+    @classmethod
+    def load_volume(cls, k, path, **kwargs):
+        """
+        Create and validate the KDip for volume directory ``k`` found in ``path``.
+        Returns the KDip and whether it was created. Nothing happens to a KDip
+        that already exists.
+        """
+        timer = StageTimer()
+        # lookkup bib record for note field
+        timer.stage('marc')
+        bib_rec = Utils.create_ht_marc(k[:12])
+        # Find the OCLC in the MARCXML
+        # First an empty list to put all the 035 tags in
+        oclc_tags = []
+        for oclc_tag in bib_rec.tag_035a:
+            oclc_search = re.search('<.*>(.*?)</.*>', oclc_tag.serialize())
+            # Make a readable list of 035$a tags
+            oclc_tags.append(oclc_search.group(1))
+        # The oclc filed can have a few patterns. We want the first match
+        oclc = next(oclc_val for oclc_val in oclc_tags \
+            if "(OCoLC)" in oclc_val \
+            or "ocm" in oclc_val \
+            or "ocn" in oclc_val \
+            and bib_rec.alma_number not in oclc_val)
+        # Remove all non-numeric characters
+        oclc = re.sub("[^0-9]", "", oclc)
+
+        # Set the note field to 'EnumCron not found' if the 999a filed
+        # is empty or missing.
+        note = bib_rec.note(k[:12]) or 'EnumCron not found'
+
+        defaults={
+           'create_date': datetime.fromtimestamp(os.path.getctime('%s/%s' % (path, k))),
+            'note': note,
+            'path': path,
+            'oclc': oclc
+        }
+
+        timer.stage('create')
+        kdip, created = cls.objects.get_or_create(kdip_id=k, defaults = defaults)
+        if created:
+            logger.info("Created KDip %s" % kdip.kdip_id)
+
+            if kwargs.get('kdip_enumcron'):
+                kdip.note = kwargs.get('kdip_enumcron')
+                Utils.update_999a(kdip.path, kdip.kdip_id, kwargs.get('kdip_enumcron'))
+
+            if kwargs.get('kdip_pid'):
+                kdip.pid = kwargs.get('kdip_pid')
+
+            kdip.validate(timer=timer, kind='load')
+
+        return kdip, created
+
+    @classmethod
+    def reconcile(cls, volumes, batch_size=500):
+        """
+        Compare volumes found on disk, a dict of kdip_id -> path, with the KDips
+        in the database. The path of KDips that moved is updated in bulk.
+
+        Returns two dicts, kdip_id -> path, of the volumes that are not in the
+        database and of the ones that moved.
+        """
+        known = dict(cls.objects.values_list('kdip_id', 'path'))
+
+        new = {}
+        moved = {}
+        for kdip_id, path in volumes.items():
+            if kdip_id not in known:
+                new[kdip_id] = path
+            elif known[kdip_id] != path:
+                moved[kdip_id] = path
+
+        # `update` skips `save` on purpose, nothing but the path changed.
+        moved_items = moved.items()
+        for start in range(0, len(moved_items), batch_size):
+            batch = moved_items[start:start + batch_size]
+            cls.objects.filter(kdip_id__in=[kdip_id for kdip_id, path in batch]).update(
+                path=Case(*[When(kdip_id=kdip_id, then=Value(path)) for kdip_id, path in batch],
+                    output_field=models.CharField()))
+
+        return new, moved
+
     def __unicode__(self):
         return self.kdip_id
 
@@ -576,6 +806,19 @@ class KDip(models.Model):
             return HttpResponseRedirect('/admin/publish/kdip/?q=%s' % self.kdip_id)
 
         else:
+            if self.job_id is not None and self.validation_mode != 'full':
+                # Volumes that were only partly validated are validated in
+                # full before they join a job. `validate` saves the KDip,
+                # without the job until we know the volume is valid.
+                job_id, self.job_id = self.job_id, None
+                self.validate(mode='full')
+                if self.status == 'invalid':
+                    logger.warning('%s is not valid, it was not added to job %s.' % (self.kdip_id, job_id))
+                    return
+                self.job_id = job_id
+                # `validate` has already inserted a new KDip.
+                kwargs.pop('force_insert', None)
+
             if self.pk is not None:
                 # If the note has been updated we need to write that to the Marc file.
                 orig = KDip.objects.get(pk=self.pk)
@@ -638,6 +881,7 @@ class Job(models.Model):
         if self.name:
             self.name = self.name.strip()
 
+        upload = False
         if (self.status == 'ready for hathi') or (self.status == 'retry'):
             if self.status == 'retry':
                 # Reset the status on the failed KDips so they will be retried.
@@ -647,12 +891,7 @@ class Job(models.Model):
                         k.save()
             # Send volumes to the upload task.
             self.status = 'uploading'
-            # Add the celery task.
-            # At this point the work is passed off to rq and executes
-            # `tasks.py`
-            from tasks import upload_for_ht
-            queue = django_rq.get_queue('high')
-            queue.enqueue(upload_for_ht, self)
+            upload = True
 
         elif self.status == 'ready for zephir':
             zephir_status = send_to_zephir(self)
@@ -661,11 +900,193 @@ class Job(models.Model):
 
         super(Job, self).save(*args, **kwargs)
 
+        if upload:
+            # Add the celery task once the job is saved as 'uploading', the
+            # uploads only finish jobs that are.
+            # At this point the work is passed off to rq and executes
+            # `tasks.py`
+            from tasks import upload_for_ht
+            queue = django_rq.get_queue('high')
+            queue.enqueue(upload_for_ht, self)
+
 class ValidationError(models.Model):
     kdip = models.ForeignKey(KDip)
     error = models.CharField(max_length=255)
     error_type = models.CharField(max_length=25)
 
+class ValidationRun(models.Model):
+    '''
+    Where the time went when a :class:`KDip` was loaded or validated. The
+    stages are saved as a JSON list of dicts with the stage's name, the
+    seconds it took, the bytes it read and the HTTP requests it made.
+    '''
+    RUN_KINDS = (
+        ('load', 'Load'),
+        ('validate', 'Validate'),
+    )
+
+    kdip = models.ForeignKey(KDip)
+    kind = models.CharField(max_length=20, choices=RUN_KINDS, default='validate')
+    started = models.DateTimeField()
+    seconds = models.FloatField()
+    bytes_read = models.BigIntegerField(default=0)
+    external_calls = models.IntegerField(default=0)
+    stages = models.TextField(blank=True)
+
+    class Meta:
+        ordering = ['-started']
+
+    @classmethod
+    def record(cls, kdip, timer, kind='validate'):
+        "Save the stages of a finished :class:`~digitizedbooks.apps.publish.Timing.StageTimer`."
+        return cls.objects.create(kdip=kdip, kind=kind,
+            started=datetime.fromtimestamp(timer.started), seconds=timer.seconds,
+            bytes_read=timer.total('bytes'), external_calls=timer.total('calls'),
+            stages=json.dumps(timer.stages))
+
+    @property
+    def stage_list(self):
+        return json.loads(self.stages) if self.stages else []
+
+    @property
+    def stage_summary(self):
+        return ', '.join('%(name)s %(seconds).1fs' % stage for stage in self.stage_list)
+
+class FileCache(models.Model):
+    '''
+    What validation learned about a file. It is reused as long as the file's
+    size, mtime and inode are the same as when it was cached.
+    '''
+    path = models.CharField(max_length=700, unique=True)
+    'Path of the file, long enough for a file of a :class:`KDip` with the longest path and kdip_id'
+    size = models.BigIntegerField()
+    mtime = models.FloatField()
+    inode = models.BigIntegerField()
+    md5 = models.CharField(max_length=32, blank=True)
+    'md5 of the file, blank if it has not been checksummed'
+    sha1 = models.CharField(max_length=40, blank=True)
+    'sha1 of the file, blank if it has not been checksummed'
+    tags = models.TextField(blank=True)
+    'Tiff tags read from the file as JSON, blank if they have not been read'
+
+    def __unicode__(self):
+        return self.path
+
+    def matches(self, stat):
+        "True if ``stat`` (an :func:`os.stat` result) is the file that was cached."
+        return self.size == stat.st_size and self.mtime == stat.st_mtime \
+            and self.inode == stat.st_ino
+
+    def get_tags(self):
+        if not self.tags:
+            return None
+        # JSON has no tuples, turn the lists back into what the tag readers return.
+        def to_tuple(value):
+            if isinstance(value, list):
+                return tuple(to_tuple(item) for item in value)
+            return value
+        return dict((int(tag), to_tuple(value)) for tag, value in json.loads(self.tags).items())
+
+    def set_tags(self, tags):
+        try:
+            self.tags = json.dumps(tags) if tags is not None else ''
+        except (TypeError, ValueError):
+            # Tags that can't be stored are read again next time.
+            self.tags = ''
+
+class FileCacheSet(object):
+    '''
+    The :class:`FileCache` entries for the files under one directory, or for
+    a list of ``paths``, read with one query and saved in bulk. With ``force``
+    the cached entries are ignored and replaced.
+    '''
+
+    def __init__(self, directory=None, force=False, paths=None):
+        self.force = force
+        self.entries = {}
+        self.changed = {}
+        self.hits = 0
+        self.misses = 0
+        self.hashed_bytes = 0
+        if not force:
+            if paths is not None:
+                entries = FileCache.objects.filter(path__in=[os.path.normpath(path) for path in paths])
+            else:
+                directory = os.path.join(os.path.normpath(directory), '')
+                entries = FileCache.objects.filter(path__startswith=directory)
+            for entry in entries:
+                self.entries[entry.path] = entry
+
+    def get(self, path):
+        '''
+        Returns the entry for ``path``. When the file changed since it was
+        cached a new, empty entry is returned.
+        '''
+        path = os.path.normpath(path)
+        if path in self.changed:
+            return self.changed[path]
+
+        stat = os.stat(path)
+        entry = self.entries.get(path)
+        if entry is not None and entry.matches(stat):
+            return entry
+
+        entry = FileCache(path=path, size=stat.st_size, mtime=stat.st_mtime, inode=stat.st_ino)
+        self.entries[path] = entry
+        self.changed[path] = entry
+        return entry
+
+    def digests(self, path):
+        '''
+        Returns the entry for ``path`` with its md5 and sha1. The file is only
+        read if they are not cached.
+        '''
+        entry = self.get(path)
+        if entry.md5 and entry.sha1:
+            self.hits += 1
+            return entry
+
+        self.misses += 1
+        digests, size = Utils.digest_file(entry.path)
+        self.hashed_bytes += size
+        return self.set_digests(entry.path, digests)
+
+    def cached_tags(self, paths):
+        "Returns a dict of path -> tags for the ``paths`` whose tags are cached."
+        cached = {}
+        for path in paths:
+            tags = self.get(path).get_tags()
+            if tags is not None:
+                cached[path] = tags
+                self.hits += 1
+            else:
+                self.misses += 1
+        return cached
+
+    def set_digests(self, path, digests):
+        "Store ``digests``, a dict with the md5 and sha1 of ``path``."
+        entry = self.get(path)
+        entry.md5 = digests['md5']
+        entry.sha1 = digests['sha1']
+        self.changed[entry.path] = entry
+        return entry
+
+    def set_tags(self, path, tags):
+        entry = self.get(path)
+        entry.set_tags(tags)
+        self.changed[entry.path] = entry
+
+    def save(self):
+        if not self.changed:
+            return
+        paths = list(self.changed)
+        for start in range(0, len(paths), 500):
+            FileCache.objects.filter(path__in=paths[start:start + 500]).delete()
+        for entry in self.changed.values():
+            entry.pk = None
+        FileCache.objects.bulk_create(self.changed.values())
+        self.changed = {}
+
 class BoxToken(models.Model):
     refresh_token = models.CharField(max_length=200, blank=True)
     client_id = models.CharField(max_length=200, blank=True)
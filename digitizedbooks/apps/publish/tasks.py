@@ -14,26 +14,27 @@ from __future__ import absolute_import
 from django.conf import settings
 from django.core.mail import send_mail
 import digitizedbooks.apps.publish.models as models
+from digitizedbooks.apps.publish.PackageBuilder import PackageBuilder
+from digitizedbooks.apps.publish.UploadPipeline import PipelinedUploader
+from digitizedbooks.apps.publish.BoxUpload import ChunkedUpload, chunked_threshold
 # PIDMAN stuff
 from pidservices.clients import parse_ark
 from pidservices.djangowrapper.shortcuts import DjangoPidmanRestClient
 # Basic python stuff
 import os
-import shutil
 import sys
 import json
 import glob
-import zipfile
 import logging
 import traceback
 from requests import ConnectionError
 import gc
 # A few specifics
-from hashlib import md5, sha1
 from box import refresh_v2_token, BoxClient, ItemAlreadyExists
 from time import sleep, strftime, gmtime
 # Exceptions
 from OpenSSL.SSL import SysCallError
+import django_rq
 from django_rq import job
 from boxsdk import OAuth2, Client, JWTAuth
 import boxsdk.exception as BoxException
@@ -96,27 +97,49 @@ def parse_response(job, kdip, response, sha1):
 def upload_file(job, kdip):
     '''
     Method to package and upload KDip to Box.com
+    With **HT_PACKAGE_STREAMING** the packages that are uploaded in parts
+    are zipped as they are sent and never written to disk.
     '''
     box_client = refresh_client(job, kdip)
-    box_folder = box_client.folder(folder_id=settings.BOXFOLDER)
     htpackage = kdip.kdip_id + '.zip'
     htpackage_path = kdip.process_dir + '.zip'
-    zipsize = os.path.getsize(htpackage_path)
 
-    zip_sha1 = sha1()
-    local_file = open(htpackage_path, 'rb')
-    # Get the checksum of the local file.
-    zip_sha1.update(local_file.read())
-    # Move the file back to the begining.
-    local_file.seek(0)
-    local_file.close()
+    # With HT_PACKAGE_STREAMING the package is zipped as it is uploaded,
+    # unless it is too small for an upload session.
+    stream_size = None
+    if getattr(settings, 'HT_PACKAGE_STREAMING', False):
+        stream_size = PackageBuilder.measure(package_files(kdip))
+        if stream_size < chunked_threshold():
+            stream_size = None
+            build_package(kdip)
+
+    if stream_size is None:
+        zipsize = os.path.getsize(htpackage_path)
+
+        # Get the checksum of the local file. It is kept in the file cache so a
+        # retried upload does not read the zip again.
+        digests = models.FileCacheSet(paths=[htpackage_path])
+        zip_sha1 = digests.digests(htpackage_path).sha1
+        digests.save()
 
     upload_response = None
     reupload = None
     try:
+        if stream_size is not None:
+            uploaded, zip_sha1 = stream_package(box_client, kdip, stream_size)
+            parse_response(job, kdip, uploaded, zip_sha1)
+            return
+
+        # Big packages are sent in parts, an interrupted upload picks up
+        # where it stopped.
+        if zipsize >= chunked_threshold():
+            parse_response(job, kdip, chunked_upload(box_client, kdip, htpackage_path, zip_sha1), zip_sha1)
+            return
+
         # Collect the garbage. This is really just here because we get `MemoryError`s from time to time.
         gc.collect()
         # Upload file to Box
+        box_folder = box_client.folder(folder_id=settings.BOXFOLDER)
         upload_response = box_folder.upload(
             htpackage_path,
             preflight_check=True,
@@ -124,7 +147,7 @@ def upload_file(job, kdip):
             upload_using_accelerator=True
         )
         # Send to function that does more checking and updatas object's status
-        parse_response(job, kdip, upload_response, zip_sha1.hexdigest())
+        parse_response(job, kdip, upload_response, zip_sha1)
 
     except BoxException.BoxAPIException as e:
         # The API throws and exception with a status of 409 if
@@ -138,7 +161,7 @@ def upload_file(job, kdip):
                 preflight_expected_size=zipsize,
                 upload_using_accelerator=True
             )
-            parse_response(job, kdip, reupload, zip_sha1.hexdigest())
+            parse_response(job, kdip, reupload, zip_sha1)
 
     except ConnectionError:
         sleep(30)
@@ -149,194 +172,368 @@ def upload_file(job, kdip):
         reason = 'box upload failed: ' + trace
         kdip_fail(job, kdip, reason)
 
-def zipdir(path, zip):
+def keep_upload_session(kdip, session_id):
+    kdip.upload_session = session_id
+    models.KDip.objects.filter(pk=kdip.pk).update(upload_session=session_id)
+
+
+def chunked_upload(box_client, kdip, htpackage_path, zip_sha1):
+    '''
+    Upload the package in parts through a Box upload session. The session is
+    kept on the KDip until the upload is committed, so when `upload_file` or
+    `upload_kdip` try again after a connection error, or an `upload_volume`
+    task runs again after its worker died, only the missing parts are sent.
+    `build_package` keeps the package while the session is pending.
+    '''
+    upload = ChunkedUpload(box_client, htpackage_path, settings.BOXFOLDER, sha1=zip_sha1,
+        session_id=kdip.upload_session or None, on_session=lambda session_id: keep_upload_session(kdip, session_id))
+    try:
+        uploaded = upload.run()
+    except BoxException.BoxAPIException:
+        # Box turned the upload down, the next one starts a new session.
+        keep_upload_session(kdip, '')
+        raise
+    keep_upload_session(kdip, '')
+    logging.getLogger(__name__).info('Uploaded {} in {} parts'.format(kdip.kdip_id, upload.parts_sent))
+    return uploaded
+
+
+def stream_package(box_client, kdip, size):
+    '''
+    Upload the package through a Box upload session as it is written, no zip
+    file is made. `size` is the size of the package from
+    `PackageBuilder.measure`. Returns the uploaded file and the package's sha1.
+    An interrupted upload is resumed like with `chunked_upload`, the package
+    is written again but only the parts Box does not have are sent.
+    '''
+    upload = ChunkedUpload(box_client, None, settings.BOXFOLDER, name='{}.zip'.format(kdip.kdip_id),
+        size=size, session_id=kdip.upload_session or None,
+        on_session=lambda session_id: keep_upload_session(kdip, session_id))
+    stream = upload.stream()
+    try:
+        package = PackageBuilder(stream)
+        write_package(package, kdip)
+        package.close()
+        uploaded = stream.close()
+    except ConnectionError:
+        # `upload_file` tries again and resumes the session.
+        stream.abort()
+        raise
+    except Exception:
+        # Box turned the upload down or what was written does not match the
+        # session, the next upload starts a new one.
+        stream.abort()
+        keep_upload_session(kdip, '')
+        raise
+    keep_upload_session(kdip, '')
+    logging.getLogger(__name__).info('Streamed {} in {} parts'.format(kdip.kdip_id, upload.parts_sent))
+    return uploaded, upload.sha1
+
+
+def package_files(kdip):
     """
-    Zip up all the files for the volume.
+    The files that go in the HT package, in the order they are listed in
+    `checksum.md5`.
     """
-    for root, dirs, files in os.walk(path):
-        for vol_file in files:
-            zip.write(os.path.join(root, vol_file))
+    volume = '{}/{}'.format(kdip.path, kdip.kdip_id)
+    files = sorted(glob.glob('{}/TIFF/*.tif'.format(volume)))
+    files += sorted(glob.glob('{}/ALTO/*.xml'.format(volume)))
+    files += sorted(glob.glob('{}/OCR/*.txt'.format(volume)))
+    return files + [kdip.meta_yml, kdip.marc_xml, kdip.mets_xml]
 
 
-def checksumfile(checkfile, process_dir):
+def package_size(kdip):
     """
-    HT wants a file with checksums for each file we're sending them.
+    Size of the files that go in the HT package, the Tiffs are stored so the
+    package is about as big.
     """
-    with open(checkfile, 'rb') as file:
-        with open('{}/checksum.md5'.format(process_dir), 'a') as outfile:
-            if 'alto' in checkfile:
-                checkfile = checkfile.replace('.alto', '')
-            filename = checkfile.split('/')
-            outfile.write('{} {}\n'.format((md5(file.read()).hexdigest()), filename[-1]))
-
-
-def checksumverify(checksum, process_dir, file):
-    with open('{}/{}'.format(process_dir, file), 'rb') as file:
-        if md5(file.read()).hexdigest() == checksum:
-            return True
-        else:
-            return False
+    return sum(os.path.getsize(path) for path in package_files(kdip) if os.path.exists(path))
+
+
+def build_package(kdip):
+    """
+    Write the zip package for HT straight from the volume's files. HT does
+    not want sub directories in the package, so every file goes at the top
+    and the ALTO files are renamed in the zip. Each file is read once: its
+    md5 goes in `checksum.md5` and is checked against the one made while
+    validating when the file cache has it. While the KDip has an upload
+    session the package that was being uploaded is kept.
+    """
+    package_path = '{}.zip'.format(kdip.process_dir)
+    if not os.path.exists(os.path.dirname(package_path)):
+        os.makedirs(os.path.dirname(package_path))
+
+    # The upload of this package was interrupted, keep it so the upload
+    # session can be resumed.
+    if kdip.upload_session and os.path.exists(package_path):
+        logging.getLogger(__name__).info('Keeping the package of {} for upload session {}'.format(
+            kdip.kdip_id, kdip.upload_session))
+        return package_path
+
+    # The parts of an earlier package can't be used for this one.
+    if kdip.upload_session:
+        keep_upload_session(kdip, '')
+
+    with PackageBuilder(package_path) as package:
+        write_package(package, kdip)
+    return package_path
+
+
+def write_package(package, kdip):
+    """
+    Write the volume's files and `checksum.md5` to `package`, a
+    `PackageBuilder`.
+    """
+    logger = logging.getLogger(__name__)
+    sources = models.FileCacheSet('{}/{}'.format(kdip.path, kdip.kdip_id))
+    for path in package_files(kdip):
+        validated = sources.get(path).md5
+        digests = package.write_file(path)
+        if validated and validated != digests['md5']:
+            logger.error('Checksum check failes for {}.'.format(path))
+        sources.set_digests(path, digests)
+    package.write_checksums()
+
+    # Keep the checksums of the volume's files for the next package.
+    sources.save()
+    logger.info('Packaged {} files of {}, {} bytes read'.format(
+        len(package.checksums), kdip.kdip_id, package.bytes_read))
+    for line in package.summary():
+        logger.info('Packaged {} {}'.format(kdip.kdip_id, line))
+
+
+@job('default')
+def load_kdip(kdip_id, path):
+    """
+    Task to create and validate a single volume. Queued by the `watch_kdips`
+    command once the volume's directory has stopped changing. An invalid
+    KDip is queued again when its files changed, it is validated again.
+    """
+    logger = logging.getLogger(__name__)
+
+    try:
+        kdip = models.KDip.objects.get(kdip_id=kdip_id)
+        # Already loaded, just keep track of where it is.
+        if kdip.path != path:
+            models.KDip.objects.filter(pk=kdip.pk).update(path=path)
+            logger.info('{} moved to {}'.format(kdip_id, path))
+        elif kdip.status == 'invalid':
+            kdip.validate()
+            logger.info('{} was validated again, it is {}'.format(kdip_id, kdip.status))
+        return
+
+    except models.KDip.DoesNotExist:
+        pass
+
+    try:
+        kdip, created = models.KDip.load_volume(kdip_id, path)
+        if kdip.status == 'invalid':
+            logger.error('{} is invalid: {}'.format(kdip_id, kdip.errors))
+    except Exception as e:
+        logger.error('Error creating KDip {} : {}'.format(kdip_id, e))
+        raise
 
 
 @job('high')
-def upload_for_ht(job, count=1):
+def upload_for_ht(job):
+    """
+    Task that splits a job into an `upload_volume` task for each KDip. They
+    go on the **HT_UPLOAD_QUEUE** queue (default 'default') so a job can be
+    worked on by several workers. The last upload to finish calls
+    `finish_job`.
+
+    With **HT_UPLOAD_MODE** set to 'pipeline' this task does the work itself,
+    packaging the next volumes while one uploads, see
+    :class:`~digitizedbooks.apps.publish.UploadPipeline.PipelinedUploader`.
+    """
+    logger = logging.getLogger(__name__)
+    # When the job was saved in a transaction that is still open, this waits
+    # for it to be committed, so the KDips reset for a retry are seen and the
+    # job is 'uploading' for `finish_job`.
+    models.Job.objects.filter(pk=job.id).update(status='uploading')
+    kdips = models.KDip.objects.filter(job__id=job.id).exclude(status='uploaded').exclude(status='upload_fail')
+
+    if getattr(settings, 'HT_UPLOAD_MODE', 'queue') == 'pipeline':
+        pipeline = PipelinedUploader(
+            lambda kdip: package_kdip(job.id, kdip.id),
+            lambda kdip: upload_kdip(job.id, kdip.id),
+            directory='{}/HT'.format(settings.KDIP_DIR), size=package_size)
+        if pipeline.run(kdips) == 0:
+            finish_job(job.id)
+        logger.info('Uploaded {}: {}'.format(job.name, pipeline.summary()))
+        return
+
+    queue = django_rq.get_queue(getattr(settings, 'HT_UPLOAD_QUEUE', 'default'))
+    for kdip in kdips:
+        queue.enqueue(upload_volume, job.id, kdip.id)
+    logger.info('Queued {} volumes of {}'.format(len(kdips), job.name))
+
+    # Nothing left to upload.
+    if not kdips:
+        finish_job(job.id)
+
+
+@job('default')
+def upload_volume(job_id, kdip_id):
+    """
+    Task to package and upload one KDip of a job. The upload runs even when
+    packaging raised, so the KDip is always failed or uploaded and the job
+    is checked with `finish_job`.
+    """
+    logger = logging.getLogger(__name__)
+    try:
+        package_kdip(job_id, kdip_id)
+    except Exception as e:
+        logger.error('Packaging KDip {} of job {} failed: {}, {}'.format(
+            kdip_id, job_id, e, traceback.format_exc()))
+    upload_kdip(job_id, kdip_id)
+
+
+def package_kdip(job_id, kdip_id):
     """
-    Task to upload files to Box in the backgroud.
+    Make a pid for a KDip if it does not have one and build its package.
+    Errors fail the KDip, which `upload_kdip` then skips.
     """
     logger = logging.getLogger(__name__)
-    kdip_dir = settings.KDIP_DIR
-
-    for kdip in models.KDip.objects.filter(job__id=job.id).exclude(status='uploaded').exclude(status='upload_fail'):
-        # Only create a PID if it doesn't already have one
-        if job.upload_attempts == 0:
-            if not kdip.pid:
-                try:
-                    pidman_client = DjangoPidmanRestClient()
-                    pidman_domain = settings.PIDMAN_DOMAIN
-                    pidman_policy = settings.PIDMAN_POLICY
-
-                    ark = pidman_client.create_ark(domain='{}'.format(pidman_domain),
-                                                   target_uri='http://myuri.org',
-                                                   policy='{}'.format(pidman_policy),
-                                                   name='{}'.format(kdip.kdip_id))
-
-                    noid = parse_ark(ark)['noid']
-
-                    kdip.pid = noid
-                    kdip.save()
-
-                    logger.info("Ark {} was created for {}".format(ark, kdip.kdip_id))
-                except Exception as e:
-                    trace = traceback.format_exc()
-                    logger.error("Failed creating an ARK for %s: %s" %
-                                 (kdip.kdip_id, e))
-                    reason = "Box uplaod failed while making an ARK line 161 " + ' ' + trace
-                    print 'ERROR: {}'.format(reason)
-                    kdip_fail(job, kdip, reason)
-
-            else:
-                logger.info("{} already has pid {}".format(kdip.kdip_id, kdip.pid))
-
-            if not os.path.exists(kdip.process_dir):
-                os.makedirs(kdip.process_dir)
-
-            # Gather everything and write the file's checksum to a file via the
-            # `checksum` method. The copy the file to the temp directory.
-            # HT does not want sub directories in the package.
-            tiffs = glob.glob('{}/{}/TIFF/*.tif'.format(kdip.path, kdip.kdip_id))
-            for tiff in tiffs:
-                checksumfile(tiff, kdip.process_dir)
-                shutil.copy(tiff, kdip.process_dir)
-
-            altos = glob.glob('{}/{}/ALTO/*.xml'.format(kdip.path, kdip.kdip_id))
-            for alto in altos:
-                checksumfile(alto, kdip.process_dir)
-                shutil.copy(alto, kdip.process_dir)
-                if 'alto' in alto:
-                    filename = alto.split('/')
-                    page, crap, ext = filename[-1].split('.')
-                    shutil.move(alto, '{}/{}.{}'.format(kdip.process_dir, page, ext))
-
-            ocrs = glob.glob('{}/{}/OCR/*.txt'.format(kdip.path, kdip.kdip_id))
-            for ocr in ocrs:
-                checksumfile(ocr, kdip.process_dir)
-                shutil.copy(ocr, kdip.process_dir)
-
-            checksumfile(kdip.meta_yml, kdip.process_dir)
-            checksumfile(kdip.marc_xml, kdip.process_dir)
-            checksumfile(kdip.mets_xml, kdip.process_dir)
-
-            shutil.copy(kdip.meta_yml, kdip.process_dir)
-            shutil.copy(kdip.marc_xml, kdip.process_dir)
-            shutil.copy(kdip.mets_xml, kdip.process_dir)
-
-            # After copying all the files to the tmp directory. We verify that
-            # the checksum matches the one we made before the move. This is done
-            # using the `verify()` method.
-            with open('{}/checksum.md5'.format(kdip.process_dir)) as f:
-                content = f.readlines()
-                for line in content:
-                    parts = line.split()
-                    verify = checksumverify(parts[0], kdip.process_dir, parts[1])
-                    if verify is not True:
-                        logger.error('Checksum check failes for %s.' %
-                                     kdip.process_dir)
-
-            # Make the zip files
-            zipf = zipfile.ZipFile('{}.zip'.format(kdip.process_dir), 'w', zipfile.ZIP_DEFLATED, allowZip64=True)
-            os.chdir(kdip.process_dir)
-            zipdir('.', zipf)
-            zipf.close()
-
-            # Delete the process directory to save space
-            # but we keep the zip file
-            shutil.rmtree(kdip.process_dir)
-
-        attempts = 0
-
-        while attempts < 5:
-
-            try:
-                # Don't upload if no pid
-                upload_file(job, kdip) if kdip.pid else kdip_fail(job, kdip, '{} has no pid.'.format(kdip.kdip_id))
-                break
-            except ConnectionError:
-                trace = traceback.format_exc()
-                attempts += 1
-                sleep(5)
-                reason = 'Connection Error, failed to upload {}.'.format(kdip.kdip_id)
-                print 'ERROR: {}'.format(reason)
-                kdip.status = 'retry'
-                kdip.save()
-                kdip_fail(job, kdip, reason) if attempts == 5 else logger.error(
-                    '{} failed to upload on attempt {} : '.format(kdip.kdip_id, attempts, trace))
-
-            except SysCallError:
-                trace = traceback.format_exc()
-                attempts = 5
-                reason = "SSL Error while uploading {}: {}".format(kdip.kdip_id, trace)
-                logger.error(reason)
-                kdip_fail(job, kdip, reason)
-
-            except TypeError:
-                trace = traceback.format_exc()
-                attempts = 5
-                reason = "TypeError in upload package for {}: {}".format(kdip.kdip_id, trace)
-                logger.error(reason)
-                kdip_fail(job, kdip, reason)
-
-            except MemoryError:
-                trace = traceback.format_exc()
-                attempts = 5
-                reason = "MemoryError for " + kdip.kdip_id
-                logger.error(reason)
-                kdip_fail(job, kdip, reason)
-
-            except Exception as e:
-                trace = traceback.format_exc()
-                attempts = 5
-                reason = "Unexpected error for {}: {}, {}".format(kdip.kdip_id, str(e), trace)
-                logger.error(reason)
-                kdip_fail(job, kdip, reason)
+    job = models.Job.objects.get(pk=job_id)
+    kdip = models.KDip.objects.get(pk=kdip_id)
+
+    # Only create a PID if it doesn't already have one
+    if not kdip.pid:
+        try:
+            pidman_client = DjangoPidmanRestClient()
+            pidman_domain = settings.PIDMAN_DOMAIN
+            pidman_policy = settings.PIDMAN_POLICY
+
+            ark = pidman_client.create_ark(domain='{}'.format(pidman_domain),
+                                           target_uri='http://myuri.org',
+                                           policy='{}'.format(pidman_policy),
+                                           name='{}'.format(kdip.kdip_id))
+
+            noid = parse_ark(ark)['noid']
+
+            kdip.pid = noid
+            kdip.save()
+
+            logger.info("Ark {} was created for {}".format(ark, kdip.kdip_id))
+        except Exception as e:
+            trace = traceback.format_exc()
+            logger.error("Failed creating an ARK for %s: %s" %
+                         (kdip.kdip_id, e))
+            reason = "Box uplaod failed while making an ARK line 161 " + ' ' + trace
+            print 'ERROR: {}'.format(reason)
+            kdip_fail(job, kdip, reason)
+
+    else:
+        logger.info("{} already has pid {}".format(kdip.kdip_id, kdip.pid))
+
+    # Streamed packages are zipped while they upload, `stream_package`
+    # resumes the session of an earlier upload.
+    if getattr(settings, 'HT_PACKAGE_STREAMING', False):
+        return
+
+    try:
+        build_package(kdip)
+    except Exception as e:
+        trace = traceback.format_exc()
+        reason = "Packaging failed for {}: {}, {}".format(kdip.kdip_id, str(e), trace)
+        logger.error(reason)
+        kdip_fail(job, kdip, reason)
+
+
+def upload_kdip(job_id, kdip_id):
+    """
+    Upload a KDip's package to Box, trying up to five times when the
+    connection fails. Runs after `package_kdip`, then checks if the job is
+    done with `finish_job`.
+    """
+    logger = logging.getLogger(__name__)
+    job = models.Job.objects.get(pk=job_id)
+    kdip = models.KDip.objects.get(pk=kdip_id)
+
+    attempts = 0
+
+    # The package could not be made.
+    if kdip.status == 'upload_fail':
+        attempts = 5
+
+    while attempts < 5:
+
+        try:
+            # Don't upload if no pid
+            upload_file(job, kdip) if kdip.pid else kdip_fail(job, kdip, '{} has no pid.'.format(kdip.kdip_id))
+            break
+        except ConnectionError:
+            trace = traceback.format_exc()
+            attempts += 1
+            job.upload_attempts = attempts
+            sleep(5)
+            reason = 'Connection Error, failed to upload {}.'.format(kdip.kdip_id)
+            print 'ERROR: {}'.format(reason)
+            kdip.status = 'retry'
+            kdip.save()
+            kdip_fail(job, kdip, reason) if attempts == 5 else logger.error(
+                '{} failed to upload on attempt {} : '.format(kdip.kdip_id, attempts, trace))
+
+        except SysCallError:
+            trace = traceback.format_exc()
+            attempts = 5
+            reason = "SSL Error while uploading {}: {}".format(kdip.kdip_id, trace)
+            logger.error(reason)
+            kdip_fail(job, kdip, reason)
+
+        except TypeError:
+            trace = traceback.format_exc()
+            attempts = 5
+            reason = "TypeError in upload package for {}: {}".format(kdip.kdip_id, trace)
+            logger.error(reason)
+            kdip_fail(job, kdip, reason)
+
+        except MemoryError:
+            trace = traceback.format_exc()
+            attempts = 5
+            reason = "MemoryError for " + kdip.kdip_id
+            logger.error(reason)
+            kdip_fail(job, kdip, reason)
+
+        except Exception as e:
+            trace = traceback.format_exc()
+            attempts = 5
+            reason = "Unexpected error for {}: {}, {}".format(kdip.kdip_id, str(e), trace)
+            logger.error(reason)
+            kdip_fail(job, kdip, reason)
+
+    # The job is only done once all its KDips are uploaded or failed.
+    if kdip.status not in ('uploaded', 'upload_fail'):
+        kdip_fail(job, kdip, 'Upload of {} did not finish, status was {}.'.format(kdip.kdip_id, kdip.status))
+
+    finish_job(job_id)
+
+
+def finish_job(job_id):
+    """
+    Called when a KDip of the job is done. Once every KDip is uploaded or
+    failed, sets the job's status and, if none failed, lets HT know.
+    """
+    logger = logging.getLogger(__name__)
+    job = models.Job.objects.get(pk=job_id)
 
     # Check to see if all the KDips uploaded.
-    job.upload_attempts = job.upload_attempts + 1
-    statuses = job.kdip_set.values_list('status', flat=True)
-    if ('retry' in statuses) and (job.upload_attempts < 5):
-        # job.upload_attempts = job.upload_attempts + 1
-        return upload_for_ht(job, count - 1)
-    elif ('upload_fail' in statuses) and (job.upload_attempts == 5):
-        job.status = 'failed'
-        job.save()
-    elif job.upload_attempts == 5:
-        job.status = 'being processed'
-        job.save()
-        recipients = settings.HATHITRUST_CONTACTS + settings.EMORY_MANAGERS
+    statuses = set(job.kdip_set.values_list('status', flat=True))
+    if statuses - set(['uploaded', 'upload_fail']):
+        return
+
+    status = 'failed' if 'upload_fail' in statuses else 'being processed'
+    # The uploads finish in parallel, only the one that changes the status
+    # sends the email.
+    if not models.Job.objects.filter(pk=job_id, status='uploading').update(status=status):
+        return
+    logger.info('{} is {}'.format(job.name, status))
+
+    if status == 'being processed':
         kdip_list = '\n'.join(job.kdip_set.filter(
             status='uploaded').values_list('kdip_id', flat=True))
         logger.info(kdip_list)
         send_to = settings.HATHITRUST_CONTACTS + settings.EMORY_MANAGERS
         send_from = settings.EMORY_CONTACT
         send_mail('New Volumes from Emory have been uploaded', 'The following volumes have been uploaded and are ready:\n\n{}'.format(kdip_list), send_from, send_to, fail_silently=False)
-    else:
-        return upload_for_ht(job, count - 1)
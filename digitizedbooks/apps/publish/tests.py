@@ -1,15 +1,57 @@
 from unittest import skip
+from mock import patch, Mock
+import hashlib
+from hashlib import md5, sha1
 
 from eulxml.xmlmap import load_xmlobject_from_file
 
-from django.test import TestCase
-from digitizedbooks.apps.publish.management.commands import check_ht
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from django.db import connection, DatabaseError
+from digitizedbooks.apps.publish.management.commands import check_ht, watch_kdips
 from django.core import management
-from digitizedbooks.apps.publish.models import Marc, KDip, Job, AlmaBibRecord
+from django.core import mail
+from digitizedbooks.apps.publish.models import Marc, KDip, Job, AlmaBibRecord, ValidationError, \
+    FileCache, FileCacheSet, Mets, ValidationRun
 from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+import glob
+import os
 import re
+from datetime import datetime, timedelta
+import shutil
+import struct
+import tempfile
+import threading
+import json
+import base64
+import BaseHTTPServer
+import SocketServer
+import zipfile
+from multiprocessing import Pool
+from StringIO import StringIO
 import Utils
+import HttpClient
+from Timing import StageTimer
+import Hashing
+import SchemaRegistry
+import requests
+from lxml import etree
 import SendToZephir
+from KDipScanner import KDipScanner
+from MetsReader import read_mets, MetsEntry
+from BibCache import BibCache
+from ValidateTiff import ValidateTiff, validate_tiff_files, read_tiff_tags, compile_rules, TIF_TAGS
+import TiffHeader
+from TiffHeader import TiffHeaderError
+from PIL import Image
+from PackageBuilder import PackageBuilder
+from UploadPipeline import PipelinedUploader
+from BoxUpload import ChunkedUpload
+import boxsdk.exception as BoxException
+from time import sleep
+import time
+from digitizedbooks.apps.publish import tasks
 from os import system
 
 class TestKDip(TestCase):
@@ -108,6 +150,633 @@ class TestKDip(TestCase):
             self.assertNotIn('(Aleph)', data)
             self.assertIn('(GEU)Aleph', data)
 
+class TestKDipReconcile(TestCase):
+
+    def test_reconcile(self):
+        KDip.objects.create(kdip_id='010000000001', path='/kdips/batch1', create_date='2015-12-30 15:43:17')
+        KDip.objects.create(kdip_id='010000000002', path='/kdips/batch1', create_date='2015-12-30 15:43:17')
+        KDip.objects.create(kdip_id='010000000003', path='/kdips/batch1', create_date='2015-12-30 15:43:17')
+
+        volumes = {
+            '010000000001': '/kdips/batch1',
+            '010000000002': '/kdips/batch2',
+            '010000000003': '/kdips/batch2',
+            '010000000004': '/kdips/batch2',
+            '010000000005': '/kdips/batch2'
+        }
+        # One query to read the KDips and one to update the paths.
+        with self.assertNumQueries(2):
+            new, moved = KDip.reconcile(volumes)
+
+        self.assertEqual(new, {'010000000004': '/kdips/batch2', '010000000005': '/kdips/batch2'})
+        self.assertEqual(sorted(moved), ['010000000002', '010000000003'])
+        self.assertEqual(KDip.objects.get(kdip_id='010000000001').path, '/kdips/batch1')
+        self.assertEqual(KDip.objects.get(kdip_id='010000000002').path, '/kdips/batch2')
+        self.assertEqual(KDip.objects.get(kdip_id='010000000003').path, '/kdips/batch2')
+
+        # Nothing moved, nothing to update.
+        with self.assertNumQueries(1):
+            KDip.reconcile(volumes)
+
+    @patch.object(Utils, 'fetch_bib_records')
+    @patch.object(KDip, 'load_volume')
+    def test_incremental_load_retries_failed_volumes(self, load_volume, fetch_bib_records):
+        kdip_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, kdip_dir)
+        for volume in ('010000000001', '010000000002'):
+            os.makedirs(os.path.join(kdip_dir, 'batch1', volume, 'TIFF'))
+
+        def load(k, path, **kwargs):
+            if k == '010000000002' and load_volume.call_count < 3:
+                raise Exception('no bib record')
+            return KDip.objects.create(kdip_id=k, path=path, create_date='2015-12-30 15:43:17'), True
+        load_volume.side_effect = load
+
+        with patch('digitizedbooks.apps.publish.models.kdip_dir', kdip_dir):
+            KDip.load(incremental=True)
+            self.assertEqual(list(KDip.objects.values_list('kdip_id', flat=True)), ['010000000001'])
+            # The volume is in the scan index now, it is retried all the same.
+            scan = KDip.load(incremental=True)
+
+        self.assertEqual(scan.new, {})
+        self.assertEqual(sorted(KDip.objects.values_list('kdip_id', flat=True)), ['010000000001', '010000000002'])
+        self.assertEqual(load_volume.call_count, 3)
+
+class InProcessPool(object):
+    "Stands in for a Pool, running the work in this process, `imap_unordered` out of order."
+
+    def __init__(self, workers):
+        self.workers = workers
+
+    def imap_unordered(self, func, items):
+        return (func(item) for item in reversed(items))
+
+    def map(self, func, items):
+        return [func(item) for item in items]
+
+    def close(self):
+        pass
+
+    def join(self):
+        pass
+
+
+class TestKDipLoadWorkers(TransactionTestCase):
+
+    def setUp(self):
+        self.kdip_dir = tempfile.mkdtemp()
+        for volume in ('batch1/010000000001', 'batch1/010000000002', 'batch2/010000000003',
+                '010000000004', '010000000005'):
+            os.makedirs(os.path.join(self.kdip_dir, volume, 'TIFF'))
+
+    def tearDown(self):
+        shutil.rmtree(self.kdip_dir)
+
+    @staticmethod
+    def load_volume(k, path, **kwargs):
+        # One volume has no bib record and one is invalid.
+        if k == '010000000002':
+            raise Exception('no bib record')
+        status = 'invalid' if k == '010000000004' else 'new'
+        return KDip.objects.create(kdip_id=k, path=path, status=status,
+            create_date='2015-12-30 15:43:17'), True
+
+    @patch.object(Utils, 'fetch_bib_records')
+    def test_workers(self, fetch_bib_records):
+        # Forked workers can't see an in memory test database, the work is
+        # then done in this process.
+        pool = Pool
+        if connection.vendor == 'sqlite' and connection.is_in_memory_db(connection.settings_dict['NAME']):
+            pool = InProcessPool
+        pools = []
+        def make_pool(workers):
+            pools.append(workers)
+            return pool(workers)
+
+        loaded = []
+        with patch('digitizedbooks.apps.publish.models.kdip_dir', self.kdip_dir), \
+                patch('digitizedbooks.apps.publish.models.Pool', side_effect=make_pool), \
+                patch.object(KDip, 'load_volume', side_effect=self.load_volume):
+            for workers in (1, 2):
+                KDip.objects.all().delete()
+                scan = KDip.load(workers=workers)
+                loaded.append((sorted(KDip.objects.values_list('kdip_id', 'path', 'status')),
+                    sorted(scan.bad_kdips)))
+
+        self.assertEqual(pools, [2])
+        self.assertEqual(loaded[0], loaded[1])
+        self.assertEqual(loaded[0][1], ['010000000002', '010000000004'])
+        self.assertEqual(len(loaded[0][0]), 4)
+
+class TestKDipValidate(TestCase):
+
+    def setUp(self):
+        self.kdip_dir = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.kdip_dir, '010000000001', 'TIFF'))
+
+    def tearDown(self):
+        shutil.rmtree(self.kdip_dir)
+
+    @patch.object(Utils, 'load_bib_record', side_effect=Exception('no record'))
+    @patch.object(Utils, 'create_yaml')
+    def test_validate(self, create_yaml, load_bib_record):
+        kdip = KDip.objects.create(kdip_id='010000000001', path=self.kdip_dir,
+            create_date='2015-12-30 15:43:17', status='new')
+        ValidationError.objects.create(kdip=kdip, error='old', error_type='Checksum')
+
+        with CaptureQueriesContext(connection) as queries:
+            kdip.validate()
+        inserts = [query for query in queries.captured_queries \
+            if 'INSERT INTO %s' % connection.ops.quote_name('publish_validationerror') in query['sql']]
+        # All the errors are saved in one insert.
+        self.assertEqual(len(inserts), 1)
+
+        self.assertEqual(kdip.status, 'invalid')
+        self.assertEqual(sorted(kdip.validationerror_set.values_list('error_type', flat=True)),
+            ['Inadequate Rights', 'Invalid Mets', 'Loading Mets', 'Missing Mets'])
+
+        run = kdip.validationrun_set.get()
+        self.assertEqual(run.kind, 'validate')
+        self.assertEqual([stage['name'] for stage in run.stage_list],
+            ['create_yaml', 'rights', 'mets', 'tiffs', 'checksums', 'save'])
+
+    @patch('digitizedbooks.apps.publish.models.validate_tiff_files', return_value=[])
+    @patch.object(KDip, '_check_mets', return_value=None)
+    @patch.object(Utils, 'get_date', return_value=None)
+    @patch.object(Utils, 'load_bib_record', side_effect=Exception('no record'))
+    @patch.object(Utils, 'create_yaml')
+    def test_validation_modes(self, create_yaml, load_bib_record, get_date, check_mets, validate_tiffs):
+        tif_dir = os.path.join(self.kdip_dir, '010000000001', 'TIFF')
+        for page in range(12):
+            Image.new('L', (10, 10)).save(os.path.join(tif_dir, '%08d.tif' % page), dpi=(600, 600))
+        kdip = KDip.objects.create(kdip_id='010000000001', path=self.kdip_dir,
+            create_date='2015-12-30 15:43:17')
+
+        def pages_read(**kwargs):
+            with patch('digitizedbooks.apps.publish.models.read_tiff_tags',
+                    wraps=read_tiff_tags) as read:
+                kdip.validate(force=True, **kwargs)
+            return [os.path.basename(tiff) for call in read.call_args_list for tiff in call[0][0]]
+
+        # The rights fail, nothing else is checked.
+        self.assertEqual(pages_read(mode='fail-fast'), [])
+        self.assertEqual(list(kdip.validationerror_set.values_list('error_type', flat=True)),
+            ['Inadequate Rights'])
+        self.assertEqual([stage['name'] for stage in kdip.validationrun_set.first().stage_list],
+            ['create_yaml', 'rights', 'save'])
+        self.assertEqual(kdip.validation_mode, 'fail-fast')
+
+        load_bib_record.side_effect = None
+        sample = pages_read(mode='sample')
+        self.assertEqual(len(sample), 3)
+        self.assertEqual((sample[0], sample[-1]), ('00000000.tif', '00000011.tif'))
+        self.assertEqual(sample, pages_read(mode='sample'))
+        self.assertEqual(KDip.objects.get(pk=kdip.pk).validation_mode, 'sample')
+
+        # Joining a job needs a full validation.
+        kdip.job = Job.objects.create(name='modes')
+        with patch('digitizedbooks.apps.publish.models.read_tiff_tags',
+                wraps=read_tiff_tags) as read:
+            kdip.save()
+        # The pages that were not sampled are read, the others come from the cache.
+        self.assertEqual(len(read.call_args[0][0]), 9)
+        self.assertFalse(set(sample) & set(os.path.basename(tiff) for tiff in read.call_args[0][0]))
+        kdip = KDip.objects.get(pk=kdip.pk)
+        self.assertEqual((kdip.validation_mode, kdip.job.name), ('full', 'modes'))
+
+    @patch('digitizedbooks.apps.publish.models.validate_tiff_files')
+    @patch.object(KDip, '_check_mets', return_value=None)
+    @patch.object(Utils, 'get_date', return_value=None)
+    @patch.object(Utils, 'load_bib_record')
+    @patch.object(Utils, 'create_yaml')
+    def test_sampled_volume_with_bad_page(self, create_yaml, load_bib_record, get_date, check_mets,
+            validate_tiffs):
+        tif_dir = os.path.join(self.kdip_dir, '010000000001', 'TIFF')
+        for page in range(12):
+            Image.new('L', (10, 10)).save(os.path.join(tif_dir, '%08d.tif' % page), dpi=(600, 600))
+        kdip = KDip.objects.create(kdip_id='010000000001', path=self.kdip_dir,
+            create_date='2015-12-30 15:43:17')
+        tiffs = sorted(glob.glob(os.path.join(tif_dir, '*.tif')))
+        bad_page = sorted(set(tiffs) - set(kdip.sample_pages(tiffs)))[0]
+        validate_tiffs.side_effect = lambda batch, tags: \
+            ['Invalid value for XResolution in  %s' % bad_page] if bad_page in batch else []
+
+        # The sample misses the bad page.
+        kdip.validate(mode='sample')
+        self.assertEqual((kdip.status, kdip.validation_mode), ('new', 'sample'))
+
+        # It is found when the volume is added to a job, which is not saved.
+        kdip.job = Job.objects.create(name='sampled')
+        kdip.save()
+        kdip = KDip.objects.get(pk=kdip.pk)
+        self.assertEqual((kdip.status, kdip.validation_mode, kdip.job), ('invalid', 'full', None))
+        self.assertEqual(list(kdip.validationerror_set.values_list('error', flat=True)),
+            ['Invalid value for XResolution in  %s' % bad_page])
+
+    def test_stage_timer(self):
+        timer = StageTimer()
+        with patch.object(HttpClient, 'session_for'):
+            timer.stage('fetch')
+            HttpClient.get('http://example.com/one')
+            HttpClient.get('http://example.com/two')
+            timer.stage('read')
+            timer.add_bytes(100)
+            timer.finish()
+        self.assertEqual([(stage['name'], stage['calls'], stage['bytes']) for stage in timer.stages],
+            [('fetch', 2, 0), ('read', 0, 100)])
+        self.assertEqual(timer.total('calls'), 2)
+
+    @patch.object(Utils, 'load_bib_record')
+    @patch.object(Utils, 'create_yaml')
+    def test_file_cache(self, create_yaml, load_bib_record):
+        tif_dir = os.path.join(self.kdip_dir, '010000000001', 'TIFF')
+        tiffs = []
+        for page in range(2):
+            tiff = os.path.join(tif_dir, '%08d.tif' % page)
+            Image.new('L', (10, 10)).save(tiff, dpi=(600, 600))
+            tiffs.append(tiff)
+        kdip = KDip.objects.create(kdip_id='010000000001', path=self.kdip_dir,
+            create_date='2015-12-30 15:43:17')
+
+        kdip.validate()
+        self.assertEqual(FileCache.objects.count(), 2)
+        tif_errors = kdip.validationerror_set.filter(error_type='Invalid Tiff').count()
+
+        def tags_read(**kwargs):
+            with patch('digitizedbooks.apps.publish.models.read_tiff_tags',
+                    wraps=read_tiff_tags) as read:
+                kdip.validate(**kwargs)
+            self.assertEqual(kdip.validationerror_set.filter(error_type='Invalid Tiff').count(),
+                tif_errors)
+            return [os.path.basename(tiff) for tiff in read.call_args[0][0]]
+
+        # Nothing changed, nothing to read.
+        self.assertEqual(tags_read(), [])
+        # A page that changed is read again.
+        Image.new('L', (10, 12)).save(tiffs[1], dpi=(600, 600))
+        os.utime(tiffs[1], (0, 0))
+        self.assertEqual(tags_read(), ['00000001.tif'])
+        self.assertEqual(tags_read(), [])
+        self.assertEqual(tags_read(force=True), ['00000000.tif', '00000001.tif'])
+        self.assertEqual(FileCache.objects.count(), 2)
+
+    def test_file_cache_digests(self):
+        tiff = os.path.join(self.kdip_dir, 'page.tif')
+        with open(tiff, 'w') as page:
+            page.write('page')
+
+        cache = FileCacheSet(self.kdip_dir)
+        self.assertEqual(cache.digests(tiff).md5, md5('page').hexdigest())
+        self.assertEqual(cache.digests(tiff).sha1, sha1('page').hexdigest())
+        self.assertEqual((cache.hits, cache.misses, cache.hashed_bytes), (1, 1, 4))
+        cache.save()
+
+        # Read from the database, the file is not read again.
+        cache = FileCacheSet(paths=[tiff])
+        self.assertEqual(cache.digests(tiff).md5, md5('page').hexdigest())
+        self.assertEqual(cache.hashed_bytes, 0)
+        self.assertEqual(FileCacheSet(self.kdip_dir, force=True).get(tiff).md5, '')
+
+        with open(tiff, 'w') as page:
+            page.write('new page')
+        cache = FileCacheSet(self.kdip_dir)
+        self.assertEqual(cache.digests(tiff).md5, md5('new page').hexdigest())
+        self.assertEqual(cache.hashed_bytes, 8)
+
+    def test_path_length(self):
+        # The longest file of a volume is its METS file.
+        longest = len('/'.join(['x' * KDip._meta.get_field('path').max_length,
+            'x' * KDip._meta.get_field('kdip_id').max_length, 'METS',
+            'x' * KDip._meta.get_field('kdip_id').max_length + '.mets.xml']))
+        self.assertTrue(FileCache._meta.get_field('path').max_length >= longest)
+
+class TestKDipScanner(TestCase):
+
+    def setUp(self):
+        self.kdip_dir = tempfile.mkdtemp()
+        for volume in ['batch1/010000000001/TIFF', 'batch1/010000000002/TIFF',
+                       'batch2/010000000003/TIFF', '010000000004/TIFF', 'HT/010000000005']:
+            os.makedirs(os.path.join(self.kdip_dir, volume))
+        self.scanner = KDipScanner(self.kdip_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.kdip_dir)
+
+    def test_scan(self):
+        scan = self.scanner.scan(incremental=False)
+        self.assertEqual(sorted(scan.volumes), ['010000000001', '010000000002', '010000000003', '010000000004'])
+        self.assertEqual(scan.volumes['010000000001'], os.path.join(self.kdip_dir, 'batch1'))
+        self.assertEqual(scan.volumes['010000000004'], self.kdip_dir)
+        self.assertEqual(len(scan.new), 4)
+
+        # Nothing changed so nothing to report.
+        scan = self.scanner.scan()
+        self.assertEqual((scan.new, scan.moved, scan.removed), ({}, {}, {}))
+        self.assertEqual(len(scan.volumes), 4)
+
+        os.makedirs(os.path.join(self.kdip_dir, 'batch1', '010000000006'))
+        shutil.move(os.path.join(self.kdip_dir, 'batch1', '010000000002'), os.path.join(self.kdip_dir, 'batch2'))
+        shutil.rmtree(os.path.join(self.kdip_dir, '010000000004'))
+
+        scan = self.scanner.scan()
+        self.assertEqual(scan.new, {'010000000006': os.path.join(self.kdip_dir, 'batch1')})
+        self.assertEqual(scan.moved, {'010000000002': os.path.join(self.kdip_dir, 'batch2')})
+        self.assertEqual(scan.removed, {'010000000004': self.kdip_dir})
+
+    def test_incremental_scan_skips_unchanged_directories(self):
+        os.makedirs(os.path.join(self.kdip_dir, 'batch1', 'sub'))
+        self.scanner.scan()
+        # Adding a volume to `sub` does not change the mtime of `batch1`.
+        os.makedirs(os.path.join(self.kdip_dir, 'batch1', 'sub', '010000000008'))
+        self.assertNotIn('010000000008', self.scanner.scan().volumes)
+        self.assertIn('010000000008', self.scanner.scan(incremental=False).volumes)
+
+    def test_volume_for(self):
+        batch1 = os.path.join(self.kdip_dir, 'batch1')
+        self.assertEqual(self.scanner.volume_for(os.path.join(batch1, '010000000001', 'TIFF', '00000001.tif'), is_dir=False),
+            ('010000000001', batch1))
+        self.assertEqual(self.scanner.volume_for(os.path.join(batch1, '010000000001')), ('010000000001', batch1))
+        self.assertEqual(self.scanner.volume_for(os.path.join(batch1, '00000001.tif'), is_dir=False), None)
+        self.assertEqual(self.scanner.volume_for(os.path.join(self.kdip_dir, 'HT', '010000000005')), None)
+        self.assertEqual(self.scanner.volume_for(batch1), None)
+
+class TestWatchKDips(TestCase):
+
+    def setUp(self):
+        self.kdip_dir = tempfile.mkdtemp()
+        self.batch = os.path.join(self.kdip_dir, 'batch1')
+        os.makedirs(os.path.join(self.batch, '010000000001', 'TIFF'))
+        self.tiff = os.path.join(self.batch, '010000000001', 'TIFF', '00000001.tif')
+        with open(self.tiff, 'w') as page:
+            page.write('page')
+        self.command = watch_kdips.Command(stdout=StringIO())
+        self.command.scanner = KDipScanner(self.kdip_dir)
+        self.command.pending = {}
+        self.queue = Mock()
+
+    def tearDown(self):
+        shutil.rmtree(self.kdip_dir)
+
+    def change(self, when):
+        with patch.object(watch_kdips.time, 'time', return_value=when):
+            self.command.event(Mock(pathname=self.tiff, dir=False))
+
+    def flush(self, when):
+        "Returns the volumes queued so far."
+        with patch.object(watch_kdips.time, 'time', return_value=when):
+            self.command.flush(self.queue, 60)
+        return [call[0][1:] for call in self.queue.enqueue.call_args_list]
+
+    def test_debounce(self):
+        self.change(1000)
+        self.assertEqual(self.flush(1030), [])
+        # A write to the Tiff, the copy is not done.
+        self.change(1050)
+        self.assertEqual(self.flush(1100), [])
+        self.assertEqual(self.flush(1110), [('010000000001', self.batch)])
+        self.assertEqual(self.command.pending, {})
+        self.assertEqual(self.flush(1200), [('010000000001', self.batch)])
+
+    def test_flush_known(self):
+        kdip = KDip.objects.create(kdip_id='010000000001', path=self.batch,
+            create_date='2015-12-30 15:43:17', status='new')
+        # Validating writes to the volume, it is not queued again.
+        self.change(1000)
+        self.assertEqual(self.flush(1060), [])
+
+        KDip.objects.filter(pk=kdip.pk).update(path='/somewhere/else')
+        self.change(1100)
+        self.assertEqual(self.flush(1160), [('010000000001', self.batch)])
+
+    def test_flush_invalid(self):
+        kdip = KDip.objects.create(kdip_id='010000000001', path=self.batch,
+            create_date='2015-12-30 15:43:17', status='invalid')
+        # Validated before the last of the volume landed.
+        ValidationRun.objects.create(kdip=kdip, started=datetime.now() - timedelta(hours=1), seconds=1)
+        self.change(1000)
+        self.assertEqual(self.flush(1060), [('010000000001', self.batch)])
+
+        # Nothing changed since it was validated.
+        ValidationRun.objects.create(kdip=kdip, started=datetime.now() + timedelta(hours=1), seconds=1)
+        self.change(1100)
+        self.assertEqual(len(self.flush(1160)), 1)
+
+    @patch.object(KDip, 'validate')
+    def test_load_kdip_validates_invalid_again(self, validate):
+        kdip = KDip.objects.create(kdip_id='010000000001', path=self.batch,
+            create_date='2015-12-30 15:43:17', status='invalid')
+        tasks.load_kdip('010000000001', self.batch)
+        self.assertEqual(validate.call_count, 1)
+
+        KDip.objects.filter(pk=kdip.pk).update(status='new')
+        tasks.load_kdip('010000000001', self.batch)
+        self.assertEqual(validate.call_count, 1)
+
+class TestBibCache(TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.fetched = []
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def fetch(self, barcode):
+        self.fetched.append(barcode)
+        with open('digitizedbooks/apps/publish/fixtures/pure-alma.xml') as marc:
+            return marc.read()
+
+    def test_cache(self):
+        cache = BibCache(self.fetch, Utils.parse_bib_record, size=2)
+        record = cache.get('010000000001')
+        self.assertTrue(isinstance(record, Marc))
+        self.assertIs(cache.get('010000000001'), record)
+        self.assertEqual(self.fetched, ['010000000001'])
+
+        # The least recently used record is dropped.
+        cache.get('010000000002')
+        cache.get('010000000003')
+        cache.get('010000000001')
+        self.assertEqual(self.fetched, ['010000000001', '010000000002', '010000000003', '010000000001'])
+        self.assertEqual(cache.stats(), {'hits': 1, 'disk_hits': 0, 'misses': 4, 'size': 2})
+
+    def test_disk_cache(self):
+        cache = BibCache(self.fetch, Utils.parse_bib_record, cache_dir=self.cache_dir, ttl=60)
+        cache.get('010000000001')
+        # A new process finds it on disk.
+        cache = BibCache(self.fetch, Utils.parse_bib_record, cache_dir=self.cache_dir, ttl=60)
+        cache.get('010000000001')
+        self.assertEqual(self.fetched, ['010000000001'])
+        self.assertEqual(cache.stats()['disk_hits'], 1)
+
+        cache.invalidate('010000000001')
+        cache.get('010000000001')
+        self.assertEqual(self.fetched, ['010000000001', '010000000001'])
+
+        # Expired records are fetched again.
+        os.utime(os.path.join(self.cache_dir, '010000000001.xml'), (0, 0))
+        cache.clear()
+        cache.get('010000000001')
+        self.assertEqual(len(self.fetched), 3)
+
+    def test_fetch_bib_records(self):
+        def fetch(barcode, **kwargs):
+            if barcode == '010000000003':
+                raise IOError('Not found')
+            return self.fetch(barcode)
+        Utils.bib_cache.clear()
+        with patch.object(Utils.bib_cache, 'fetch', fetch):
+            records = Utils.fetch_bib_records(['010000000001', '010000000002', '010000000002', '010000000003'], concurrency=2)
+        self.assertEqual(sorted(records), ['010000000001', '010000000002'])
+        self.assertEqual(sorted(self.fetched), ['010000000001', '010000000002'])
+        self.assertIs(Utils.load_bib_record('010000000001'), records['010000000001'])
+
+    def test_room_for(self):
+        cache = BibCache(self.fetch, Utils.parse_bib_record, size=2)
+        with cache.room_for(4):
+            for barcode in ('010000000001', '010000000002', '010000000003', '010000000004'):
+                cache.get(barcode)
+            self.assertEqual(cache.stats()['size'], 4)
+        # Back to its size once the batch is done, with the latest records.
+        self.assertEqual(cache.size, 2)
+        self.assertEqual(list(cache.records), ['010000000003', '010000000004'])
+
+        # A batch does not shrink the cache either.
+        with cache.room_for(1):
+            self.assertEqual(cache.size, 2)
+
+class TestSchemaRegistry(TestCase):
+
+    schemas = {
+        'http://example.com/schemas/a.xsd': '''<xs:schema xmlns:xs="http://www.w3.org/2001/XMLSchema"
+                xmlns:b="urn:b" targetNamespace="urn:a" elementFormDefault="qualified">
+            <xs:import namespace="urn:b" schemaLocation="b/b.xsd"/>
+            <xs:element name="a" type="b:value"/>
+        </xs:schema>''',
+        'http://example.com/schemas/b/b.xsd': '''<xs:schema xmlns:xs="http://www.w3.org/2001/XMLSchema"
+                targetNamespace="urn:b">
+            <xs:simpleType name="value">
+                <xs:restriction base="xs:integer"/>
+            </xs:simpleType>
+        </xs:schema>'''
+    }
+
+    def setUp(self):
+        self.schema_dir = tempfile.mkdtemp()
+        SchemaRegistry.clear()
+
+    def tearDown(self):
+        shutil.rmtree(self.schema_dir)
+        SchemaRegistry.clear()
+
+    def test_refresh_and_get_schema(self):
+        def get(url, **kwargs):
+            response = requests.Response()
+            response.status_code = 200
+            response._content = self.schemas[url]
+            return response
+
+        url = 'http://example.com/schemas/a.xsd'
+        with self.settings(SCHEMA_DIR=self.schema_dir):
+            with patch.object(SchemaRegistry.HttpClient, 'get', side_effect=get):
+                self.assertEqual(SchemaRegistry.refresh([url]),
+                    [url, 'http://example.com/schemas/b/b.xsd'])
+            self.assertTrue(os.path.exists(os.path.join(self.schema_dir,
+                'example.com', 'schemas', 'b', 'b.xsd')))
+
+            # Compiled from the local copies, and only once.
+            schema = SchemaRegistry.get_schema(url)
+            self.assertTrue(schema is SchemaRegistry.get_schema(url))
+            self.assertTrue(schema.validate(etree.fromstring('<a xmlns="urn:a">1</a>')))
+            self.assertFalse(schema.validate(etree.fromstring('<a xmlns="urn:a">one</a>')))
+
+class TestMetsReader(TestCase):
+
+    mets = '''<mets:mets xmlns:mets="http://www.loc.gov/METS/" xmlns:mix="http://www.loc.gov/mix/v20"
+            xmlns:xlink="http://www.w3.org/1999/xlink" %s>
+        <mets:amdSec>
+            %s
+            <mets:techMD ID="AMD_TECHMD_ALTO00000001"/>
+        </mets:amdSec>
+        <mets:fileSec>
+            <mets:fileGrp ID="TIFF">
+                <mets:file ID="TIF1" MIMETYPE="image/tiff" SIZE="10" CHECKSUM="abc">
+                    <mets:FLocat LOCTYPE="URL" xlink:href="../TIFF/00000001.tif"/>
+                </mets:file>
+            </mets:fileGrp>
+            <mets:fileGrp ID="ALTO">
+                <mets:file ID="ALTO1" MIMETYPE="text/xml">
+                    <mets:FLocat LOCTYPE="URL" xlink:href="../ALTO/00000001.xml"/>
+                </mets:file>
+            </mets:fileGrp>
+        </mets:fileSec>
+    </mets:mets>'''
+
+    techmd = '''<mets:techMD ID="AMD_TECHMD_TIF%08d"><mets:mdWrap><mets:xmlData><mix:mix>
+        <mix:BasicDigitalObjectInformation>
+            <mix:ObjectIdentifier><mix:objectIdentifierValue>../TIFF/%08d.tif</mix:objectIdentifierValue></mix:ObjectIdentifier>
+            <mix:fileSize>%s</mix:fileSize>
+            <mix:FormatDesignation><mix:formatName>image/tiff</mix:formatName></mix:FormatDesignation>
+            <mix:Fixity><mix:messageDigest>%s</mix:messageDigest></mix:Fixity>
+        </mix:BasicDigitalObjectInformation>
+    </mix:mix></mets:xmlData></mets:mdWrap></mets:techMD>'''
+
+    schema = '''<xs:schema xmlns:xs="http://www.w3.org/2001/XMLSchema"
+            targetNamespace="http://www.loc.gov/METS/">
+        <xs:element name="mets">
+            <xs:complexType>
+                <xs:sequence>
+                    <xs:any processContents="skip" minOccurs="0" maxOccurs="unbounded"/>
+                </xs:sequence>
+                <xs:attribute name="OBJID" use="required"/>
+            </xs:complexType>
+        </xs:element>
+    </xs:schema>'''
+
+    def setUp(self):
+        self.mets_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.mets_dir)
+
+    def write_mets(self, attributes='', prolog=''):
+        mets_file = os.path.join(self.mets_dir, 'test.mets.xml')
+        techmds = ''.join(self.techmd % (page, page, 100 + page, md5(str(page)).hexdigest()) \
+            for page in range(1, 4))
+        with open(mets_file, 'w') as mets:
+            mets.write(prolog + self.mets % (attributes, techmds))
+        return mets_file
+
+    def test_read_mets(self):
+        mets_file = self.write_mets()
+        index = read_mets(mets_file)
+
+        # Same files as the eulxml Mets object finds.
+        mets = load_xmlobject_from_file(mets_file, Mets)
+        self.assertEqual(list(index.techmd),
+            [file_ref.href for file_ref in mets.techmd])
+        self.assertEqual(index.techmd.values(),
+            [MetsEntry(file_ref.size, file_ref.checksum, file_ref.mimetype) for file_ref in mets.techmd])
+
+        self.assertEqual(index.files['../TIFF/00000001.tif'], MetsEntry(10, 'abc', 'image/tiff'))
+        self.assertEqual(index.files['../ALTO/00000001.xml'], MetsEntry(None, None, 'text/xml'))
+        self.assertEqual(index.groups, {'TIFF': ['../TIFF/00000001.tif'], 'ALTO': ['../ALTO/00000001.xml']})
+        self.assertEqual(index.valid, None)
+
+    def test_read_mets_after_comment(self):
+        prolog = '<?xml version="1.0"?>\n<!-- Made by the scanner -->\n<?xml-stylesheet href="mets.xsl"?>\n'
+        index = read_mets(self.write_mets(prolog=prolog))
+        self.assertEqual(len(index.techmd), 3)
+        self.assertEqual(index.files['../TIFF/00000001.tif'], MetsEntry(10, 'abc', 'image/tiff'))
+
+    def test_read_mets_with_schema(self):
+        schema = etree.XMLSchema(etree.fromstring(self.schema))
+        self.assertTrue(read_mets(self.write_mets('OBJID="test"'), schema).valid)
+
+        index = read_mets(self.write_mets(), schema)
+        self.assertFalse(index.valid)
+        self.assertEqual(len(index.techmd), 3)
+
 class TestMarcUpdate(TestCase):
 
     def test_check_ht(self):
@@ -155,6 +824,698 @@ class TestPureAlmaBibRecord(TestCase):
         record = load_xmlobject_from_file('digitizedbooks/apps/publish/fixtures/pure-alma.xml', Marc)
         self.assertTrue(Utils.transform_035(record))
 
+class TestChecksum(TestCase):
+    def test_md5_file(self):
+        path = 'digitizedbooks/apps/publish/fixtures/pure-alma.xml'
+        with open(path, 'rb') as fixture:
+            data = fixture.read()
+        self.assertEqual(Utils.md5_file(path, buffer_size=100), (md5(data).hexdigest(), len(data)))
+        self.assertEqual(Utils.digest_file(path, buffer_size=100),
+            ({'md5': md5(data).hexdigest(), 'sha1': sha1(data).hexdigest()}, len(data)))
+
+    def test_hash_file(self):
+        path = 'digitizedbooks/apps/publish/fixtures/pure-alma.xml'
+        with open(path, 'rb') as fixture:
+            data = fixture.read()
+        expected = dict((algorithm, hashlib.new(algorithm, data).hexdigest()) \
+            for algorithm in ('md5', 'sha1', 'sha256'))
+        self.assertEqual(Hashing.hash_file(path, ('md5', 'sha1', 'sha256'), 100), (expected, len(data)))
+        self.assertEqual(Hashing.hash_file_per_digest(path, ('md5', 'sha1', 'sha256')),
+            (expected, 3 * len(data)))
+
+class TestPackageBuilder(TestCase):
+
+    def setUp(self):
+        self.kdip_dir = tempfile.mkdtemp()
+        self.volume = os.path.join(self.kdip_dir, '010000000001')
+        self.files = {}
+        for name, data in (('TIFF/00000001.tif', 'tiff' * 1000), ('ALTO/00000001.alto.xml', '<alto/>'),
+                ('OCR/00000001.txt', 'text'), ('meta.yml', 'yaml'), ('marc.xml', '<marc/>'),
+                ('METS/010000000001.mets.xml', '<mets/>')):
+            path = os.path.join(self.volume, name)
+            if not os.path.exists(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'wb') as volume_file:
+                volume_file.write(data)
+            self.files[name] = data
+
+    def tearDown(self):
+        shutil.rmtree(self.kdip_dir)
+
+    def test_build_package(self):
+        kdip = KDip.objects.create(kdip_id='010000000001', path=self.kdip_dir,
+            create_date='2015-12-30 15:43:17')
+        with self.settings(KDIP_DIR=self.kdip_dir):
+            package_path = tasks.build_package(kdip)
+
+        self.assertEqual(package_path, os.path.join(self.kdip_dir, 'HT', '010000000001.zip'))
+        # Nothing is staged next to the package.
+        self.assertEqual(os.listdir(os.path.join(self.kdip_dir, 'HT')), ['010000000001.zip'])
+        # The ALTO file is renamed in the package, not on disk.
+        self.assertTrue(os.path.exists(os.path.join(self.volume, 'ALTO', '00000001.alto.xml')))
+
+        package = zipfile.ZipFile(package_path)
+        self.assertIsNone(package.testzip())
+        self.assertEqual(package.namelist(), ['00000001.tif', '00000001.xml', '00000001.txt',
+            'meta.yml', 'marc.xml', '010000000001.mets.xml', 'checksum.md5'])
+        self.assertEqual(package.read('00000001.xml'), '<alto/>')
+        self.assertEqual(package.read('checksum.md5').splitlines(),
+            ['%s %s' % (md5(package.read(name)).hexdigest(), name) for name in package.namelist()[:-1]])
+
+        # Tiffs are stored, the text files are deflated.
+        self.assertEqual([info.compress_type for info in package.infolist()],
+            [zipfile.ZIP_STORED] + [zipfile.ZIP_DEFLATED] * 6)
+
+        # The digests are kept for the next package.
+        tiff = FileCache.objects.get(path=os.path.join(self.volume, 'TIFF', '00000001.tif'))
+        self.assertEqual(tiff.sha1, sha1(self.files['TIFF/00000001.tif']).hexdigest())
+
+    def test_stored(self):
+        package_path = os.path.join(self.kdip_dir, 'package.zip')
+        with PackageBuilder(package_path, {'*': 0}) as package:
+            digests = package.write_file(os.path.join(self.volume, 'TIFF', '00000001.tif'))
+            package.write_checksums()
+        self.assertEqual(digests['md5'], md5(self.files['TIFF/00000001.tif']).hexdigest())
+        self.assertEqual(package.bytes_read, 4000)
+        info = zipfile.ZipFile(package_path).getinfo('00000001.tif')
+        self.assertEqual((info.compress_type, info.compress_size), (zipfile.ZIP_STORED, 4000))
+
+    def test_compression_report(self):
+        package_path = os.path.join(self.kdip_dir, 'package.zip')
+        with PackageBuilder(package_path, {'.TIF': 0, '.txt': 9, '*': 1}) as package:
+            package.write_file(os.path.join(self.volume, 'TIFF', '00000001.tif'))
+            package.write_file(os.path.join(self.volume, 'OCR', '00000001.txt'))
+            package.write_file(os.path.join(self.volume, 'marc.xml'))
+        self.assertEqual([package.level(name) for name in ('a.tif', 'a.txt', 'a.xml', 'a')], [0, 9, 1, 1])
+        self.assertEqual(sorted(package.report), ['.tif', '.txt', '.xml'])
+        self.assertEqual((package.report['.tif']['bytes_in'], package.report['.tif']['bytes_out']),
+            (4000, 4000))
+        self.assertEqual(len(package.summary()), 3)
+        self.assertTrue(package.summary()[0].startswith('.tif: 1 files, 4000 bytes in, 4000 out (100%)'))
+
+    def test_streamed(self):
+        paths = [os.path.join(self.volume, name) for name in sorted(self.files)]
+        sink = Sink()
+        with PackageBuilder(sink) as package:
+            for path in paths:
+                package.write_file(path)
+            package.write_checksums()
+        self.assertTrue(package.streaming)
+        self.assertEqual(PackageBuilder.measure(paths), len(sink.data))
+
+        package = zipfile.ZipFile(StringIO(sink.data))
+        self.assertIsNone(package.testzip())
+        self.assertEqual(package.read('00000001.tif'), self.files['TIFF/00000001.tif'])
+        self.assertEqual(package.read('checksum.md5').splitlines(),
+            ['%s %s' % (md5(package.read(name)).hexdigest(), name) for name in package.namelist()[:-1]])
+        self.assertEqual(package.getinfo('checksum.md5').compress_type, zipfile.ZIP_STORED)
+
+        # The same files make the same package later on.
+        later = Sink()
+        with patch('zipfile.time') as zipfile_time:
+            zipfile_time.time.return_value = time.time() + 3600
+            zipfile_time.localtime = time.localtime
+            with PackageBuilder(later) as package:
+                for path in paths:
+                    package.write_file(path)
+                package.write_checksums()
+        self.assertEqual(later.data, sink.data)
+
+
+class Sink(object):
+    "Keeps what is written to it and can't seek, like an upload."
+
+    def __init__(self):
+        self.data = ''
+
+    def write(self, data):
+        self.data += str(data)
+
+    def tell(self):
+        return len(self.data)
+
+    def flush(self):
+        pass
+
+
+class TestUploadForHT(TestCase):
+
+    def setUp(self):
+        self.job = Job.objects.create(name='upload', status='uploading')
+        self.kdips = [KDip.objects.create(kdip_id='01000000000%s' % number, job=self.job,
+            create_date='2015-12-30 15:43:17', status='new', pid='pid%s' % number) for number in range(3)]
+
+    @patch('digitizedbooks.apps.publish.tasks.django_rq.get_queue')
+    def test_fan_out(self, get_queue):
+        self.kdips[2].status = 'uploaded'
+        self.kdips[2].save()
+        tasks.upload_for_ht(self.job)
+
+        calls = get_queue.return_value.enqueue.call_args_list
+        self.assertEqual(sorted(call[0] for call in calls),
+            [(tasks.upload_volume, self.job.id, self.kdips[0].id), (tasks.upload_volume, self.job.id, self.kdips[1].id)])
+
+    @patch('digitizedbooks.apps.publish.models.django_rq.get_queue')
+    def test_job_saved_before_upload(self, get_queue):
+        statuses = []
+        get_queue.return_value.enqueue.side_effect = \
+            lambda task, job: statuses.append(Job.objects.get(pk=job.pk).status)
+        Job.objects.filter(pk=self.job.pk).update(status='ready for hathi')
+        self.job.status = 'ready for hathi'
+        self.job.save()
+        self.assertEqual(statuses, ['uploading'])
+
+    def test_nothing_to_upload(self):
+        KDip.objects.filter(job=self.job).update(status='uploaded')
+        # The job as it is before the transaction that saved it is committed.
+        Job.objects.filter(pk=self.job.pk).update(status='ready for hathi')
+        with self.settings(HATHITRUST_CONTACTS=['ht@example.com'], EMORY_MANAGERS=[],
+                EMORY_CONTACT='dbooks@example.com'):
+            tasks.upload_for_ht(self.job)
+        self.assertEqual(Job.objects.get(pk=self.job.pk).status, 'being processed')
+        self.assertEqual(len(mail.outbox), 1)
+
+    @patch.object(tasks, 'upload_kdip')
+    @patch.object(tasks, 'package_kdip')
+    def test_pipeline(self, package_kdip, upload_kdip):
+        with self.settings(HT_UPLOAD_MODE='pipeline', KDIP_DIR=tempfile.gettempdir()):
+            tasks.upload_for_ht(self.job)
+        ids = sorted(kdip.id for kdip in self.kdips)
+        self.assertEqual(sorted(call[0] for call in package_kdip.call_args_list),
+            [(self.job.id, kdip_id) for kdip_id in ids])
+        self.assertEqual(sorted(call[0] for call in upload_kdip.call_args_list),
+            [(self.job.id, kdip_id) for kdip_id in ids])
+
+    @patch.object(tasks, 'upload_file')
+    @patch.object(tasks, 'build_package', side_effect=IOError('disk full'))
+    def test_package_failure(self, build_package, upload_file):
+        tasks.package_kdip(self.job.id, self.kdips[0].id)
+        self.assertEqual(KDip.objects.get(pk=self.kdips[0].id).status, 'upload_fail')
+        # The upload is skipped, but still lets the job know.
+        tasks.upload_kdip(self.job.id, self.kdips[0].id)
+        self.assertFalse(upload_file.called)
+
+    @patch.object(tasks, 'finish_job')
+    @patch.object(tasks, 'upload_file')
+    @patch.object(tasks, 'package_kdip', side_effect=DatabaseError('gone away'))
+    def test_upload_after_package_error(self, package_kdip, upload_file, finish_job):
+        tasks.upload_volume(self.job.id, self.kdips[0].id)
+        self.assertTrue(upload_file.called)
+        finish_job.assert_called_once_with(self.job.id)
+
+    def test_finish_job(self):
+        def upload(kdip, status):
+            kdip.status = status
+            kdip.save()
+            with self.settings(HATHITRUST_CONTACTS=['ht@example.com'], EMORY_MANAGERS=[],
+                    EMORY_CONTACT='dbooks@example.com'):
+                tasks.finish_job(self.job.id)
+            return Job.objects.get(pk=self.job.id).status
+
+        self.assertEqual(upload(self.kdips[0], 'uploaded'), 'uploading')
+        self.assertEqual(upload(self.kdips[1], 'uploaded'), 'uploading')
+        self.assertEqual(upload(self.kdips[2], 'uploaded'), 'being processed')
+        self.assertEqual(len(mail.outbox), 1)
+        # A late callback does not send the email again.
+        self.assertEqual(upload(self.kdips[2], 'uploaded'), 'being processed')
+        self.assertEqual(len(mail.outbox), 1)
+
+        Job.objects.filter(pk=self.job.id).update(status='uploading')
+        self.assertEqual(upload(self.kdips[2], 'upload_fail'), 'failed')
+        self.assertEqual(len(mail.outbox), 1)
+
+
+class TestUploadPipeline(TestCase):
+
+    def run_pipeline(self, upload_time=0, package_error=None, **kwargs):
+        events = []
+
+        def package(item):
+            events.append(('package', item))
+            if package_error:
+                raise package_error
+
+        def upload(item):
+            events.append(('upload', item))
+            sleep(upload_time)
+
+        pipeline = PipelinedUploader(package, upload, **kwargs)
+        self.assertEqual(pipeline.run(range(4)), 4)
+        self.assertEqual([item for event, item in events if event == 'upload'], range(4))
+        for item in range(4):
+            self.assertTrue(events.index(('package', item)) < events.index(('upload', item)))
+        return pipeline
+
+    def test_overlap(self):
+        # The first upload only ends once the second volume is packaged,
+        # which has to happen while it uploads.
+        packaged = threading.Event()
+
+        def package(item):
+            if item == 1:
+                packaged.set()
+
+        def upload(item):
+            if item == 0:
+                self.assertTrue(packaged.wait(10))
+
+        pipeline = PipelinedUploader(package, upload, lookahead=2)
+        self.assertEqual(pipeline.run(range(4)), 4)
+        self.assertIn(pipeline.most_ahead, (1, 2))
+        self.assertEqual(pipeline.space_waits, 0)
+        self.assertIn('overlapped uploads', pipeline.summary())
+
+    def test_lookahead(self):
+        pipeline = self.run_pipeline(upload_time=0.02, lookahead=1)
+        self.assertEqual(pipeline.most_ahead, 1)
+        self.assertEqual(pipeline.space_waits, 0)
+
+    @patch('digitizedbooks.apps.publish.UploadPipeline.free_space', return_value=50)
+    def test_free_space(self, free_space):
+        # The first upload lasts until the packaging waits for space: with one
+        # package waiting there is no room for the next.
+        def upload(item):
+            for tries in range(1000):
+                if item or pipeline.space_waits:
+                    break
+                sleep(0.01)
+
+        pipeline = PipelinedUploader(lambda item: None, upload, lookahead=3, directory='/packages',
+            size=lambda item: 60)
+        self.assertEqual(pipeline.run(range(4)), 4)
+        # One is packaged when none is waiting.
+        self.assertEqual(pipeline.most_ahead, 1)
+        self.assertTrue(pipeline.space_waits > 0)
+
+    def test_package_error(self):
+        # The uploads still run and find out the package is missing.
+        self.run_pipeline(package_error=IOError('disk full'))
+
+    def test_upload_error(self):
+        packaged = []
+        pipeline = PipelinedUploader(packaged.append, Mock(side_effect=IOError('offline')), lookahead=1)
+        self.assertRaises(IOError, pipeline.run, range(10))
+        # The packaging stops too.
+        self.assertTrue(len(packaged) < 10)
+
+
+class StandInBoxHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    "Answers the upload session requests of the Box API."
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, status, body=None):
+        content = json.dumps(body) if body is not None else ''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def session(self):
+        session = self.server.sessions.get(self.path.split('?')[0].split('/')[5])
+        if session is None:
+            self.reply(404, {'code': 'not_found'})
+        return session
+
+    def do_POST(self):
+        server = self.server
+        if self.path.endswith('/commit'):
+            session = self.session()
+            if session is None:
+                return
+            data = ''.join(session['parts'][part['offset']][1] for part in json.loads(self.body())['parts'])
+            if self.headers['Digest'] != 'sha=' + base64.b64encode(sha1(data).digest()):
+                return self.reply(412, {'code': 'precondition_failed'})
+            file_id = session.get('file_id') or str(len(server.files) + 1)
+            server.files[file_id] = (session['file_name'], data)
+            return self.reply(201, {'entries': [{'type': 'file', 'id': file_id, 'sha1': sha1(data).hexdigest()}]})
+
+        body = json.loads(self.body())
+        file_id = None
+        if self.path.endswith('/files/upload_sessions'):
+            for existing_id, (name, data) in server.files.items():
+                if name == body['file_name']:
+                    return self.reply(409, {'code': 'item_name_in_use',
+                        'context_info': {'conflicts': {'id': existing_id}}})
+        else:
+            file_id = self.path.split('/')[4]
+        session_id = 'session%s' % (len(server.sessions) + 1)
+        server.sessions[session_id] = {'file_name': body.get('file_name', server.files.get(file_id, ('',))[0]),
+            'file_id': file_id, 'parts': {}, 'total_parts': -(-body['file_size'] // server.part_size)}
+        self.reply(201, {'id': session_id, 'part_size': server.part_size,
+            'total_parts': server.sessions[session_id]['total_parts']})
+
+    def do_PUT(self):
+        session = self.session()
+        if session is None:
+            return
+        data = self.body()
+        if self.headers['Digest'] != 'sha=' + base64.b64encode(sha1(data).digest()):
+            return self.reply(412, {'code': 'precondition_failed'})
+        offset = int(self.headers['Content-Range'].split()[1].split('-')[0])
+        part = {'part_id': '%08d' % offset, 'offset': offset, 'size': len(data), 'sha1': sha1(data).hexdigest()}
+        session['parts'][offset] = (part, data)
+        self.server.part_requests += 1
+        self.reply(200, {'part': part})
+
+    def do_GET(self):
+        session = self.session()
+        if session is None:
+            return
+        if '/parts' in self.path:
+            parts = [part for part, data in sorted(session['parts'].values())]
+            return self.reply(200, {'entries': parts, 'total_count': len(parts)})
+        self.reply(200, {'id': self.path.split('/')[5], 'part_size': self.server.part_size,
+            'total_parts': session['total_parts']})
+
+
+class StandInBoxServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    "Local stand-in for the Box upload API, the files it gets are kept in ``files``."
+    daemon_threads = True
+
+    def __init__(self, part_size=1024):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), StandInBoxHandler)
+        self.part_size = part_size
+        self.sessions = {}
+        self.files = {}
+        self.part_requests = 0
+        self.url = 'http://127.0.0.1:%s/api/2.0' % self.server_port
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+
+class StandInBoxClient(object):
+    "Makes requests like boxsdk's Client, without the authentication."
+
+    def __init__(self, fail_after=None):
+        self.fail_after = fail_after
+        self.parts = 0
+
+    def make_request(self, method, url, **kwargs):
+        if method == 'PUT':
+            self.parts += 1
+            if self.fail_after is not None and self.parts > self.fail_after:
+                raise requests.ConnectionError('connection dropped')
+        response = requests.request(method, url, **kwargs)
+        if response.status_code >= 400:
+            raise BoxException.BoxAPIException(response.status_code,
+                context_info=response.json().get('context_info'))
+        return response
+
+
+class Killed(BaseException):
+    "Stands in for the worker being killed, nothing catches it."
+
+
+class TestChunkedUpload(TestCase):
+
+    def setUp(self):
+        self.server = StandInBoxServer()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.package = os.path.join(self.tmp_dir, '010000000001.zip')
+        self.data = os.urandom(10 * 1024 + 100)
+        with open(self.package, 'wb') as package:
+            package.write(self.data)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_upload(self):
+        sessions = []
+        with self.settings(BOX_UPLOAD_URL=self.server.url):
+            uploaded = ChunkedUpload(StandInBoxClient(), self.package, '0', workers=3,
+                on_session=sessions.append).run()
+            self.assertEqual(uploaded.sha1, sha1(self.data).hexdigest())
+            self.assertEqual(self.server.files[uploaded.id], ('010000000001.zip', self.data))
+            self.assertEqual((sessions, self.server.part_requests), (['session1'], 11))
+
+            # The same name again makes a new version of the file.
+            again = ChunkedUpload(StandInBoxClient(), self.package, '0').run()
+            self.assertEqual(again.id, uploaded.id)
+
+    def test_resume(self):
+        with self.settings(BOX_UPLOAD_URL=self.server.url):
+            upload = ChunkedUpload(StandInBoxClient(fail_after=4), self.package, '0', workers=1)
+            self.assertRaises(requests.ConnectionError, upload.run)
+            self.assertEqual(self.server.files, {})
+
+            # Only the parts that did not make it are sent again.
+            resumed = ChunkedUpload(StandInBoxClient(), self.package, '0', session_id=upload.session_id)
+            uploaded = resumed.run()
+            self.assertEqual((resumed.parts_sent, self.server.part_requests), (7, 11))
+            self.assertEqual(self.server.files[uploaded.id][1], self.data)
+
+            # An expired session starts over.
+            expired = ChunkedUpload(StandInBoxClient(), self.package, '0', session_id='gone')
+            expired.run()
+            self.assertEqual((expired.session_id, expired.parts_sent), ('session2', 11))
+
+    @patch.object(tasks, 'sleep')
+    @patch.object(tasks, 'refresh_client')
+    def test_upload_file(self, refresh_client, sleep):
+        # The connection drops after two parts, the retry resumes the session.
+        refresh_client.side_effect = [StandInBoxClient(fail_after=2), StandInBoxClient()]
+        job = Job.objects.create(name='chunked', status='uploading')
+        kdip = KDip.objects.create(kdip_id='010000000001', create_date='2015-12-30 15:43:17',
+            job=job, status='new')
+        with self.settings(BOX_UPLOAD_URL=self.server.url, KDIP_DIR=self.tmp_dir,
+                BOX_CHUNKED_THRESHOLD=1024, BOX_UPLOAD_WORKERS=1, BOXFOLDER='0'):
+            os.makedirs(os.path.dirname(kdip.process_dir))
+            os.rename(self.package, kdip.process_dir + '.zip')
+            tasks.upload_file(job, kdip)
+
+        kdip = KDip.objects.get(pk=kdip.pk)
+        self.assertEqual((kdip.status, kdip.upload_session), ('uploaded', ''))
+        self.assertEqual((len(self.server.sessions), self.server.part_requests), (1, 11))
+
+    def test_stream(self):
+        with self.settings(BOX_UPLOAD_URL=self.server.url):
+            upload = ChunkedUpload(StandInBoxClient(fail_after=4), None, '0', name='010000000001.zip',
+                size=len(self.data), workers=1)
+            stream = upload.stream()
+            self.assertRaises(requests.ConnectionError, stream.write, self.data)
+            stream.abort()
+
+            # Written again, only the parts that did not make it are sent.
+            resumed = ChunkedUpload(StandInBoxClient(), None, '0', name='010000000001.zip',
+                size=len(self.data), session_id=upload.session_id)
+            stream = resumed.stream()
+            for start in range(0, len(self.data), 1000):
+                stream.write(self.data[start:start + 1000])
+            uploaded = stream.close()
+            self.assertEqual(uploaded.sha1, sha1(self.data).hexdigest())
+            self.assertEqual(self.server.files[uploaded.id], ('010000000001.zip', self.data))
+            self.assertEqual((resumed.parts_sent, self.server.part_requests), (7, 11))
+
+            short = ChunkedUpload(StandInBoxClient(), None, '0', name='short.zip', size=len(self.data))
+            stream = short.stream()
+            stream.write(self.data[:-1])
+            self.assertRaises(ValueError, stream.close)
+
+    def write_volume(self):
+        "Writes the files of a volume, returns their paths in package order."
+        paths = []
+        volume = os.path.join(self.tmp_dir, '010000000001')
+        for name, data in (('TIFF/00000001.tif', self.data), ('meta.yml', 'yaml'), ('marc.xml', '<marc/>'),
+                ('METS/010000000001.mets.xml', '<mets/>')):
+            path = os.path.join(volume, name)
+            if not os.path.exists(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'wb') as volume_file:
+                volume_file.write(data)
+            paths.append(path)
+        return paths
+
+    def stream_package(self, upload, paths):
+        stream = upload.stream()
+        package = PackageBuilder(stream)
+        for path in paths:
+            package.write_file(path)
+        package.write_checksums()
+        package.close()
+        return stream.close()
+
+    def test_resume_streamed_package(self):
+        paths = self.write_volume()
+        size = PackageBuilder.measure(paths)
+
+        # Every part is sent, then the connection drops before the commit.
+        client = StandInBoxClient()
+        def make_request(method, url, **kwargs):
+            if url.endswith('/commit'):
+                raise requests.ConnectionError('connection dropped')
+            return StandInBoxClient.make_request(client, method, url, **kwargs)
+        client.make_request = make_request
+
+        with self.settings(BOX_UPLOAD_URL=self.server.url):
+            upload = ChunkedUpload(client, None, '0', name='010000000001.zip', size=size)
+            self.assertRaises(requests.ConnectionError, self.stream_package, upload, paths)
+
+            # Written again later, the package is the same so what Box has
+            # matches its sha1.
+            resumed = ChunkedUpload(StandInBoxClient(), None, '0', name='010000000001.zip', size=size,
+                session_id=upload.session_id)
+            with patch('zipfile.time') as zipfile_time:
+                zipfile_time.time.return_value = time.time() + 3600
+                zipfile_time.localtime = time.localtime
+                uploaded = self.stream_package(resumed, paths)
+        self.assertEqual(resumed.parts_sent, 0)
+        package = zipfile.ZipFile(StringIO(self.server.files[uploaded.id][1]))
+        self.assertIsNone(package.testzip())
+
+    @patch('digitizedbooks.apps.publish.BoxUpload.ThreadPool', InProcessPool)
+    @patch.object(tasks, 'finish_job')
+    @patch.object(tasks, 'refresh_client')
+    def test_upload_volume_resumes(self, refresh_client, finish_job):
+        # The worker is killed after four parts are sent.
+        killed = StandInBoxClient()
+        def make_request(method, url, **kwargs):
+            if method == 'PUT' and killed.parts == 4:
+                raise Killed()
+            return StandInBoxClient.make_request(killed, method, url, **kwargs)
+        killed.make_request = make_request
+        refresh_client.side_effect = [killed, StandInBoxClient()]
+
+        job = Job.objects.create(name='killed', status='uploading')
+        kdip = KDip.objects.create(kdip_id='010000000001', create_date='2015-12-30 15:43:17',
+            job=job, status='new', path=self.tmp_dir, pid='pid1')
+        self.write_volume()
+        with self.settings(BOX_UPLOAD_URL=self.server.url, KDIP_DIR=self.tmp_dir,
+                BOX_CHUNKED_THRESHOLD=1024, BOX_UPLOAD_WORKERS=1, BOXFOLDER='0'):
+            self.assertRaises(Killed, tasks.upload_volume, job.id, kdip.id)
+            self.assertEqual(KDip.objects.get(pk=kdip.pk).upload_session, 'session1')
+
+            # The next worker keeps the package and only sends the parts Box
+            # does not have.
+            package_path = kdip.process_dir + '.zip'
+            with open(package_path, 'rb') as package:
+                data = package.read()
+            os.utime(package_path, (0, 0))
+            tasks.upload_volume(job.id, kdip.id)
+
+        kdip = KDip.objects.get(pk=kdip.pk)
+        self.assertEqual((kdip.status, kdip.upload_session), ('uploaded', ''))
+        self.assertEqual(os.stat(package_path).st_mtime, 0)
+        parts = -(-len(data) // self.server.part_size)
+        self.assertEqual((len(self.server.sessions), self.server.part_requests), (1, parts))
+        self.assertEqual(self.server.files.values()[0][1], data)
+        finish_job.assert_called_once_with(job.id)
+
+    @patch.object(tasks, 'refresh_client')
+    def test_upload_file_streaming(self, refresh_client):
+        refresh_client.return_value = StandInBoxClient()
+        job = Job.objects.create(name='streamed', status='uploading')
+        kdip = KDip.objects.create(kdip_id='010000000001', create_date='2015-12-30 15:43:17',
+            job=job, status='new', path=self.tmp_dir, pid='pid1')
+        self.write_volume()
+
+        with self.settings(BOX_UPLOAD_URL=self.server.url, KDIP_DIR=self.tmp_dir, HT_PACKAGE_STREAMING=True,
+                BOX_CHUNKED_THRESHOLD=1024, BOXFOLDER='0'):
+            # A session left by an upload of another package is not resumed.
+            stale = ChunkedUpload(StandInBoxClient(), None, '0', name='010000000001.zip', size=3 * len(self.data))
+            stale.stream()
+            KDip.objects.filter(pk=kdip.pk).update(upload_session=stale.session_id)
+            kdip = KDip.objects.get(pk=kdip.pk)
+            tasks.upload_file(job, kdip)
+            self.assertFalse(os.path.exists(kdip.process_dir + '.zip'))
+
+            # Packaging again keeps the session for the upload to resume.
+            KDip.objects.filter(pk=kdip.pk).update(upload_session=stale.session_id)
+            tasks.package_kdip(job.id, kdip.id)
+            self.assertEqual(KDip.objects.get(pk=kdip.pk).upload_session, stale.session_id)
+            KDip.objects.filter(pk=kdip.pk).update(upload_session='')
+
+        kdip = KDip.objects.get(pk=kdip.pk)
+        self.assertEqual((kdip.status, kdip.upload_session), ('uploaded', ''))
+        self.assertEqual(len(self.server.sessions), 2)
+        package = zipfile.ZipFile(StringIO(self.server.files.values()[0][1]))
+        self.assertIsNone(package.testzip())
+        self.assertEqual(package.read('00000001.tif'), self.data)
+
+
+class TestValidateTiff(TestCase):
+
+    def setUp(self):
+        self.tif_dir = tempfile.mkdtemp()
+        self.tiffs = []
+        for page in range(4):
+            tiff = os.path.join(self.tif_dir, '%08d.tif' % page)
+            self.tiffs.append(tiff)
+            if page == 2:
+                with open(tiff, 'w') as not_a_tiff:
+                    not_a_tiff.write('not a tiff')
+            else:
+                Image.new('L', (10, 10)).save(tiff, dpi=(600, 600))
+
+    def tearDown(self):
+        shutil.rmtree(self.tif_dir)
+
+    def test_validate_tiff_files(self):
+        errors = validate_tiff_files(self.tiffs, workers=1)
+        self.assertTrue(errors)
+        self.assertEqual([error for error in errors if self.tiffs[2] in error],
+            ValidateTiff(self.tiffs[2]).validate_tiffs())
+        # Same errors in the same order with a pool.
+        self.assertEqual(validate_tiff_files(self.tiffs, workers=3), errors)
+
+    def test_rules(self):
+        tags = {256: (10,), 257: (10,), 258: (8,), 259: (1,), 262: (1,), 271: 'Make', 272: 'Model',
+            274: (1,), 277: (1,), 282: ((600, 1),), 283: ((1200, 2),), 296: (2,), 306: '2015:06:01 12:00:00'}
+        self.assertEqual(ValidateTiff('page.tif', tags=tags).validate_tiffs(), [])
+
+        low_resolution = dict(tags, **{282: ((300, 1),), 271: ''})
+        self.assertEqual(ValidateTiff('page.tif', tags=low_resolution).validate_tiffs(),
+            ['Invalid value for Make in  page.tif', 'Invalid value for XResolution in  page.tif'])
+
+        color = dict(tags, **{258: (8, 8, 8), 259: (4,), 262: (2,), 277: (3,), 282: ((300, 1),)})
+        self.assertEqual(ValidateTiff('page.tif', tags=color).validate_tiffs(),
+            ['Invalid value for Compression in  page.tif'])
+
+        two_channels = dict(tags, **{258: (8, 8)})
+        self.assertEqual(ValidateTiff('page.tif', tags=two_channels).validate_tiffs(),
+            ['Cannot determine type for  page.tif'])
+
+        rules = compile_rules({'tags': [('Make', {'values': ['Scanner']})],
+            'image_types': [('Any', {'BitsPerSample': [8], 'tags': []})]})
+        self.assertEqual(ValidateTiff('page.tif', tags=tags).validate_tiffs(rules),
+            ['Invalid value for Make in  page.tif'])
+        self.assertRaises(ImproperlyConfigured, compile_rules,
+            {'tags': [('NoSuchTag', {})], 'image_types': []})
+
+    def test_read_tags(self):
+        image = Image.open(self.tiffs[0])
+        pil_tags = dict((tag, image.tag[tag]) for tag in image.tag.keys())
+        image.close()
+        self.assertEqual(TiffHeader.read_tags(self.tiffs[0]), pil_tags)
+        self.assertEqual(TiffHeader.read_tags(self.tiffs[0], [256, 282]),
+            {256: (10,), 282: ((600, 1),)})
+        with self.settings(TIFF_TAG_READER='pil'):
+            self.assertEqual(ValidateTiff(self.tiffs[0]).read_tags(),
+                TiffHeader.read_tags(self.tiffs[0], TIF_TAGS.values()))
+        self.assertRaises(TiffHeaderError, TiffHeader.read_tags, self.tiffs[2])
+
+    def test_read_big_tiff_tags(self):
+        # Big endian BigTIFF with the IFD at 16 and a DateTime stored after it.
+        big_tiff = os.path.join(self.tif_dir, 'big.tif')
+        date_time = '2015:06:01 12:00:00\0'
+        with open(big_tiff, 'wb') as tiff:
+            tiff.write(struct.pack('>2sHHHQ', 'MM', 43, 8, 0, 16))
+            tiff.write(struct.pack('>Q', 2))
+            tiff.write(struct.pack('>HHQQ', 256, 4, 1, 5 << 32))
+            tiff.write(struct.pack('>HHQQ', 306, 2, len(date_time), 16 + 8 + 2 * 20 + 8))
+            tiff.write(struct.pack('>Q', 0))
+            tiff.write(date_time)
+        self.assertEqual(TiffHeader.read_tags(big_tiff),
+            {256: (5,), 306: '2015:06:01 12:00:00'})
+
 class TestHTMarc(TestCase):
     def test_ht_marc(self):
         rec = Utils.create_ht_marc('010000666241')